@@ -1,19 +1,21 @@
 from flask import Flask
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+import database
+import metrics
+from extensions import db, bcrypt
+from json_provider import FastJSONProvider
 
 app = Flask(__name__)
 app.config.from_object('config.Config')
+app.json = FastJSONProvider(app)
 
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
+db.init_app(app)
+bcrypt.init_app(app)
+metrics.init_app(app)
 
 from auth.views import auth_blueprint
 from diary.views import diary_blueprint
 app.register_blueprint(auth_blueprint)
 app.register_blueprint(diary_blueprint)
 
-with app.app_context():
-    db.drop_all()
-    db.create_all()
+import commands
@@ -0,0 +1,202 @@
+import datetime
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'blacklist'
+
+
+class BloomFilter:
+    """
+    Fixed size bloom filter, answers "definitely not" or "maybe"
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # double hashing on two halves of one digest
+        digest = hashlib.sha256(item.encode()).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        # overlapping syncs add the same tokens again, count them once
+        if item in self:
+            return
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class RedisInvalidation:
+    """
+    Carries blacklisted digests to every process on a redis channel, a
+    listener thread per process hands them to cache.receive
+    """
+
+    def __init__(self, url, cache, app):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.cache = cache
+        self.app = app
+
+    def publish(self, digest):
+        self.redis.publish(CHANNEL, digest)
+
+    def start(self):
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                for item in pubsub.listen():
+                    with self.app.app_context():
+                        self.cache.receive(item['data'].decode())
+            except Exception:
+                # messages missed meanwhile still arrive with the next sync
+                logger.warning('Blacklist invalidation listener failed', exc_info=True)
+                time.sleep(1)
+
+
+class BlacklistCache:
+    """
+    In-process membership layer in front of the blacklist_tokens table.
+    The database is only asked about tokens the bloom filter may contain
+    and confirmed hits are kept in a small LRU. Tokens are identified by
+    their digest everywhere.
+
+    A token blacklisted in one process reaches the others through redis
+    at once when BLACKLIST_BROKER_URL is set, and through sync() within
+    BLACKLIST_SYNC_INTERVAL seconds in any case. Rows can commit out of
+    id order, so every sync also re-reads the tokens blacklisted in the
+    last BLACKLIST_SYNC_OVERLAP seconds.
+    """
+
+    def __init__(self, source):
+        # source provides count(), lookup(digest) and
+        # since(last_id, recent) -> (id, digest) rows
+        self.source = source
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.hits = OrderedDict()
+        self.last_id = 0
+        self.last_sync = 0.0
+        self.listeners = []
+        self.transport = None
+        self.pid = None
+
+    def _connect(self):
+        # threads do not survive a fork, one listener per process
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            url = current_app.config.get('BLACKLIST_BROKER_URL')
+            if not url:
+                return
+            if self.transport is not None:
+                self.listeners.remove(self.transport.publish)
+            self.transport = RedisInvalidation(url, self, current_app._get_current_object())
+            self.listeners.append(self.transport.publish)
+        self.transport.start()
+
+    def warm(self):
+        # rebuild the filter from the whole table
+        config = current_app.config
+        capacity = max(config.get('BLACKLIST_BLOOM_CAPACITY'), 2 * self.source.count())
+        bloom = BloomFilter(capacity, config.get('BLACKLIST_BLOOM_ERROR_RATE'))
+        last_id = 0
+        for id, digest in self.source.since(0):
+            bloom.add(digest)
+            last_id = max(last_id, id)
+        with self.lock:
+            self.bloom = bloom
+            self.hits.clear()
+            self.last_id = last_id
+            self.last_sync = time.monotonic()
+
+    def sync(self):
+        # pick up tokens blacklisted by other processes
+        config = current_app.config
+        if time.monotonic() - self.last_sync < config.get('BLACKLIST_SYNC_INTERVAL'):
+            return
+        self.last_sync = time.monotonic()
+        recent = datetime.datetime.now() - datetime.timedelta(
+            seconds=config.get('BLACKLIST_SYNC_OVERLAP')
+        )
+        for id, digest in self.source.since(self.last_id, recent):
+            with self.lock:
+                self.bloom.add(digest)
+                self.last_id = max(self.last_id, id)
+        if self.bloom.count > self.bloom.capacity:
+            self.warm()
+
+    def add(self, digest):
+        self._connect()
+        self.receive(digest)
+        for listener in self.listeners:
+            try:
+                listener(digest)
+            except Exception:
+                # the row is committed, the other processes sync it later
+                logger.warning('Could not publish a blacklisted token', exc_info=True)
+
+    def receive(self, digest):
+        # invalidation hook, call this with tokens published by other processes
+        if self.bloom is None:
+            self.warm()
+        with self.lock:
+            self.bloom.add(digest)
+            self._remember(digest)
+
+    def add_listener(self, listener):
+        # listener(digest) is called for every token blacklisted in this process
+        self.listeners.append(listener)
+
+    def contains(self, digest):
+        self._connect()
+        if self.bloom is None:
+            self.warm()
+        else:
+            self.sync()
+        if digest not in self.bloom:
+            return False
+        with self.lock:
+            if digest in self.hits:
+                self.hits.move_to_end(digest)
+                return True
+        if self.source.lookup(digest):
+            with self.lock:
+                self._remember(digest)
+            return True
+        return False
+
+    def _remember(self, digest):
+        self.hits[digest] = True
+        self.hits.move_to_end(digest)
+        while len(self.hits) > current_app.config.get('BLACKLIST_LRU_SIZE'):
+            self.hits.popitem(last=False)
@@ -0,0 +1,53 @@
+import functools
+
+from flask import request, make_response, jsonify, g
+
+from app import db
+from auth.models import User
+from auth.principal import principal_cache
+
+
+def login_required(f):
+    """
+    Verifies the auth token once and resolves the user once per request,
+    the principal is stored on g.principal, the raw token on g.auth_token
+    and its TokenResult on g.token
+    """
+
+    @functools.wraps(f)
+    def decorated(*args, **kwargs):
+        # get the auth token
+        auth_token = request.headers.get("Authorization")
+        if not auth_token:
+            responseObject = {
+                "status": "fail",
+                "message": "Provide a valid auth token.",
+            }
+            return make_response(jsonify(responseObject)), 401
+        token = User.verify_auth_token(auth_token)
+        if not token.valid:
+            responseObject = {"status": "fail", "message": token.error}
+            return make_response(jsonify(responseObject)), 401
+        principal = principal_cache.get(token.user_id, load_user)
+        if principal is None:
+            responseObject = {
+                "status": "fail",
+                "message": "A user with this auth token does not exist.",
+            }
+            return make_response(jsonify(responseObject)), 401
+        g.auth_token = auth_token
+        g.token = token
+        g.principal = principal
+        return f(*args, **kwargs)
+
+    return decorated
+
+
+def load_user(user_id):
+    # primary key lookup, served from the identity map when possible
+    return db.session.get(User, user_id)
+
+
+def current_user():
+    # full User row for handlers that need more than the principal
+    return load_user(g.principal.id)
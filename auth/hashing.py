@@ -0,0 +1,143 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+import metrics
+from extensions import bcrypt
+
+
+class HashingBusy(Exception):
+    """
+    Raised when every hashing slot is taken
+    """
+
+
+class BcryptHasher:
+    prefixes = ('$2a$', '$2b$', '$2y$')
+
+    def __init__(self, rounds):
+        self.rounds = rounds
+
+    def hash(self, password):
+        return bcrypt.generate_password_hash(password, self.rounds).decode()
+
+    def verify(self, hashed, password):
+        return bcrypt.check_password_hash(hashed, password)
+
+    def needs_rehash(self, hashed):
+        # $2b$<rounds>$...
+        return int(hashed.split('$')[2]) != self.rounds
+
+
+class Argon2Hasher:
+    prefixes = ('$argon2id$',)
+
+    def __init__(self, time_cost, memory_cost, parallelism):
+        import argon2
+        self.exceptions = argon2.exceptions
+        self.hasher = argon2.PasswordHasher(
+            time_cost=time_cost,
+            memory_cost=memory_cost,
+            parallelism=parallelism,
+            type=argon2.Type.ID,
+        )
+
+    def hash(self, password):
+        return self.hasher.hash(password)
+
+    def verify(self, hashed, password):
+        try:
+            return self.hasher.verify(hashed, password)
+        except self.exceptions.VerificationError:
+            return False
+        except self.exceptions.InvalidHash:
+            return False
+
+    def needs_rehash(self, hashed):
+        return self.hasher.check_needs_rehash(hashed)
+
+
+class PasswordHasher:
+    """
+    Hashes with the configured backend and verifies with whichever
+    backend made the stored hash. Work runs on a bounded thread pool,
+    when all HASH_MAX_PENDING slots are taken HashingBusy is raised
+    instead of queueing.
+    """
+
+    def __init__(self):
+        self.backends = None
+        self.executor = None
+        self.slots = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def _setup(self):
+        # pools do not survive a fork, build one per worker process
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self._build()
+
+    def _build(self):
+        config = current_app.config
+        self.backends = {'bcrypt': BcryptHasher(config.get('BCRYPT_LOG_ROUNDS'))}
+        try:
+            self.backends['argon2id'] = Argon2Hasher(
+                config.get('ARGON2_TIME_COST'),
+                config.get('ARGON2_MEMORY_COST'),
+                config.get('ARGON2_PARALLELISM'),
+            )
+        except ImportError:
+            if config.get('PASSWORD_HASHER') == 'argon2id':
+                raise
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.get('HASH_WORKERS'), thread_name_prefix='hasher'
+        )
+        self.slots = threading.BoundedSemaphore(config.get('HASH_MAX_PENDING'))
+        self.pid = os.getpid()
+
+    def _run(self, fn, *args):
+        self._setup()
+        if not self.slots.acquire(blocking=False):
+            raise HashingBusy('Too many password operations, try again later.')
+        try:
+            with metrics.timed('hash'):
+                return self.executor.submit(fn, *args).result()
+        finally:
+            self.slots.release()
+
+    def _backend(self, hashed):
+        for backend in self.backends.values():
+            if hashed.startswith(backend.prefixes):
+                return backend
+        raise ValueError('Unknown password hash format.')
+
+    def hash(self, password):
+        self._setup()
+        backend = self.backends[current_app.config.get('PASSWORD_HASHER')]
+        return self._run(backend.hash, password)
+
+    def verify(self, hashed, password):
+        """
+        Checks password against hashed, rehashing with the configured
+        backend and parameters when the stored hash is outdated
+        :return: (bool, new hash or None)
+        """
+        self._setup()
+        preferred = self.backends[current_app.config.get('PASSWORD_HASHER')]
+        backend = self._backend(hashed)
+        return self._run(self._verify, preferred, backend, hashed, password)
+
+    def _verify(self, preferred, backend, hashed, password):
+        if not backend.verify(hashed, password):
+            return False, None
+        if backend is not preferred or backend.needs_rehash(hashed):
+            return True, preferred.hash(password)
+        return True, None
+
+
+password_hasher = PasswordHasher()
@@ -1,7 +1,14 @@
 import datetime
+import time
 import jwt
+from flask import current_app
 
-from app import app, db, bcrypt
+import metrics
+from extensions import db
+from auth.blacklist import BlacklistCache
+from auth.hashing import password_hasher
+from auth.principal import principal_cache
+from auth.tokens import TokenResult, BLACKLISTED, token_service
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -11,30 +18,45 @@ class User(db.Model):
     password = db.Column(db.String(255), nullable=False)
     registered_on = db.Column(db.DateTime, nullable=False)
     admin = db.Column(db.Boolean, nullable=False, default=False)
+    # utc, bumped whenever the profile changes
+    updated_on = db.Column(db.DateTime, nullable=False)
 
     def __init__(self, email, password, admin=False):
         self.email = email
-        self.password = bcrypt.generate_password_hash(
-            password, app.config.get('BCRYPT_LOG_ROUNDS')
-        ).decode()
+        self.password = password_hasher.hash(password)
         self.registered_on = datetime.datetime.now()
+        self.updated_on = datetime.datetime.utcnow()
         self.admin = admin
 
     def encode_auth_token(self, user_id):
         try:
-            payload = {
-                'exp': datetime.datetime.utcnow() + datetime.timedelta(days=0, seconds=200),
-                'iat': datetime.datetime.utcnow(),
-                'sub': user_id
-                }
-            return jwt.encode(
-                payload,
-                app.config.get('SECRET_KEY'),
-                algorithm='HS256'
-                )
+            return token_service.encode(
+                user_id, current_app.config.get('AUTH_TOKEN_LIFETIME')
+            )
         except Exception as e:
             return e
 
+    def check_password(self, password):
+        # rehashes in place when the stored hash is outdated, the caller commits
+        ok, new_hash = password_hasher.verify(self.password, password)
+        if new_hash:
+            self.password = new_hash
+            db.session.add(self)
+        return ok
+
+    @staticmethod
+    def verify_auth_token(auth_token):
+        """
+        Validates the auth token, signature and expiry are memoized by
+        the token service but the blacklist is checked every time
+        :param auth_token:
+        :return: TokenResult
+        """
+        result = token_service.verify(auth_token)
+        if result.valid and BlacklistToken.check_digest(result.digest, result.exp):
+            return TokenResult.failed(BLACKLISTED, result.digest)
+        return result
+
     @staticmethod
     def decode_auth_token(auth_token):
         """
@@ -42,25 +64,17 @@ class User(db.Model):
         :param auth_token:
         :return: integer|string
         """
-        try:
-            payload = jwt.decode(auth_token, app.config.get('SECRET_KEY'),algorithms='HS256')
-            is_blacklisted_token = BlacklistToken.check_blacklist(auth_token)
-            if is_blacklisted_token:
-                return 'Token blacklisted. Please log in again.'
-            else:
-                return payload['sub']
-        except jwt.ExpiredSignatureError:
-            return 'Signature expired. Please log in again.'
-        except jwt.InvalidTokenError:
-            print(auth_token)
-            return 'Invalid token. Please log in again.'
-        
+        result = User.verify_auth_token(auth_token)
+        return result.user_id if result.valid else result.error
+
     def update(self, data):
         for key, value in data.items():
             if key == 'email':
                 self.email = value
+        self.updated_on = datetime.datetime.utcnow()
         db.session.add(self)
         db.session.commit()
+        principal_cache.invalidate(self.id)
         return 'Email Update Succesful'
 
 class BlacklistToken(db.Model):
@@ -70,21 +84,99 @@ class BlacklistToken(db.Model):
     __tablename__ = 'blacklist_tokens'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    token = db.Column(db.String(500), unique=True, nullable=False)
-    blacklisted_on = db.Column(db.DateTime, nullable=False)
+    # hex sha256 of the token, raw tokens are never stored
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    blacklisted_on = db.Column(db.DateTime, nullable=False, index=True)
+    # utc expiry of the token, the row is useless after it
+    exp = db.Column(db.DateTime, nullable=False, index=True)
 
     def __init__(self, token):
-        self.token = token
+        self.token_hash = BlacklistToken.digest(token)
         self.blacklisted_on = datetime.datetime.now()
+        # the token was validated before logout, only the claim is needed here
+        payload = jwt.decode(token, options={'verify_signature': False})
+        self.exp = datetime.datetime.utcfromtimestamp(payload['exp'])
 
     def __repr__(self):
-        return '<id: token: {}'.format(self.token)
+        return '<id: token_hash: {}'.format(self.token_hash)
+
+    @staticmethod
+    def digest(auth_token):
+        return token_service.digest(auth_token)
 
     @staticmethod
-    def check_blacklist(auth_token):
+    def check_blacklist(auth_token, exp=None):
         # check whether auth token has been blacklisted
-        res = BlacklistToken.query.filter_by(token=str(auth_token)).first()
+        return BlacklistToken.check_digest(BlacklistToken.digest(auth_token), exp)
+
+    @staticmethod
+    def check_digest(token_hash, exp=None):
+        # only bloom filter hits reach the database
+        if exp is not None and exp <= time.time():
+            # expired tokens are rejected anyway and may already be purged
+            return False
+        return blacklist_cache.contains(token_hash)
+
+    @staticmethod
+    def lookup(token_hash):
+        res = BlacklistToken.query.filter(
+            BlacklistToken.token_hash == token_hash,
+            BlacklistToken.exp > datetime.datetime.utcnow()
+        ).first()
         if res:
             return True
         else:
             return False
+
+    @staticmethod
+    def count():
+        return BlacklistToken.query.count()
+
+    @staticmethod
+    def since(last_id, recent=None):
+        # rows after last_id, and those blacklisted from recent on
+        # whatever their id, a lower id may have committed later
+        condition = BlacklistToken.id > last_id
+        if recent is not None:
+            condition = db.or_(condition, BlacklistToken.blacklisted_on >= recent)
+        return db.session.query(
+            BlacklistToken.id, BlacklistToken.token_hash
+        ).filter(condition).order_by(BlacklistToken.id).yield_per(1000)
+
+    @staticmethod
+    def purge_expired(batch_size=1000):
+        """
+        Deletes expired tokens in batches of batch_size,
+        committing after every batch so locks stay short
+        :param batch_size:
+        :return: dict of purge stats
+        """
+        started = datetime.datetime.utcnow()
+        purged = 0
+        batches = 0
+        while True:
+            ids = [id for id, in db.session.query(BlacklistToken.id).filter(
+                BlacklistToken.exp <= started
+            ).limit(batch_size)]
+            if not ids:
+                break
+            BlacklistToken.query.filter(
+                BlacklistToken.id.in_(ids)
+            ).delete(synchronize_session=False)
+            db.session.commit()
+            purged += len(ids)
+            batches += 1
+            metrics.BLACKLIST_PURGED.inc(len(ids))
+            metrics.BLACKLIST_PURGE_BATCHES.inc()
+        stats = {
+            'purged': purged,
+            'batches': batches,
+            'remaining': BlacklistToken.count(),
+            'seconds': (datetime.datetime.utcnow() - started).total_seconds(),
+        }
+        metrics.BLACKLIST_PURGE_SECONDS.observe(stats['seconds'])
+        metrics.BLACKLIST_TOKENS.set(stats['remaining'])
+        return stats
+
+blacklist_cache = BlacklistCache(BlacklistToken)
+
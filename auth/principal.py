@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app
+
+# the part of a user every authenticated request needs
+Principal = namedtuple('Principal', ['id', 'email', 'admin'])
+
+
+class LocalBackend:
+    """
+    In-memory stand-in for the redis client calls the cache uses
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def setex(self, key, ttl, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class PrincipalCache:
+    """
+    Short TTL cache of principals keyed by user id, backed by the local
+    backend or by redis when PRINCIPAL_CACHE_URL is set
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+
+    def _backend(self):
+        if self.backend is None:
+            config = current_app.config
+            url = config.get('PRINCIPAL_CACHE_URL')
+            if url:
+                import redis
+                self.backend = redis.Redis.from_url(url)
+            else:
+                self.backend = LocalBackend(config.get('PRINCIPAL_CACHE_SIZE'))
+        return self.backend
+
+    def key(self, user_id):
+        return 'principal:{}'.format(user_id)
+
+    def get(self, user_id, loader):
+        """
+        Returns the principal of user_id, calling loader(user_id) on a miss
+        :param user_id:
+        :param loader: returns a User or None
+        :return: Principal|None
+        """
+        backend = self._backend()
+        value = backend.get(self.key(user_id))
+        if value is not None:
+            self.hits += 1
+            return Principal(*json.loads(value))
+        self.misses += 1
+        user = loader(user_id)
+        if user is None:
+            return None
+        principal = Principal(user.id, user.email, user.admin)
+        backend.setex(
+            self.key(user_id),
+            current_app.config.get('PRINCIPAL_CACHE_TTL'),
+            json.dumps(principal)
+        )
+        return principal
+
+    def invalidate(self, user_id):
+        self._backend().delete(self.key(user_id))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+principal_cache = PrincipalCache()
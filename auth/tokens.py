@@ -0,0 +1,159 @@
+import datetime
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+
+import jwt
+from jwt.algorithms import HMACAlgorithm
+from flask import current_app
+
+import metrics
+
+ALGORITHM = 'HS256'
+# key of tokens signed before key ids were introduced
+LEGACY_KID = 'default'
+
+EXPIRED = 'Signature expired. Please log in again.'
+INVALID = 'Invalid token. Please log in again.'
+BLACKLISTED = 'Token blacklisted. Please log in again.'
+
+
+class TokenResult(namedtuple('TokenResult', ['user_id', 'exp', 'kid', 'jti', 'digest', 'error'])):
+    """
+    Outcome of a verification, error is None for valid tokens
+    """
+
+    @property
+    def valid(self):
+        return self.error is None
+
+    @staticmethod
+    def failed(error, digest=None):
+        return TokenResult(None, None, None, None, digest, error)
+
+
+def parse_keys(value):
+    # "kid=secret,kid=secret"
+    keys = {}
+    for item in (value or '').split(','):
+        kid, _, secret = item.strip().partition('=')
+        if kid and secret:
+            keys[kid] = secret
+    return keys
+
+
+class TokenService:
+    """
+    Signs and verifies auth tokens. HMAC keys are prepared once per
+    process and picked by the kid header, so several keys can be
+    accepted while only JWT_SIGNING_KID signs. Valid tokens are
+    remembered by digest until they expire, a hot client's token is
+    verified with one hash and one dictionary lookup. Blacklisting is
+    not part of verification, callers check it on every request.
+    """
+
+    def __init__(self):
+        self.keys = None
+        self.signing_kid = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.memo = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _setup(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self._load()
+
+    def _load(self):
+        config = current_app.config
+        secrets = parse_keys(config.get('JWT_KEYS'))
+        if config.get('SECRET_KEY'):
+            secrets.setdefault(LEGACY_KID, config.get('SECRET_KEY'))
+        algorithm = HMACAlgorithm(HMACAlgorithm.SHA256)
+        self.keys = {kid: algorithm.prepare_key(secret) for kid, secret in secrets.items()}
+        self.signing_kid = config.get('JWT_SIGNING_KID') or LEGACY_KID
+        self.memo.clear()
+        self.pid = os.getpid()
+
+    @staticmethod
+    def digest(auth_token):
+        return hashlib.sha256(str(auth_token).encode()).hexdigest()
+
+    def encode(self, user_id, lifetime):
+        """
+        :param user_id:
+        :param lifetime: seconds
+        :return: token string
+        """
+        self._setup()
+        now = datetime.datetime.utcnow()
+        payload = {
+            'exp': now + datetime.timedelta(seconds=lifetime),
+            'iat': now,
+            'sub': user_id,
+            'jti': uuid.uuid4().hex,
+        }
+        headers = None if self.signing_kid == LEGACY_KID else {'kid': self.signing_kid}
+        return jwt.encode(payload, self.keys[self.signing_kid], algorithm=ALGORITHM, headers=headers)
+
+    def verify(self, auth_token):
+        """
+        Checks signature and expiry of the token
+        :param auth_token:
+        :return: TokenResult
+        """
+        self._setup()
+        digest = self.digest(auth_token)
+        with self.lock:
+            result = self.memo.get(digest)
+            if result is not None:
+                self.memo.move_to_end(digest)
+        if result is not None:
+            if result.exp > time.time():
+                self.hits += 1
+                return result
+            with self.lock:
+                self.memo.pop(digest, None)
+            return TokenResult.failed(EXPIRED, digest)
+        self.misses += 1
+        with metrics.timed('jwt'):
+            result = self._decode(auth_token, digest)
+        if result.valid:
+            self._remember(digest, result)
+        return result
+
+    def _decode(self, auth_token, digest):
+        try:
+            kid = jwt.get_unverified_header(auth_token).get('kid', LEGACY_KID)
+            key = self.keys.get(kid)
+            if key is None:
+                return TokenResult.failed(INVALID, digest)
+            payload = jwt.decode(
+                auth_token, key, algorithms=[ALGORITHM], options={'require': ['exp', 'sub']}
+            )
+        except jwt.ExpiredSignatureError:
+            return TokenResult.failed(EXPIRED, digest)
+        except jwt.InvalidTokenError:
+            return TokenResult.failed(INVALID, digest)
+        return TokenResult(payload['sub'], payload['exp'], kid, payload.get('jti'), digest, None)
+
+    def _remember(self, digest, result):
+        size = current_app.config.get('TOKEN_CACHE_SIZE')
+        with self.lock:
+            self.memo[digest] = result
+            self.memo.move_to_end(digest)
+            while len(self.memo) > size:
+                self.memo.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.memo)}
+
+
+token_service = TokenService()
@@ -1,10 +1,14 @@
-from flask import Blueprint, request, make_response, jsonify
+from flask import Blueprint, request, make_response, jsonify, g
 from flask.views import MethodView
 
-import jwt
-
-from app import bcrypt, db
-from auth.models import User, BlacklistToken
+import conditional
+import database
+from app import db
+from auth.models import User, BlacklistToken, blacklist_cache
+from auth.decorators import login_required, current_user
+from auth.hashing import HashingBusy
+from auth.principal import principal_cache
+from auth.tokens import token_service
 
 auth_blueprint = Blueprint("auth", __name__)
 
@@ -35,6 +39,9 @@ class RegisterAPI(MethodView):
                     "auth_token": auth_token,
                 }
                 return make_response(jsonify(responseObject)), 201
+            except HashingBusy as e:
+                responseObject = {"status": "fail", "message": str(e)}
+                return make_response(jsonify(responseObject)), 429
             except Exception as e:
                 responseObject = {
                     "status": "fail",
@@ -60,9 +67,9 @@ class LoginAPI(MethodView):
         try:
             # fetch the user data
             user = User.query.filter_by(email=post_data.get("email")).first()
-            if user and bcrypt.check_password_hash(
-                user.password, post_data.get("password")
-            ):
+            if user and user.check_password(post_data.get("password")):
+                # persists a rehash made by check_password
+                db.session.commit()
                 auth_token = user.encode_auth_token(user.id)
                 if auth_token:
                     responseObject = {
@@ -74,6 +81,9 @@ class LoginAPI(MethodView):
             else:
                 responseObject = {"status": "fail", "message": "User does not exist."}
                 return make_response(jsonify(responseObject)), 404
+        except HashingBusy as e:
+            responseObject = {"status": "fail", "message": str(e)}
+            return make_response(jsonify(responseObject)), 429
         except Exception as e:
             print(e)
             responseObject = {"status": "fail", "message": "Try again"}
@@ -85,93 +95,37 @@ class UserAPI(MethodView):
     User Resource
     """
 
+    decorators = [login_required]
+
     def get(self):
-        # get the auth token
-        auth_header = request.headers.get("Authorization")
-        if auth_header:
-            try:
-                auth_token = auth_header
-            except IndexError:
-                responseObject = {
-                    "status": "fail",
-                    "message": "Bearer token malformed.",
-                }
-                return make_response(jsonify(responseObject)), 401
-        else:
-            auth_token = ""
-        if auth_token:
-            resp = User.decode_auth_token(auth_token)
-            if not isinstance(resp, str):
-                user = User.query.filter_by(id=resp).first()
-                if user:
-                    responseObject = {
-                        "status": "success",
-                        "data": {
-                            "user_id": user.id,
-                            "email": user.email,
-                            "admin": user.admin,
-                            "registered_on": user.registered_on,
-                        },
-                    }
-                    return make_response(jsonify(responseObject)), 200
-                else:
-                    responseObject = {
-                        "status": "fail",
-                        "message": "A user with this auth token does not exist.",
-                    }
-                    return make_response(jsonify(responseObject)), 401
-            responseObject = {"status": "fail", "message": resp}
-            return make_response(jsonify(responseObject)), 401
-        else:
-            responseObject = {
-                "status": "fail",
-                "message": "Provide a valid auth token.",
-            }
-            return make_response(jsonify(responseObject)), 401
+        user = current_user()
+        etag = conditional.make_etag("user", user.id, user.updated_on)
+        response = conditional.not_modified(etag, user.updated_on)
+        if response is not None:
+            return response
+        responseObject = {
+            "status": "success",
+            "data": {
+                "user_id": user.id,
+                "email": user.email,
+                "admin": user.admin,
+                "registered_on": user.registered_on,
+            },
+        }
+        response = make_response(jsonify(responseObject))
+        return conditional.add_validators(response, etag, user.updated_on), 200
 
     def put(self):
-        # get the auth token
-        auth_header = request.headers.get("Authorization")
-        if auth_header:
-            try:
-                auth_token = auth_header
-            except IndexError:
-                responseObject = {
-                    "status": "fail",
-                    "message": "Bearer token malformed.",
-                }
-                return make_response(jsonify(responseObject)), 401
-        else:
-            auth_token = ""
         # get the post data
         post_data = request.get_json()
-        if auth_token:
-            resp = User.decode_auth_token(auth_token)
-            if not isinstance(resp, str):
-                user = User.query.filter_by(id=resp).first()
-                if user:
-                    try:
-                        resp = user.update(post_data)
-                        responseObject = {"status": "success", "message": resp}
-                        return make_response(jsonify(responseObject)), 200
-                    except Exception as e:
-                        print(e)
-                        responseObject = {"status": "success", "message": "Try again"}
-                        return make_response(jsonify(responseObject)), 500
-                else:
-                    responseObject = {
-                        "status": "fail",
-                        "message": "A user with this auth token does not exist.",
-                    }
-                    return make_response(jsonify(responseObject)), 401
-            responseObject = {"status": "fail", "message": resp}
-            return make_response(jsonify(responseObject)), 401
-        else:
-            responseObject = {
-                "status": "fail",
-                "message": "Provide a valid auth token.",
-            }
-            return make_response(jsonify(responseObject)), 401
+        try:
+            resp = current_user().update(post_data)
+            responseObject = {"status": "success", "message": resp}
+            return make_response(jsonify(responseObject)), 200
+        except Exception as e:
+            print(e)
+            responseObject = {"status": "success", "message": "Try again"}
+            return make_response(jsonify(responseObject)), 500
 
 
 class LogoutAPI(MethodView):
@@ -179,39 +133,46 @@ class LogoutAPI(MethodView):
     Logout Resource
     """
 
+    decorators = [login_required]
+
     def post(self):
-        # get auth token
-        auth_header = request.headers.get("Authorization")
-        if auth_header:
-            auth_token = auth_header
-        else:
-            auth_token = ""
-        if auth_token:
-            resp = User.decode_auth_token(auth_token)
-            if not isinstance(resp, str):
-                # mark the token as blacklisted
-                blacklist_token = BlacklistToken(token=auth_token)
-                try:
-                    # insert the token
-                    db.session.add(blacklist_token)
-                    db.session.commit()
-                    responseObject = {
-                        "status": "success",
-                        "message": "Successfully logged out.",
-                    }
-                    return make_response(jsonify(responseObject)), 200
-                except Exception as e:
-                    responseObject = {"status": "fail", "message": e}
-                    return make_response(jsonify(responseObject)), 200
-            else:
-                responseObject = {"status": "fail", "message": resp}
-                return make_response(jsonify(responseObject)), 401
-        else:
+        # mark the token as blacklisted
+        blacklist_token = BlacklistToken(token=g.auth_token)
+        try:
+            # insert the token
+            db.session.add(blacklist_token)
+            db.session.commit()
+            blacklist_cache.add(blacklist_token.token_hash)
             responseObject = {
-                "status": "fail",
-                "message": "Provide a valid auth token.",
+                "status": "success",
+                "message": "Successfully logged out.",
             }
-            return make_response(jsonify(responseObject)), 403
+            return make_response(jsonify(responseObject)), 200
+        except Exception as e:
+            responseObject = {"status": "fail", "message": e}
+            return make_response(jsonify(responseObject)), 200
+
+
+class CacheStatsAPI(MethodView):
+    """
+    Cache Stats Resource
+    """
+
+    decorators = [login_required]
+
+    def get(self):
+        if not g.principal.admin:
+            responseObject = {"status": "fail", "message": "Authorization failed."}
+            return make_response(jsonify(responseObject)), 401
+        responseObject = {
+            "status": "success",
+            "data": {
+                "principal": principal_cache.stats(),
+                "tokens": token_service.stats(),
+                "pool": database.pool_stats(db.engine),
+            },
+        }
+        return make_response(jsonify(responseObject)), 200
 
 
 # define the API resources
@@ -219,6 +180,7 @@ registration_view = RegisterAPI.as_view("register_api")
 login_view = LoginAPI.as_view("login_api")
 user_view = UserAPI.as_view("user_api")
 logout_view = LogoutAPI.as_view("logout_api")
+cache_stats_view = CacheStatsAPI.as_view("cache_stats_api")
 
 # add Rules for API Endpoints
 auth_blueprint.add_url_rule(
@@ -229,3 +191,6 @@ auth_blueprint.add_url_rule(
     "/api/auth/profile", view_func=user_view, methods=["GET", "PUT"]
 )
 auth_blueprint.add_url_rule("/api/auth/logout", view_func=logout_view, methods=["POST"])
+auth_blueprint.add_url_rule(
+    "/api/auth/cache-stats", view_func=cache_stats_view, methods=["GET"]
+)
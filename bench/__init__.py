@@ -0,0 +1,3 @@
+"""
+Benchmarks, run the modules with python -m bench.<name>
+"""
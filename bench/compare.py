@@ -0,0 +1,70 @@
+"""
+Compares two result files of bench.micro or bench.load and exits with
+status 1 when a benchmark got slower than the threshold allows.
+
+    python -m bench.compare baseline.json current.json --threshold 0.1
+"""
+import argparse
+import json
+
+# lower is better for latencies, higher for throughput
+METRICS = (('p50', 1), ('p95', 1), ('p99', 1), ('throughput', -1))
+
+
+def change(old, new):
+    if old in (None, 0) or new is None:
+        return None
+    return (new - old) / old
+
+
+def compare(baseline, current, threshold):
+    """
+    :return: (rows of (name, metric, old, new, change, regressed), regressions)
+    """
+    rows = []
+    regressions = 0
+    for name, stats in current['results'].items():
+        old_stats = baseline['results'].get(name)
+        if old_stats is None:
+            continue
+        for metric, direction in METRICS:
+            old, new = old_stats.get(metric), stats.get(metric)
+            delta = change(old, new)
+            regressed = delta is not None and delta * direction > threshold
+            regressions += regressed
+            rows.append((name, metric, old, new, delta, regressed))
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Allowed relative change before a metric counts as a regression.')
+    args = parser.parse_args()
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline.get('kind') != current.get('kind'):
+        raise SystemExit('Cannot compare {} results with {} results.'.format(
+            baseline.get('kind'), current.get('kind')
+        ))
+
+    rows, regressions = compare(baseline, current, args.threshold)
+    print('baseline {}, current {}'.format(
+        baseline['environment'].get('commit'), current['environment'].get('commit')
+    ))
+    for name, metric, old, new, delta, regressed in rows:
+        print('{:<28} {:<10} {:>12} {:>12} {:>9} {}'.format(
+            name, metric, old, new,
+            '-' if delta is None else '{:+.1%}'.format(delta),
+            'REGRESSION' if regressed else ''
+        ))
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
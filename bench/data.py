@@ -0,0 +1,116 @@
+"""
+Seeded synthetic users, diaries and blacklisted tokens. The same seed
+always gives the same rows, so runs on different commits compare.
+"""
+import datetime
+import hashlib
+import random
+
+from extensions import db
+from auth.models import User, BlacklistToken
+from diary.models import Diary
+from diary import lexicon, processing
+
+PASSWORD = 'bench-password'
+BATCH_SIZE = 10000
+# every timestamp is relative to this, never to the clock
+EPOCH = datetime.datetime(2023, 1, 1)
+# expiry of the blacklisted tokens, far enough for them to stay valid
+TOKENS_EXPIRE = datetime.datetime(2100, 1, 1)
+
+FILLER = (
+    'today', 'work', 'home', 'friends', 'walk', 'coffee', 'morning', 'evening',
+    'family', 'dinner', 'weather', 'train', 'book', 'music', 'city', 'garden',
+)
+# lexicon words mixed into filler, so every analysis path is taken
+VOCABULARY = sorted(lexicon.VALENCES) + sorted(lexicon.NEGATIONS) + list(FILLER) * 8
+
+
+def email(i):
+    return 'user{}@bench.local'.format(i)
+
+
+def users(count, password_hash, seed=0):
+    """
+    :param count:
+    :param password_hash: stored hash of PASSWORD, hashed once by the caller
+    :param seed:
+    :return: iterator of users rows, inserted into an empty table they
+        get ids 1..count, user 1 is an admin
+    """
+    rng = random.Random(seed)
+    start = datetime.datetime(2022, 1, 1)
+    for i in range(1, count + 1):
+        registered_on = start + datetime.timedelta(seconds=rng.randint(0, 365 * 86400))
+        yield {
+            'email': email(i),
+            'password': password_hash,
+            'registered_on': registered_on,
+            'updated_on': registered_on,
+            'admin': i == 1,
+        }
+
+
+def text(rng, words=(5, 60)):
+    return ' '.join(rng.choice(VOCABULARY) for _ in range(rng.randint(*words))) + '.'
+
+
+def diaries(count, users, seed=0, words=(5, 60), processed=True):
+    """
+    :param count:
+    :param users: diaries are spread over user ids 1..users
+    :param seed:
+    :param words: (min, max) words per body
+    :param processed: store results, otherwise every diary is in progress
+    :return: iterator of diaries rows
+    """
+    rng = random.Random(seed)
+    engine = processing.get_engine()
+    for _ in range(count):
+        body = text(rng, words)
+        created_on = EPOCH + datetime.timedelta(seconds=rng.randint(0, 365 * 86400))
+        preview, length = Diary.summarize(body)
+        yield {
+            'text': body,
+            'preview': preview,
+            'text_length': length,
+            'user_id': rng.randint(1, users),
+            'in_progress': not processed,
+            'result': processing.dumps(engine.analyze(body)) if processed else None,
+            'created_on': created_on,
+            'updated_on': created_on,
+        }
+
+
+def tokens(count, seed=0):
+    # digests of tokens that were never issued, none of them expired
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield {
+            'token_hash': hashlib.sha256(rng.randbytes(32)).hexdigest(),
+            'blacklisted_on': EPOCH + datetime.timedelta(seconds=rng.randint(0, 365 * 86400)),
+            'exp': TOKENS_EXPIRE,
+        }
+
+
+def insert(table, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+
+
+def seed(user_count, diary_count, token_count, password_hash, seed=0):
+    """
+    Fills the empty tables of the current app
+    :return: row counts
+    """
+    insert(User.__table__, users(user_count, password_hash, seed))
+    insert(Diary.__table__, diaries(diary_count, user_count, seed))
+    insert(BlacklistToken.__table__, tokens(token_count, seed))
+    db.session.commit()
+    return {'users': user_count, 'diaries': diary_count, 'tokens': token_count}
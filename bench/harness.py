@@ -0,0 +1,136 @@
+"""
+Timing, statistics and result files shared by the benchmarks
+"""
+import json
+import math
+import os
+import platform
+import subprocess
+import time
+
+
+def percentile(ordered, q):
+    # nearest rank on an already sorted list
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(q / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(samples, elapsed=None, errors=0):
+    """
+    :param samples: durations in seconds
+    :param elapsed: wall time of the run, for throughput
+    :param errors:
+    :return: dict in milliseconds
+    """
+    ordered = sorted(samples)
+    ms = lambda value: None if value is None else round(value * 1000, 4)
+    stats = {
+        'count': len(ordered),
+        'errors': errors,
+        'min': ms(ordered[0] if ordered else None),
+        'mean': ms(sum(ordered) / len(ordered) if ordered else None),
+        'p50': ms(percentile(ordered, 50)),
+        'p95': ms(percentile(ordered, 95)),
+        'p99': ms(percentile(ordered, 99)),
+        'max': ms(ordered[-1] if ordered else None),
+    }
+    if elapsed is None:
+        elapsed = sum(ordered)
+    stats['throughput'] = round(len(ordered) / elapsed, 2) if elapsed else None
+    return stats
+
+
+def benchmark(fn, rounds=1000, warmup=10, min_time=0.0):
+    """
+    Calls fn() rounds times after warmup calls, in the manner of
+    pytest-benchmark, and runs on until min_time seconds have passed
+    :return: summarize() of the calls
+    """
+    for _ in range(warmup):
+        fn()
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < rounds or time.perf_counter() - started < min_time:
+        before = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - before)
+    return summarize(samples)
+
+
+def environment():
+    # enough to tell whether two result files are comparable
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def write_results(path, kind, params, results):
+    """
+    Writes {kind, params, environment, results} where results maps a
+    benchmark name to its summarize() dict
+    """
+    document = {
+        'kind': kind,
+        'params': params,
+        'environment': environment(),
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def print_table(results):
+    print('{:<28} {:>8} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+        'name', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'ops/s'
+    ))
+    for name, stats in results.items():
+        print('{:<28} {:>8} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+            name, stats['count'], *(
+                '-' if stats[key] is None else '{:.3f}'.format(stats[key])
+                for key in ('p50', 'p95', 'p99', 'max')
+            ), '-' if stats['throughput'] is None else '{:.1f}'.format(stats['throughput'])
+        ))
+
+
+def configure(url, rounds=None):
+    """
+    Points the application at a scratch database, call before anything
+    imports app or config
+    :param url: database url, its tables are dropped and created
+    :param rounds: bcrypt rounds of the seeded users and new hashes
+    """
+    os.environ['DATABASE_URL'] = url
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    if rounds is not None:
+        os.environ['BCRYPT_LOG_ROUNDS'] = str(rounds)
+
+
+def prepare(users, diaries, tokens, seed=0):
+    """
+    Recreates the schema of the configured database and seeds it
+    :return: the Flask app
+    """
+    from app import app
+    from extensions import db
+    from auth.hashing import password_hasher
+    from bench import data
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        data.seed(users, diaries, tokens, password_hasher.hash(data.PASSWORD), seed)
+    return app
@@ -0,0 +1,189 @@
+"""
+Load driver: concurrent requests against the application through the
+Flask test client, with p50/p95/p99 latency and throughput per endpoint.
+
+    python -m bench.load --requests 500 --concurrency 4 --out load.json
+
+Tasks go to an in-memory Celery broker, as in production the web
+process only publishes them. The processing path is timed on its own
+by calling pprocess_diaries directly.
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from bench import harness
+
+
+class Scenario:
+    """
+    One endpoint, request(client, rng) returns the response
+    """
+
+    def __init__(self, name, request):
+        self.name = name
+        self.request = request
+
+
+def scenarios(app, users):
+    from extensions import db
+    from auth.models import User
+    from diary.models import Diary
+    from bench import data
+
+    with app.app_context():
+        tokens = {}
+        owned = {}
+        for user in User.query.filter(User.id <= users).all():
+            tokens[user.id] = user.encode_auth_token(user.id)
+            owned[user.id] = [
+                id for id, in db.session.query(Diary.id).filter(Diary.user_id == user.id).limit(100)
+            ] or [None]
+    ids = sorted(tokens)
+
+    def auth(rng):
+        user_id = rng.choice(ids)
+        return user_id, {'Authorization': tokens[user_id]}
+
+    def login(client, rng):
+        return client.post('/api/auth/login', json={
+            'email': data.email(rng.choice(ids)), 'password': data.PASSWORD
+        })
+
+    def profile(client, rng):
+        return client.get('/api/auth/profile', headers=auth(rng)[1])
+
+    def diaries(client, rng):
+        return client.get('/api/diary?limit=50', headers=auth(rng)[1])
+
+    def diary(client, rng):
+        user_id, headers = auth(rng)
+        return client.get('/api/diary/{}'.format(rng.choice(owned[user_id])), headers=headers)
+
+    def create(client, rng):
+        return client.post('/api/diary', headers=auth(rng)[1], json={
+            'text': data.text(rng)
+        })
+
+    def stats(client, rng):
+        return client.get('/api/stats', headers=auth(rng)[1])
+
+    return [
+        Scenario('login', login),
+        Scenario('profile', profile),
+        Scenario('diaries', diaries),
+        Scenario('diary', diary),
+        Scenario('create', create),
+        Scenario('stats', stats),
+    ]
+
+
+def run(app, scenario, requests, concurrency, seed, warmup=10):
+    """
+    Sends requests requests from concurrency threads, after warmup
+    untimed ones that fill the caches
+    :return: summarize() of the request latencies
+    """
+    client = app.test_client()
+    rng = random.Random(seed)
+    for _ in range(warmup):
+        scenario.request(client, rng)
+    samples = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker(index):
+        client = app.test_client()
+        rng = random.Random(seed * 1000 + index)
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            before = time.perf_counter()
+            response = scenario.request(client, rng)
+            elapsed = time.perf_counter() - before
+            with lock:
+                samples.append(elapsed)
+                if response.status_code >= 400:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return harness.summarize(samples, time.perf_counter() - started, errors[0])
+
+
+def run_processing(app, batches, batch_size, seed):
+    """
+    Times pprocess_diaries on freshly inserted in-progress diaries
+    :return: summarize() of the batches
+    """
+    from extensions import db
+    from diary.models import Diary
+    from bench import data
+    import tasks
+
+    with app.app_context():
+        last = db.session.query(db.func.coalesce(db.func.max(Diary.id), 0)).scalar()
+        data.insert(Diary.__table__, data.diaries(batches * batch_size, 10, seed, processed=False))
+        db.session.commit()
+        ids = [id for id, in db.session.query(Diary.id).filter(Diary.id > last).order_by(Diary.id)]
+    samples = []
+    for start in range(0, len(ids), batch_size):
+        before = time.perf_counter()
+        tasks.pprocess_diaries(ids[start:start + batch_size])
+        samples.append(time.perf_counter() - before)
+    stats = harness.summarize(samples)
+    stats['diaries_per_second'] = round(batches * batch_size / sum(samples), 2) if samples else None
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default='sqlite:///' + os.path.join(tempfile.gettempdir(), 'u-time-bench.db'),
+                        help='Scratch database, its tables are dropped and created.')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--diaries', type=int, default=20000)
+    parser.add_argument('--tokens', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=500, help='Requests per endpoint.')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=10, help='Untimed requests per endpoint.')
+    parser.add_argument('--bcrypt-rounds', type=int, default=12)
+    parser.add_argument('--batches', type=int, default=20, help='pprocess_diaries calls.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', help='Run the endpoints whose name contains this.')
+    parser.add_argument('--out', help='Write the results as JSON to this file.')
+    args = parser.parse_args()
+
+    harness.configure(args.url, rounds=args.bcrypt_rounds)
+    app = harness.prepare(args.users, args.diaries, args.tokens, args.seed)
+    import tasks
+    tasks.celery.conf.broker_url = 'memory://'
+
+    results = {}
+    for scenario in scenarios(app, args.users):
+        if args.only and args.only not in scenario.name:
+            continue
+        results[scenario.name] = run(
+            app, scenario, args.requests, args.concurrency, args.seed, args.warmup
+        )
+    for batch_size in (1, 100):
+        name = 'pprocess_diaries[{}]'.format(batch_size)
+        if args.only and args.only not in name:
+            continue
+        results[name] = run_processing(app, args.batches, batch_size, args.seed)
+    harness.print_table(results)
+    if args.out:
+        harness.write_results(args.out, 'load', vars(args), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Micro-benchmarks of the per-request hot paths: token decoding, the
+blacklist check, diary serialization and text processing.
+
+    python -m bench.micro --tokens 100000 --out micro.json
+"""
+import argparse
+import random
+
+from bench import harness
+
+
+def cases(app):
+    from extensions import db
+    from auth.models import User, BlacklistToken, blacklist_cache
+    from auth.tokens import token_service
+    from diary.models import Diary
+    from bench import data
+    import tasks
+
+    user = db.session.get(User, 2)
+    token = user.encode_auth_token(user.id)
+    # a token that really is blacklisted, for the hit path
+    revoked = user.encode_auth_token(user.id + 1)
+    db.session.add(BlacklistToken(revoked))
+    db.session.commit()
+    blacklist_cache.warm()
+
+    diary = Diary.query.first()
+    # load the deferred body outside the timings
+    diary.text
+    rows = Diary.query.with_entities(*Diary.json_columns()).limit(50).all()
+    rng = random.Random(0)
+    short = data.text(rng, (50, 50))
+    long = data.text(rng, (5000, 5000))
+
+    def decode_uncached():
+        # signature and expiry checked again, as for a token seen the first time
+        token_service.memo.clear()
+        return User.decode_auth_token(token)
+
+    return {
+        'decode_auth_token cached': lambda: User.decode_auth_token(token),
+        'decode_auth_token uncached': decode_uncached,
+        'check_blacklist miss': lambda: BlacklistToken.check_blacklist(token),
+        'check_blacklist hit': lambda: BlacklistToken.check_blacklist(revoked),
+        'myjson': lambda: app.json.dumps(diary.myjson()),
+        'row_json page of 50': lambda: app.json.dumps(
+            {'status': 'success', 'data': [Diary.row_json(row) for row in rows]}
+        ),
+        'text_processor 50 words': lambda: tasks.text_processor(short),
+        'text_processor 5000 words': lambda: tasks.text_processor(long),
+        'text_processor chunked': lambda: tasks.text_processor(
+            long[start:start + 4096] for start in range(0, len(long), 4096)
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default='sqlite://',
+                        help='Scratch database, its tables are dropped and created.')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--diaries', type=int, default=1000)
+    parser.add_argument('--tokens', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', help='Run the benchmarks whose name contains this.')
+    parser.add_argument('--out', help='Write the results as JSON to this file.')
+    args = parser.parse_args()
+
+    harness.configure(args.url, rounds=4)
+    app = harness.prepare(args.users, args.diaries, args.tokens, args.seed)
+    results = {}
+    with app.app_context():
+        for name, fn in cases(app).items():
+            if args.only and args.only not in name:
+                continue
+            rounds = args.rounds if 'text_processor' not in name else max(1, args.rounds // 10)
+            results[name] = harness.benchmark(fn, rounds=rounds)
+    harness.print_table(results)
+    if args.out:
+        harness.write_results(args.out, 'micro', vars(args), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Listing serialization: ORM objects through Flask's default provider
+against column rows through FastJSONProvider.
+
+    python -m bench.serialization --rows 10000
+"""
+import argparse
+import time
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from extensions import db
+from json_provider import FastJSONProvider
+from diary.models import Diary
+from bench import data
+
+
+def setup(rows):
+    app = Flask('bench')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        data.insert(Diary.__table__, data.diaries(rows, 100))
+        db.session.commit()
+    return app
+
+
+def orm_default(app):
+    app.json = DefaultJSONProvider(app)
+    # bodies were loaded with the row before they were deferred
+    diaries = Diary.query.options(db.undefer(Diary.text)).all()
+    return app.json.response({'status': 'success', 'data': [diary.myjson() for diary in diaries]})
+
+
+def rows_fast(app):
+    app.json = FastJSONProvider(app)
+    diaries = Diary.query.with_entities(*Diary.json_columns()).all()
+    return app.json.response({'status': 'success', 'data': [Diary.row_json(diary) for diary in diaries]})
+
+
+def measure(app, fn, repeat):
+    best = None
+    with app.test_request_context():
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn(app)
+            elapsed = time.perf_counter() - started
+            db.session.remove()
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    app = setup(args.rows)
+    baseline = measure(app, orm_default, args.repeat)
+    fast = measure(app, rows_fast, args.repeat)
+    print('rows:                  {}'.format(args.rows))
+    print('orm + default json:    {:.1f} ms'.format(baseline * 1000))
+    print('rows + fast json:      {:.1f} ms'.format(fast * 1000))
+    print('speedup:               {:.1f}x'.format(baseline / fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import os
+import sys
+import time
+
+import click
+import sqlalchemy
+
+import migrations
+import tasks
+from app import app, db
+from config import Config
+from auth.models import BlacklistToken
+from diary import explain, export, scheduler
+from diary.models import Diary, UserStats
+
+
+@app.cli.command('purge-blacklist')
+@click.option('--batch-size', default=Config.BLACKLIST_PURGE_BATCH_SIZE, show_default=True)
+def purge_blacklist(batch_size):
+    """Delete blacklisted tokens that have expired."""
+    stats = BlacklistToken.purge_expired(batch_size)
+    click.echo(
+        'Purged {purged} expired tokens in {batches} batches, '
+        '{remaining} remaining ({seconds:.2f}s)'.format(**stats)
+    )
+
+
+@app.cli.command('init-db')
+def init_db():
+    """Create the schema, or bring an existing one up to date."""
+    with db.engine.connect() as conn:
+        revision = migrations.current(conn)
+    if revision is None:
+        # empty database, no need to replay every revision
+        db.create_all()
+        migrations.stamp(db.engine)
+        click.echo('Created schema at revision {}'.format(migrations.head()))
+        return
+    applied = migrations.upgrade(db.engine)
+    if applied:
+        click.echo('Applied revisions {}'.format(', '.join(applied)))
+    else:
+        click.echo('Database is up to date.')
+
+
+@app.cli.command('db-upgrade')
+def db_upgrade():
+    """Apply pending schema migrations."""
+    applied = migrations.upgrade(db.engine)
+    if applied:
+        click.echo('Applied revisions {}'.format(', '.join(applied)))
+    else:
+        click.echo('Database is up to date.')
+
+
+@app.cli.command('relay-outbox')
+@click.option('--once', is_flag=True, help='Drain the outbox once and exit.')
+def relay_outbox(once):
+    """Send pending diary_outbox rows to the processing queue."""
+    while True:
+        sent = tasks.prelay_outbox()
+        if sent:
+            click.echo('Relayed {} diaries'.format(sent))
+        if once:
+            break
+        time.sleep(Config.RELAY_INTERVAL)
+
+
+@app.cli.command('worker')
+@click.option('--queue', type=click.Choice(list(scheduler.QUEUES)), default=scheduler.INTERACTIVE,
+              show_default=True)
+@click.option('--concurrency', type=int, help='Defaults to WORKER_<QUEUE>_CONCURRENCY.')
+def run_worker(queue, concurrency):
+    """Run a Celery worker for one diary queue."""
+    if concurrency is None:
+        concurrency = app.config.get('WORKER_{}_CONCURRENCY'.format(queue.upper()))
+    queues = [scheduler.QUEUES[queue]]
+    argv = ['worker', '--concurrency', str(concurrency), '--hostname', queue + '@%h']
+    if queue == scheduler.INTERACTIVE:
+        # the periodic tasks are short, they share the interactive workers
+        queues.append(tasks.celery.conf.task_default_queue)
+    else:
+        # reserving tasks ahead would only hide them from idle workers
+        argv += ['--prefetch-multiplier', '1']
+    tasks.celery.worker_main(argv + ['--queues', ','.join(queues)])
+
+
+@app.cli.command('sweep-diaries')
+@click.option('--timeout', default=Config.STUCK_DIARY_TIMEOUT, show_default=True)
+def sweep_diaries(timeout):
+    """Requeue diaries stuck in progress."""
+    requeued = Diary.requeue_stuck(timeout)
+    click.echo('Requeued {} stuck diaries'.format(requeued))
+
+
+@app.cli.command('rebuild-stats')
+@click.option('--chunk-size', default=1000, show_default=True, help='Users per chunk.')
+def rebuild_stats(chunk_size):
+    """Recompute user_stats from scratch."""
+    rebuilt = UserStats.rebuild(chunk_size)
+    click.echo('Rebuilt stats of {} users'.format(rebuilt))
+
+
+@app.cli.command('export-diaries')
+@click.option('--format', 'format', type=click.Choice(export.FORMATS), default='csv', show_default=True)
+@click.option('--out', type=click.Path(dir_okay=False), help='Output file, stdout when omitted.')
+@click.option('--user-id', type=int, help='Only the diaries of this user.')
+@click.option('--from', 'start', type=click.DateTime(['%Y-%m-%d']), help='First day of creation.')
+@click.option('--to', 'end', type=click.DateTime(['%Y-%m-%d']), help='Last day of creation.')
+@click.option('--since', help='Watermark of a previous export, only newer changes are exported.')
+@click.option('--watermark-file', type=click.Path(dir_okay=False),
+              help='Read --since from this file and store the new watermark in it.')
+@click.option('--no-text', is_flag=True, help='Export previews instead of bodies.')
+@click.option('--batch-size', default=Config.EXPORT_BATCH_SIZE, show_default=True)
+def export_diaries(format, out, user_id, start, end, since, watermark_file, no_text, batch_size):
+    """Export diaries as csv, parquet or arrow."""
+    if not export.available(format):
+        raise click.ClickException('The {} format needs pyarrow.'.format(format))
+    if since is None and watermark_file and os.path.exists(watermark_file):
+        with open(watermark_file) as f:
+            since = f.read().strip()
+    try:
+        since = export.parse_watermark(since)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--since')
+    upto = export.watermark(Config.EXPORT_WATERMARK_LAG, since)
+    rows = export.query(
+        upto, user_id, start and start.date(), end and end.date(), since, not no_text, batch_size
+    )
+    chunks = export.chunks(format, rows, export.column_names(not no_text), batch_size)
+    if out:
+        # only replace a previous export once this one is complete
+        mode = {'mode': 'w', 'newline': ''} if format == 'csv' else {'mode': 'wb'}
+        with open(out + '.part', **mode) as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(out + '.part', out)
+    else:
+        stream = sys.stdout if format == 'csv' else sys.stdout.buffer
+        for chunk in chunks:
+            stream.write(chunk)
+        stream.flush()
+    if watermark_file:
+        with open(watermark_file, 'w') as f:
+            f.write(upto.isoformat() + '\n')
+    click.echo('Exported up to {}'.format(upto.isoformat()), err=True)
+
+
+@app.cli.command('explain-queries')
+@click.option('--url', default='sqlite://', show_default=True,
+              help='Scratch database, its tables are created and dropped.')
+@click.option('--rows', default=100000, show_default=True)
+@click.option('--users', default=1000, show_default=True)
+def explain_queries(url, rows, users):
+    """Check that the diaries queries use index scans."""
+    try:
+        results = explain.check(sqlalchemy.create_engine(url), rows, users)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for name, plan, ok in results:
+        click.echo('{} {}'.format('ok  ' if ok else 'FAIL', name))
+        for line in plan:
+            click.echo('       ' + line)
+    if not all(ok for _, _, ok in results):
+        raise SystemExit(1)
@@ -0,0 +1,41 @@
+import datetime
+import hashlib
+
+from flask import request, make_response
+
+
+def make_etag(*parts):
+    # strong validator of a representation built from parts
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def not_modified(etag, last_modified=None):
+    """
+    Answers a conditional GET before any body is built
+    :param etag:
+    :param last_modified: naive utc datetime
+    :return: 304 response when the client copy is current, else None
+    """
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified is not None:
+        fresh = utc(last_modified).replace(microsecond=0) <= request.if_modified_since
+    else:
+        fresh = False
+    if not fresh:
+        return None
+    return add_validators(make_response('', 304), etag, last_modified)
+
+
+def add_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = utc(last_modified)
+    # clients may keep the body but must revalidate every time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def utc(value):
+    return value.replace(tzinfo=datetime.timezone.utc)
@@ -0,0 +1,125 @@
+import codecs
+import zlib
+
+from flask import current_app, has_app_context
+from sqlalchemy import types
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# first byte of every stored body
+PLAIN = b'p'
+ZLIB = b'z'
+ZSTD = b's'
+
+CHUNK_SIZE = 64 * 1024
+
+
+def compress(text, method=None, threshold=0):
+    """
+    Encodes a body for storage, bodies shorter than threshold bytes
+    are stored plain since compressing them rarely pays off
+    :param text:
+    :param method: None, 'zlib' or 'zstd'
+    :param threshold:
+    :return: bytes
+    """
+    raw = text.encode('utf-8')
+    if not method or len(raw) < threshold:
+        return PLAIN + raw
+    if method == 'zlib':
+        return ZLIB + zlib.compress(raw)
+    if method == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstandard is not installed.')
+        return ZSTD + zstandard.ZstdCompressor().compress(raw)
+    raise ValueError('Unknown compression {}.'.format(method))
+
+
+def iter_text(value, chunk_size=CHUNK_SIZE):
+    """
+    Decodes a stored body chunk_size bytes at a time
+    :param value: bytes from compress, or str left by older rows
+    :return: iterator of str
+    """
+    if value is None:
+        return
+    if isinstance(value, str):
+        for start in range(0, len(value), chunk_size):
+            yield value[start:start + chunk_size]
+        return
+    value = bytes(value)
+    kind, data = value[:1], memoryview(value)[1:]
+    if kind == PLAIN:
+        pieces = (data[start:start + chunk_size] for start in range(0, len(data), chunk_size))
+    elif kind == ZLIB:
+        pieces = _zlib_pieces(data, chunk_size)
+    elif kind == ZSTD:
+        if zstandard is None:
+            raise RuntimeError('zstandard is not installed.')
+        pieces = zstandard.ZstdDecompressor().read_to_iter(data, write_size=chunk_size)
+    else:
+        raise ValueError('Unknown stored body.')
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for piece in pieces:
+        text = decoder.decode(piece)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+
+def _zlib_pieces(data, chunk_size):
+    decompressor = zlib.decompressobj()
+    while data:
+        yield decompressor.decompress(data, chunk_size)
+        data = decompressor.unconsumed_tail
+    yield decompressor.flush()
+
+
+def decompress(value):
+    if value is None:
+        return None
+    return ''.join(iter_text(value))
+
+
+class CompressedText(types.TypeDecorator):
+    """
+    Unicode text stored as bytes, compressed with DIARY_TEXT_COMPRESSION
+    when the body is at least DIARY_TEXT_COMPRESSION_MIN bytes long
+    """
+
+    impl = types.LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not has_app_context():
+            return compress(value)
+        config = current_app.config
+        return compress(
+            value,
+            config.get('DIARY_TEXT_COMPRESSION'),
+            config.get('DIARY_TEXT_COMPRESSION_MIN')
+        )
+
+    def result_processor(self, dialect, coltype):
+        # decode the driver value directly, older sqlite rows are still text
+        return decompress
+
+
+class StoredBody(types.TypeDecorator):
+    """
+    The stored bytes of a CompressedText column as the driver returns
+    them, for reading bodies with iter_text
+    """
+
+    impl = types.LargeBinary
+    cache_ok = True
+
+    def result_processor(self, dialect, coltype):
+        return None
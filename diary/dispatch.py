@@ -0,0 +1,102 @@
+import atexit
+import os
+import threading
+import time
+
+from app import app
+from diary.models import DiaryOutbox
+from tasks import publish_diaries, run_eager
+
+
+class BatchDispatcher:
+    """
+    Collects new diary ids in process and publishes them to the batch
+    task every max_batch ids or max_delay seconds, whichever comes first.
+    Their outbox rows were committed with the diaries, so batches the
+    broker refuses are left for the relay.
+    """
+
+    def __init__(self, send, max_batch, max_delay):
+        # send(ids) publishes one batch
+        self.send = send
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.cond = threading.Condition()
+        self.ids = []
+        self.first_at = None
+        self.thread = None
+        self.pid = None
+
+    def submit(self, id):
+        self.submit_many([id])
+
+    def submit_many(self, ids):
+        if not ids:
+            return
+        if self.max_delay <= 0:
+            for start in range(0, len(ids), self.max_batch):
+                self._publish(ids[start:start + self.max_batch])
+            return
+        with self.cond:
+            self._ensure_thread()
+            if not self.ids:
+                self.first_at = time.monotonic()
+            empty = not self.ids
+            self.ids.extend(ids)
+            if empty or len(self.ids) >= self.max_batch:
+                self.cond.notify()
+
+    def flush(self):
+        # publish everything collected so far from the calling thread
+        with self.cond:
+            batch, self.ids = self.ids, []
+        for start in range(0, len(batch), self.max_batch):
+            self._publish(batch[start:start + self.max_batch])
+
+    def _ensure_thread(self):
+        # threads do not survive a fork, start one per worker process
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.ids = []
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.ids:
+                    self.cond.wait()
+                deadline = self.first_at + self.max_delay
+                while len(self.ids) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = self.ids[:self.max_batch]
+                self.ids = self.ids[self.max_batch:]
+                self.first_at = time.monotonic()
+            self._publish(batch)
+
+    def _publish(self, batch):
+        try:
+            self.send(batch)
+        except Exception:
+            # the outbox rows stay, the relay sends them later
+            app.logger.warning(
+                'Could not dispatch %d diaries', len(batch), exc_info=True
+            )
+
+
+def send(ids):
+    # relay exactly these ids, rows already taken by the relay are skipped
+    with app.app_context():
+        DiaryOutbox.relay(publish_diaries, len(ids), diary_ids=ids)
+        run_eager()
+
+
+dispatcher = BatchDispatcher(
+    send,
+    app.config.get('DISPATCH_BATCH_SIZE'),
+    app.config.get('DISPATCH_MAX_DELAY_MS') / 1000.0,
+)
+atexit.register(dispatcher.flush)
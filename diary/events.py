@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from flask import current_app
+
+from extensions import db
+from diary.models import Diary
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'diary-events'
+
+
+def message(id, user_id, result, updated_on):
+    # what subscribers learn about a processed diary, the text is left out
+    return {
+        'id': id,
+        'user_id': user_id,
+        'in_progress': False,
+        'result': result,
+        'updated_on': updated_on.isoformat(),
+    }
+
+
+class LocalBroker:
+    """
+    In-process fan out, messages only reach subscribers of this process
+    """
+
+    # whether messages published by other processes arrive here
+    shared = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+
+    def publish(self, message):
+        self.deliver(message)
+
+    def deliver(self, message):
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    def subscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.add(subscription)
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+
+class RedisBroker(LocalBroker):
+    """
+    Publishes on one redis channel, a listener thread per process
+    hands every message to the local subscriptions
+    """
+
+    shared = True
+
+    def __init__(self, url):
+        super().__init__()
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.pid = None
+
+    def publish(self, message):
+        self.redis.publish(CHANNEL, json.dumps(message))
+
+    def subscribe(self, subscription):
+        self._ensure_thread()
+        super().subscribe(subscription)
+
+    def _ensure_thread(self):
+        # threads do not survive a fork, start one per worker process
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                for item in pubsub.listen():
+                    self.deliver(json.loads(item['data']))
+            except Exception:
+                logger.warning('Diary events listener failed', exc_info=True)
+                # messages may be missed until it is back, streams catch up
+                # from the database as they do after an overflow
+                with self.lock:
+                    for subscription in self.subscriptions:
+                        subscription.overflowed = True
+                time.sleep(1)
+
+
+class Subscription:
+    """
+    Bounded queue of the messages one connection asked for: the diaries
+    in diary_ids, those of user_id, or both filters at once
+    """
+
+    def __init__(self, broker, user_id=None, diary_ids=None, maxsize=1000):
+        self.broker = broker
+        self.user_id = user_id
+        self.diary_ids = diary_ids
+        self.queue = queue.Queue(maxsize)
+        # set when messages were dropped, the reader should catch up
+        self.overflowed = False
+
+    def matches(self, message):
+        if self.diary_ids is not None and message['id'] not in self.diary_ids:
+            return False
+        return self.user_id is None or message['user_id'] == self.user_id
+
+    def put(self, message):
+        if not self.matches(message):
+            return
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DiaryEvents:
+    """
+    Pub/sub of processed diaries, in process or through redis when
+    EVENTS_BROKER_URL is set
+    """
+
+    def __init__(self):
+        self.broker = None
+
+    def _broker(self):
+        if self.broker is None:
+            url = current_app.config.get('EVENTS_BROKER_URL')
+            self.broker = RedisBroker(url) if url else LocalBroker()
+        return self.broker
+
+    @property
+    def shared(self):
+        return self._broker().shared
+
+    def publish(self, messages):
+        broker = self._broker()
+        for message in messages:
+            broker.publish(message)
+
+    def subscribe(self, user_id=None, diary_ids=None):
+        subscription = Subscription(
+            self._broker(), user_id, diary_ids,
+            current_app.config.get('EVENTS_QUEUE_SIZE')
+        )
+        self._broker().subscribe(subscription)
+        return subscription
+
+
+def catch_up(user_id=None, diary_ids=None, since=None):
+    """
+    Processed diaries a subscriber may have missed, from the database
+    :param user_id:
+    :param diary_ids:
+    :param since: only diaries updated after this utc datetime
+    :return: messages
+    """
+    query = db.session.query(
+        Diary.id, Diary.user_id, Diary.result, Diary.updated_on
+    ).filter(Diary.in_progress == False)
+    if user_id is not None:
+        query = query.filter(Diary.user_id == user_id)
+    if diary_ids is not None:
+        query = query.filter(Diary.id.in_(diary_ids))
+    if since is not None:
+        query = query.filter(Diary.updated_on > since)
+    return [message(*row) for row in query.order_by(Diary.updated_on)]
+
+
+events = DiaryEvents()
@@ -0,0 +1,111 @@
+"""
+Query plan checks for the hot diaries queries.
+
+Loads synthetic rows into a scratch database and asserts with EXPLAIN
+that every query is answered from an index, run it with
+'flask explain-queries'.
+"""
+import datetime
+import random
+import re
+
+from extensions import db
+from diary import export, pagination
+from diary.models import Diary
+
+# plan lines that mean a full scan or a sort of the whole table
+BAD = {
+    'sqlite': [re.compile(r'^SCAN diaries$'), re.compile(r'USE TEMP B-TREE FOR ORDER BY')],
+    'postgresql': [re.compile(r'Seq Scan on diaries'), re.compile(r'^(->)?\s*Sort\b')],
+}
+
+
+def queries():
+    # the statements the API, the worker and the sweeper actually run
+    now = datetime.datetime.now()
+    cursor = pagination.encode_cursor(now - datetime.timedelta(days=1), 1000)
+    return [
+        ('listing', pagination.keyset(
+            Diary.query.filter_by(user_id=1), Diary
+        ).limit(pagination.DEFAULT_LIMIT + 1)),
+        ('listing next page', pagination.keyset(
+            Diary.query.filter_by(user_id=1), Diary, cursor
+        ).limit(pagination.DEFAULT_LIMIT + 1)),
+        ('admin listing', pagination.keyset(
+            Diary.query, Diary
+        ).limit(pagination.DEFAULT_LIMIT + 1)),
+        ('stats rebuild', db.session.query(
+            Diary.user_id, Diary.created_on, Diary.result
+        ).filter(
+            Diary.user_id.in_([1, 2, 3]),
+            Diary.in_progress == False,
+            Diary.result != None
+        )),
+        ('stuck diaries', Diary.stuck(now - datetime.timedelta(minutes=10))),
+        ('diaries in flight', Diary.in_flight()),
+        ('incremental export', export.query(
+            now, since=now - datetime.timedelta(hours=1)
+        )),
+    ]
+
+
+def load(conn, rows, users, batch_size=10000):
+    # a small fraction of diaries is still in progress, as in production
+    random.seed(0)
+    start = datetime.datetime.now() - datetime.timedelta(days=365)
+    table = Diary.__table__
+    for offset in range(0, rows, batch_size):
+        conn.execute(table.insert(), [
+            {
+                'text': 'synthetic diary',
+                'preview': 'synthetic diary',
+                'text_length': 15,
+                'user_id': random.randint(1, users),
+                'in_progress': random.random() < 0.001,
+                'result': None,
+                'created_on': start + datetime.timedelta(seconds=random.randint(0, 365 * 86400)),
+                'updated_on': start,
+            }
+            for _ in range(min(batch_size, rows - offset))
+        ])
+    conn.exec_driver_sql('ANALYZE')
+
+
+def explain(conn, query):
+    compiled = query.statement.compile(
+        dialect=conn.dialect, compile_kwargs={'render_postcompile': True}
+    )
+    if conn.dialect.name == 'postgresql':
+        sql, params = 'EXPLAIN ' + str(compiled), compiled.params
+    else:
+        sql = 'EXPLAIN QUERY PLAN ' + str(compiled)
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    return [str(row[-1]) for row in conn.exec_driver_sql(sql, params)]
+
+
+def check(engine, rows=100000, users=1000):
+    """
+    Creates the schema in engine, fills it and explains every query.
+    The tables are dropped afterwards, so databases that already have
+    any of them are refused with ValueError.
+    :return: list of (name, plan lines, ok)
+    """
+    bad = BAD[engine.dialect.name]
+    existing = set(db.inspect(engine).get_table_names()) & set(db.metadata.tables)
+    if existing:
+        raise ValueError('The database already has the tables {}, use an empty scratch database.'.format(
+            ', '.join(sorted(existing))
+        ))
+    db.metadata.create_all(engine)
+    try:
+        with engine.begin() as conn:
+            load(conn, rows, users)
+        results = []
+        with engine.connect() as conn:
+            for name, query in queries():
+                plan = explain(conn, query)
+                ok = not any(pattern.search(line.strip()) for line in plan for pattern in bad)
+                results.append((name, plan, ok))
+        return results
+    finally:
+        db.metadata.drop_all(engine)
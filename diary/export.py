@@ -0,0 +1,213 @@
+"""
+Bulk export of diaries for analytics, as CSV or Arrow/Parquet batches.
+
+Rows are read through a server side cursor and written out a batch at a
+time, so memory stays bounded by the batch size whatever the range.
+Every export is cut at a watermark, passing it back as since exports
+only the diaries created or processed after it.
+"""
+import csv
+import datetime
+import io
+
+from extensions import db
+from diary.models import Diary
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ('csv', 'parquet', 'arrow')
+MIMETYPES = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+
+def columns(text=True):
+    # the body is only read when asked for, the preview otherwise
+    body = Diary.text if text else Diary.preview
+    return (Diary.id, Diary.user_id, Diary.created_on, Diary.updated_on,
+            Diary.in_progress, Diary.text_length, Diary.result, body)
+
+
+def column_names(text=True):
+    return [column.key for column in columns(text)]
+
+
+def watermark(lag, since=None):
+    """
+    :param lag: seconds, transactions older than this are assumed committed
+    :param since: watermark of the previous export, never gone back past
+    :return: utc cut off of an export started now
+    """
+    upto = datetime.datetime.utcnow() - datetime.timedelta(seconds=lag)
+    return max(upto, since) if since is not None else upto
+
+
+def parse_watermark(value):
+    """
+    :param value: watermark of a previous export, or None
+    :return: datetime or None, ValueError when malformed
+    """
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError('Watermark must be an ISO 8601 timestamp.')
+
+
+def query(upto, user_id=None, start=None, end=None, since=None, text=True, batch_size=1000):
+    """
+    Diaries updated up to upto, rows are fetched batch_size at a time
+    :param upto: watermark the export is cut at
+    :param user_id: only the diaries of this user
+    :param start: first day of created_on, inclusive
+    :param end: last day of created_on, inclusive
+    :param since: watermark of the previous export, incremental when given
+    :param text: full bodies, previews otherwise
+    """
+    query = db.session.query(*columns(text)).filter(Diary.updated_on <= upto)
+    if user_id is not None:
+        query = query.filter(Diary.user_id == user_id)
+    if start is not None:
+        query = query.filter(Diary.created_on >= datetime.datetime.combine(start, datetime.time.min))
+    if end is not None:
+        query = query.filter(
+            Diary.created_on < datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time.min)
+        )
+    if since is not None:
+        # created or processed since, served by ix_diaries_updated
+        query = query.filter(Diary.updated_on > since).order_by(Diary.updated_on, Diary.id)
+    else:
+        query = query.order_by(Diary.created_on, Diary.id)
+    return query.yield_per(batch_size)
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _cell(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def csv_chunks(rows, names, batch_size=1000):
+    """
+    :return: iterator of str, the header and then one chunk per batch
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    for batch in batches(rows, batch_size):
+        writer.writerows([[_cell(value) for value in row] for row in batch])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # nothing to export, only the header
+        yield buffer.getvalue()
+
+
+def schema(names):
+    if pyarrow is None:
+        raise RuntimeError('pyarrow is not installed.')
+    types = {
+        'id': pyarrow.int64(),
+        'user_id': pyarrow.int64(),
+        'created_on': pyarrow.timestamp('us'),
+        'updated_on': pyarrow.timestamp('us'),
+        'in_progress': pyarrow.bool_(),
+        'text_length': pyarrow.int64(),
+        'result': pyarrow.large_string(),
+        'text': pyarrow.large_string(),
+        'preview': pyarrow.string(),
+    }
+    return pyarrow.schema([(name, types[name]) for name in names])
+
+
+def record_batch(batch, schema):
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array(values, type=field.type) for values, field in zip(zip(*batch), schema)],
+        schema=schema
+    )
+
+
+class ChunkSink:
+    """
+    Write-only file for pyarrow writers, whatever was written since
+    the last drain() can be sent away
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_chunks(rows, names, batch_size=1000, parquet=False):
+    """
+    Arrow IPC stream, or Parquet with a row group per batch
+    :return: iterator of bytes
+    """
+    arrow_schema = schema(names)
+    sink = ChunkSink()
+    if parquet:
+        writer = pyarrow.parquet.ParquetWriter(sink, arrow_schema)
+        write = lambda batch: writer.write_table(pyarrow.Table.from_batches([batch]))
+    else:
+        writer = pyarrow.ipc.new_stream(sink, arrow_schema)
+        write = writer.write_batch
+    for batch in batches(rows, batch_size):
+        write(record_batch(batch, arrow_schema))
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    yield sink.drain()
+
+
+def chunks(format, rows, names, batch_size=1000):
+    if format == 'csv':
+        return csv_chunks(rows, names, batch_size)
+    if format in ('parquet', 'arrow'):
+        return arrow_chunks(rows, names, batch_size, parquet=format == 'parquet')
+    raise ValueError('Format must be one of {}.'.format(', '.join(FORMATS)))
+
+
+def available(format):
+    # formats other than csv need pyarrow
+    return format == 'csv' or (format in FORMATS and pyarrow is not None)
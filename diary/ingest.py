@@ -0,0 +1,141 @@
+import codecs
+import datetime
+import json
+
+READ_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+
+
+class MalformedBody(ValueError):
+    """
+    The body cannot be read any further, items before it were fine
+    """
+
+
+def too_large(max_item_size):
+    return 'Item must be at most {} bytes of JSON.'.format(max_item_size)
+
+
+def ndjson_items(stream, max_item_size=None):
+    """
+    One JSON document per line, a bad line only fails its own item
+    :param stream: binary file-like request body
+    :param max_item_size: longer lines fail without being parsed
+    :return: iterator of (item, error message or None)
+    """
+    limit = -1 if max_item_size is None else max_item_size + 1
+    while True:
+        line = stream.readline(limit)
+        if not line:
+            return
+        if max_item_size is not None and len(line) > max_item_size:
+            # skip the rest of the line a bounded piece at a time
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(READ_SIZE)
+            yield None, too_large(max_item_size)
+            continue
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line), None
+        except ValueError:
+            yield None, 'Invalid JSON.'
+
+
+def json_array_items(stream, max_item_size=None):
+    """
+    Reads the elements of a top level JSON array one at a time, so
+    the whole body never has to be in memory
+    :param stream: binary file-like request body
+    :param max_item_size: characters an element may take, the body is
+        refused when one gets larger
+    :return: iterator of (item, None)
+    """
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+    buffer = ''
+    position = 0
+    eof = False
+
+    def fill(size=READ_SIZE):
+        nonlocal buffer, position, eof
+        chunk = stream.read(size)
+        eof = not chunk
+        buffer = buffer[position:] + decode(chunk, final=eof)
+        position = 0
+
+    def next_char():
+        # first character that is not whitespace, without consuming it
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if eof:
+                return ''
+            fill()
+
+    try:
+        if next_char() != '[':
+            raise MalformedBody('Body must be a JSON array.')
+        position += 1
+        if next_char() == ']':
+            position += 1
+            if next_char() != '':
+                raise MalformedBody('Unexpected data after the array.')
+            return
+        while True:
+            next_char()
+            while True:
+                try:
+                    item, end = _decoder.raw_decode(buffer, position)
+                    # a number at the end of the buffer may go on in the next chunk
+                    if end < len(buffer) or eof:
+                        break
+                except ValueError:
+                    if eof:
+                        raise MalformedBody('Invalid JSON.')
+                pending = len(buffer) - position
+                if max_item_size is not None and pending > max_item_size:
+                    raise MalformedBody(too_large(max_item_size))
+                # at least double what is buffered, every retry parses it
+                # all again and must not make large items quadratic
+                fill(max(READ_SIZE, pending))
+            position = end
+            yield item, None
+            separator = next_char()
+            position += 1
+            if separator == ']':
+                break
+            if separator != ',':
+                raise MalformedBody('Invalid JSON.')
+        if next_char() != '':
+            raise MalformedBody('Unexpected data after the array.')
+    except UnicodeDecodeError:
+        raise MalformedBody('Body must be UTF-8.')
+
+
+def validate(item, max_length=None):
+    """
+    Checks one bulk item, {"text": ..., "created_on": optional ISO date}
+    :return: ((text, created_on), None) or (None, error message)
+    """
+    if not isinstance(item, dict):
+        return None, 'Item must be an object.'
+    text = item.get('text')
+    if not isinstance(text, str) or not text:
+        return None, 'Text must be a non-empty string.'
+    if max_length is not None and len(text) > max_length:
+        return None, 'Text must be at most {} characters.'.format(max_length)
+    created_on = item.get('created_on')
+    if created_on is not None:
+        try:
+            created_on = datetime.datetime.fromisoformat(created_on)
+        except (TypeError, ValueError):
+            return None, 'created_on must be an ISO 8601 date.'
+        if created_on.tzinfo is not None:
+            # created_on is stored naive in server time
+            created_on = created_on.astimezone().replace(tzinfo=None)
+    return (text, created_on), None
@@ -0,0 +1,62 @@
+# Built-in word valences (-3..3), used when TEXT_LEXICON_PATH is not set.
+# A lexicon file has one "word<TAB>score" pair per line, AFINN style.
+VALENCES = {
+    'abandoned': -2, 'accomplished': 2, 'afraid': -2, 'alone': -2,
+    'amazing': 3, 'angry': -3, 'annoyed': -2, 'anxious': -2,
+    'appreciate': 2, 'ashamed': -2, 'awesome': 3, 'awful': -3,
+    'bad': -2, 'beautiful': 3, 'best': 3, 'better': 2,
+    'bitter': -2, 'bored': -2, 'brave': 2, 'bright': 1,
+    'broken': -2, 'calm': 2, 'celebrate': 3, 'cheerful': 2,
+    'comfortable': 2, 'confident': 2, 'confused': -2, 'crap': -3,
+    'cried': -2, 'cry': -1, 'crying': -2, 'death': -2,
+    'delighted': 3, 'depressed': -3, 'desperate': -3, 'disappointed': -2,
+    'disaster': -2, 'disgusted': -3, 'dread': -2, 'easy': 1,
+    'energetic': 2, 'enjoy': 2, 'enjoyed': 2, 'excellent': 3,
+    'excited': 3, 'exhausted': -2, 'fail': -2, 'failed': -2,
+    'failure': -2, 'fantastic': 3, 'fear': -2, 'fine': 2,
+    'fun': 3, 'funny': 2, 'glad': 3, 'good': 3,
+    'grateful': 3, 'great': 3, 'grief': -2, 'guilty': -3,
+    'happy': 3, 'hate': -3, 'hated': -3, 'healthy': 2,
+    'helpful': 2, 'hope': 2, 'hopeful': 2, 'hopeless': -2,
+    'horrible': -3, 'hurt': -2, 'ill': -2, 'inspired': 2,
+    'jealous': -2, 'joy': 3, 'kind': 2, 'laugh': 1,
+    'laughed': 1, 'lonely': -2, 'lost': -2, 'love': 3,
+    'loved': 3, 'lovely': 3, 'lucky': 3, 'mad': -3,
+    'miserable': -3, 'miss': -2, 'missed': -2, 'nervous': -2,
+    'nice': 3, 'overwhelmed': -2, 'pain': -2, 'panic': -3,
+    'peaceful': 2, 'perfect': 3, 'pleasant': 3, 'pleased': 3,
+    'positive': 2, 'productive': 2, 'proud': 2, 'regret': -2,
+    'relaxed': 2, 'relieved': 2, 'sad': -2, 'scared': -2,
+    'sick': -2, 'sorry': -1, 'stress': -1, 'stressed': -2,
+    'strong': 2, 'stupid': -2, 'success': 2, 'successful': 3,
+    'suffer': -2, 'terrible': -3, 'thank': 2, 'thankful': 2,
+    'tired': -2, 'ugly': -3, 'unhappy': -2, 'upset': -2,
+    'useless': -2, 'warm': 1, 'weak': -2, 'win': 4,
+    'wonderful': 4, 'worried': -3, 'worse': -3, 'worst': -3,
+    'worthless': -2, 'wrong': -2,
+}
+
+NEGATIONS = frozenset([
+    'not', 'no', 'never', 'none', 'nobody', 'nothing', 'neither', 'nor',
+    "don't", "doesn't", "didn't", "isn't", "wasn't", "aren't", "weren't",
+    "can't", "couldn't", "won't", "wouldn't", "shouldn't", 'without',
+])
+
+INTENSIFIERS = {
+    'very': 1.3, 'really': 1.3, 'so': 1.2, 'extremely': 1.5,
+    'incredibly': 1.5, 'too': 1.2, 'quite': 1.1, 'slightly': 0.7,
+    'somewhat': 0.8, 'barely': 0.6,
+}
+
+STOPWORDS = frozenset('''
+a about above after again against all am an and any are as at be because
+been before being below between both but by could did do does doing down
+during each few for from further had has have having he her here hers
+herself him himself his how i if in into is it its itself just me more
+most my myself of off on once only or other our ours ourselves out over
+own same she should some such than that the their theirs them themselves
+then there these they this those through to today under until up us was
+we were what when where which while who whom why will with would you your
+yours yourself yourselves i'm i've i'd i'll it's that's there's got get
+go went going also like one really very so too much many still even now day
+'''.split()) | NEGATIONS
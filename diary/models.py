@@ -1,30 +1,580 @@
 import datetime
+import json
+from collections import OrderedDict
 
-from app import app, db, bcrypt
+from sqlalchemy.dialects import postgresql, sqlite
+
+from extensions import db
+from diary.compression import CompressedText
+
+# characters of the body shown in listings
+PREVIEW_LENGTH = 200
+
+def as_utc(value):
+    # aware copy of a naive utc datetime, serialized with +00:00
+    return value.replace(tzinfo=datetime.timezone.utc) if value is not None else None
 
 class Diary(db.Model):
     __tablename__ = 'diaries'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    text = db.Column(db.String(255), nullable=True)
+    # the body is only loaded when it is accessed
+    text = db.deferred(db.Column(CompressedText, nullable=True))
+    preview = db.Column(db.String(PREVIEW_LENGTH), nullable=True)
+    text_length = db.Column(db.Integer, nullable=True)
     user_id = db.Column(db.Integer, nullable=False)
     in_progress = db.Column(db.Boolean, nullable=False, default=False)
-    result = db.Column(db.String(255), nullable=True)
+    result = db.Column(db.Text, nullable=True)
+    # server local time, as registered_on of users
     created_on = db.Column(db.DateTime, nullable=False)
+    # last time the diary was handed to the broker
+    dispatched_on = db.Column(db.DateTime, nullable=True)
+    # utc, bumped whenever the representation changes, serialized with
+    # its offset so it is not taken for local time next to created_on
+    updated_on = db.Column(db.DateTime, nullable=False)
 
     def __init__(self, text, user_id, in_progress, result=None):
         self.text = text
+        self.preview, self.text_length = Diary.summarize(text)
         self.user_id = user_id
         self.in_progress = in_progress
         self.result = result
         self.created_on = datetime.datetime.now()
+        self.updated_on = datetime.datetime.utcnow()
 
     def myjson(self):
         return {
             'id':self.id,
             'text':self.text,
+            'text_length':self.text_length,
             'user_id':self.user_id,
             'in_progress':self.in_progress,
             'result':self.result,
-            'created_on':self.created_on
+            'created_on':self.created_on,
+            'updated_on':as_utc(self.updated_on)
+        }
+
+    @staticmethod
+    def summarize(text):
+        # (preview, length) stored next to the body for listings
+        if text is None:
+            return None, None
+        return text[:PREVIEW_LENGTH], len(text)
+
+    @staticmethod
+    def json_columns():
+        # the listing columns, myjson with the preview instead of the body
+        return (Diary.id, Diary.preview, Diary.text_length, Diary.user_id,
+                Diary.in_progress, Diary.result, Diary.created_on, Diary.updated_on)
+
+    @staticmethod
+    def row_json(row):
+        # listing json for a row selected with json_columns
+        data = row._asdict()
+        data['updated_on'] = as_utc(data['updated_on'])
+        return data
+
+    @staticmethod
+    def insert_many(user_id, items, backfill=False):
+        """
+        Inserts new diaries with their outbox rows using multi-row
+        statements, the caller commits
+        :param user_id:
+        :param items: (text, created_on) pairs, created_on may be None
+        :param backfill: leave them to the scheduler, see diary.scheduler
+        :return: ids in the order of items
+        """
+        if not items:
+            return []
+        now = datetime.datetime.now()
+        updated_on = datetime.datetime.utcnow()
+        rows = [
+            {
+                'text': text,
+                'preview': text[:PREVIEW_LENGTH],
+                'text_length': len(text),
+                'user_id': user_id,
+                'in_progress': True,
+                'result': None,
+                'created_on': created_on or now,
+                'updated_on': updated_on,
+            }
+            for text, created_on in items
+        ]
+        if db.engine.dialect.name == 'postgresql':
+            # one INSERT .. VALUES (..), (..) RETURNING id
+            ids = db.session.execute(
+                db.insert(Diary).values(rows).returning(Diary.id)
+            ).scalars().all()
+        else:
+            # no multi-row RETURNING here, the flush reads each lastrowid
+            diaries = [Diary.from_row(row) for row in rows]
+            db.session.add_all(diaries)
+            db.session.flush()
+            ids = [diary.id for diary in diaries]
+        db.session.execute(
+            db.insert(DiaryOutbox),
+            [{'diary_id': id, 'created_on': now, 'backfill': backfill} for id in ids]
+        )
+        return ids
+
+    @staticmethod
+    def from_row(row):
+        diary = Diary(row['text'], row['user_id'], row['in_progress'], row['result'])
+        diary.created_on = row['created_on']
+        diary.updated_on = row['updated_on']
+        return diary
+
+    @staticmethod
+    def requeue_stuck(timeout):
+        """
+        Puts diaries that are still in progress timeout seconds after
+        they were dispatched back into the outbox
+        :param timeout:
+        :return: number of diaries requeued
+        """
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+        stuck = Diary.stuck(cutoff).all()
+        db.session.add_all([DiaryOutbox(id) for id, in stuck])
+        db.session.commit()
+        return len(stuck)
+
+    @staticmethod
+    def claim_in_progress(ids):
+        """
+        Locks the diaries of ids still in progress until the commit, a
+        task processing the same diaries at the same time gets none
+        :return: set of the claimed ids
+        """
+        if not ids:
+            return set()
+        query = db.session.query(Diary.id).filter(Diary.id.in_(ids), Diary.in_progress == True)
+        if db.engine.dialect.name == 'postgresql':
+            query = query.with_for_update(skip_locked=True)
+        else:
+            # the database write lock stands in for row locks, see DiaryOutbox.claim
+            db.session.execute(
+                db.update(Diary).where(db.false()).values(in_progress=Diary.in_progress)
+            )
+        return set(id for id, in query)
+
+    @staticmethod
+    def in_flight():
+        # handed to the workers and not processed yet, served by ix_diaries_in_flight
+        return db.session.query(db.func.count(Diary.id)).filter(
+            Diary.in_progress == True,
+            Diary.dispatched_on != None,
+            ~db.exists().where(DiaryOutbox.diary_id == Diary.id)
+        )
+
+    @staticmethod
+    def stuck(cutoff):
+        # in progress, dispatched (or created, if never dispatched) before cutoff
+        # and not already waiting in the outbox, served by ix_diaries_stuck
+        return db.session.query(Diary.id).filter(
+            Diary.in_progress == True,
+            db.func.coalesce(Diary.dispatched_on, Diary.created_on) < cutoff,
+            ~db.exists().where(DiaryOutbox.diary_id == Diary.id)
+        )
+
+# keyset listings of one user, and of everyone for admins
+db.Index('ix_diaries_user_created', Diary.user_id, Diary.created_on.desc(), Diary.id.desc())
+db.Index('ix_diaries_created', Diary.created_on.desc(), Diary.id.desc())
+# incremental exports, everything created or processed since a watermark
+db.Index('ix_diaries_updated', Diary.updated_on, Diary.id)
+# partial index, only the few diaries still in progress are in it
+db.Index(
+    'ix_diaries_stuck',
+    db.func.coalesce(Diary.dispatched_on, Diary.created_on),
+    postgresql_where=Diary.in_progress == True,
+    sqlite_where=Diary.in_progress == True
+)
+# the few dispatched diaries still being processed
+db.Index(
+    'ix_diaries_in_flight',
+    Diary.dispatched_on,
+    postgresql_where=db.and_(Diary.in_progress == True, Diary.dispatched_on != None),
+    sqlite_where=db.and_(Diary.in_progress == True, Diary.dispatched_on != None)
+)
+
+class DiaryOutbox(db.Model):
+    """
+    Diary ids waiting to be sent to the processing queue, written in
+    the same transaction as the diary itself
+    """
+    __tablename__ = 'diary_outbox'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    diary_id = db.Column(db.Integer, nullable=False, index=True)
+    created_on = db.Column(db.DateTime, nullable=False)
+    # bulk imports, released by the scheduler instead of the dispatcher
+    backfill = db.Column(db.Boolean, nullable=False, default=False)
+
+    def __init__(self, diary_id, backfill=False):
+        self.diary_id = diary_id
+        self.created_on = datetime.datetime.now()
+        self.backfill = backfill
+
+    @staticmethod
+    def claim(batch_size, diary_ids=None, older_than=None, backfill=None):
+        # lock the oldest pending rows so concurrent relays skip them
+        query = DiaryOutbox.query.order_by(DiaryOutbox.id)
+        if diary_ids is not None:
+            query = query.filter(DiaryOutbox.diary_id.in_(diary_ids))
+        if older_than is not None:
+            query = query.filter(DiaryOutbox.created_on <= older_than)
+        if backfill is not None:
+            query = query.filter(DiaryOutbox.backfill == backfill)
+        if db.engine.dialect.name == 'postgresql':
+            query = query.with_for_update(skip_locked=True)
+        else:
+            # sqlite has no row locks, taking the database write lock
+            # first makes concurrent relays claim one after another
+            db.session.execute(
+                db.update(DiaryOutbox).where(db.false()).values(diary_id=DiaryOutbox.diary_id)
+            )
+        return query.limit(batch_size).all()
+
+    @staticmethod
+    def relay(send, batch_size, diary_ids=None, older_than=None, backfill=None):
+        """
+        Sends one batch of pending ids with send(ids), the rows are
+        deleted in the same transaction so each id is sent once
+        :return: number of ids sent
+        """
+        try:
+            rows = DiaryOutbox.claim(batch_size, diary_ids, older_than, backfill)
+            if not rows:
+                db.session.rollback()
+                return 0
+            send([row.diary_id for row in rows])
+            DiaryOutbox.sent(rows)
+            db.session.commit()
+            return len(rows)
+        except Exception:
+            db.session.rollback()
+            raise
+
+    @staticmethod
+    def sent(rows):
+        # deletes claimed rows once their ids were sent, the diaries are in flight from now
+        DiaryOutbox.query.filter(
+            DiaryOutbox.id.in_([row.id for row in rows])
+        ).delete(synchronize_session=False)
+        Diary.query.filter(Diary.id.in_([row.diary_id for row in rows])).update(
+            {'dispatched_on': datetime.datetime.now()},
+            synchronize_session=False
+        )
+
+    @staticmethod
+    def drain(send, batch_size, older_than=None, backfill=None):
+        # relay batches until nothing is left
+        total = 0
+        while True:
+            sent = DiaryOutbox.relay(send, batch_size, older_than=older_than, backfill=backfill)
+            if not sent:
+                return total
+            total += sent
+
+class SchedulerTurn(db.Model):
+    """
+    Round robin state of the backfill scheduler, one row per user with
+    diaries waiting, shared by every process that relays
+    """
+    __tablename__ = 'scheduler_turns'
+
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # place in the round, the lowest one is served next
+    position = db.Column(db.Integer, nullable=False)
+    deficit = db.Column(db.Integer, nullable=False, default=0)
+    # only set on the user in front, in the middle of a turn
+    serving = db.Column(db.Boolean, nullable=False, default=False)
+
+    @staticmethod
+    def lock():
+        # releases run one after another, the lock is held until the commit
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(db.text('LOCK TABLE scheduler_turns IN EXCLUSIVE MODE'))
+        else:
+            db.session.execute(
+                db.update(SchedulerTurn).where(db.false()).values(deficit=SchedulerTurn.deficit)
+            )
+
+    @staticmethod
+    def load():
+        """
+        :return: user ids in turn order, {user_id: deficit}, whether the
+            user in front is in the middle of a turn
+        """
+        rows = db.session.query(
+            SchedulerTurn.user_id, SchedulerTurn.deficit, SchedulerTurn.serving
+        ).order_by(SchedulerTurn.position).all()
+        order = [row.user_id for row in rows]
+        deficits = {row.user_id: row.deficit for row in rows}
+        return order, deficits, bool(rows) and rows[0].serving
+
+    @staticmethod
+    def save(order, deficits, serving):
+        # the round is small, one row per user with a backlog
+        SchedulerTurn.query.delete(synchronize_session=False)
+        if order:
+            db.session.execute(db.insert(SchedulerTurn), [
+                {
+                    'user_id': user_id,
+                    'position': position,
+                    'deficit': deficits[user_id],
+                    'serving': serving and position == 0,
+                }
+                for position, user_id in enumerate(order)
+            ])
+
+class UserStats(db.Model):
+    """
+    Running totals of a user's processed diaries, kept up to date by
+    the worker so /api/stats reads a single row
+    """
+    __tablename__ = 'user_stats'
+
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    diaries = db.Column(db.Integer, nullable=False, default=0)
+    words = db.Column(db.Integer, nullable=False, default=0)
+    sentiment_sum = db.Column(db.Float, nullable=False, default=0.0)
+    positive = db.Column(db.Integer, nullable=False, default=0)
+    neutral = db.Column(db.Integer, nullable=False, default=0)
+    negative = db.Column(db.Integer, nullable=False, default=0)
+    current_streak = db.Column(db.Integer, nullable=False, default=0)
+    longest_streak = db.Column(db.Integer, nullable=False, default=0)
+    last_day = db.Column(db.Date, nullable=True)
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.diaries = 0
+        self.words = 0
+        self.sentiment_sum = 0.0
+        self.positive = 0
+        self.neutral = 0
+        self.negative = 0
+        self.current_streak = 0
+        self.longest_streak = 0
+
+    def add(self, analysis):
+        self.diaries += 1
+        self.words += analysis['words']
+        self.sentiment_sum += analysis['sentiment']
+        setattr(self, analysis['mood'], getattr(self, analysis['mood']) + 1)
+
+    def add_day(self, day):
+        # extend the streak with a day that had no diaries before,
+        # returns False when the streaks have to be recounted
+        if self.last_day is not None and day < self.last_day:
+            return False
+        if self.last_day is not None and day == self.last_day + datetime.timedelta(days=1):
+            self.current_streak += 1
+        else:
+            self.current_streak = 1
+        self.last_day = day
+        self.longest_streak = max(self.longest_streak, self.current_streak)
+        return True
+
+    def recount_streaks(self):
+        days = [day for day, in db.session.query(UserStatsDaily.day).filter(
+            UserStatsDaily.user_id == self.user_id
+        ).order_by(UserStatsDaily.day)]
+        self.current_streak = 0
+        self.longest_streak = 0
+        previous = None
+        for day in days:
+            if previous is not None and day == previous + datetime.timedelta(days=1):
+                self.current_streak += 1
+            else:
+                self.current_streak = 1
+            self.longest_streak = max(self.longest_streak, self.current_streak)
+            previous = day
+        self.last_day = previous
+
+    def myjson(self):
+        return {
+            'diaries':self.diaries,
+            'words':self.words,
+            'average_sentiment':average(self.sentiment_sum, self.diaries),
+            'moods':{
+                'positive':self.positive,
+                'neutral':self.neutral,
+                'negative':self.negative
+            },
+            'current_streak':self.current_streak,
+            'longest_streak':self.longest_streak,
+            'last_day':self.last_day.isoformat() if self.last_day else None
+        }
+
+    @staticmethod
+    def record(entries):
+        """
+        Adds processed diaries to the stats, the caller commits
+        :param entries: list of (user_id, created_on, analysis)
+        """
+        user_ids = sorted(set(user_id for user_id, _, _ in entries))
+        days = sorted(set((user_id, created_on.date()) for user_id, created_on, _ in entries))
+        # row locks only cover rows that exist, the first rows of a user
+        # or a day are created up front so that racing workers do not fail
+        insert_missing(UserStats, [{'user_id': user_id} for user_id in user_ids])
+        insert_missing(UserStatsDaily, [{'user_id': user_id, 'day': day} for user_id, day in days])
+        query = UserStats.query.filter(
+            UserStats.user_id.in_(user_ids)
+        ).order_by(UserStats.user_id)
+        daily_query = UserStatsDaily.query.filter(
+            UserStatsDaily.user_id.in_(user_ids),
+            UserStatsDaily.day.in_(set(day for _, day in days))
+        ).order_by(UserStatsDaily.user_id, UserStatsDaily.day)
+        if db.engine.dialect.name == 'postgresql':
+            # concurrent workers update the same users one after another
+            query = query.with_for_update()
+            daily_query = daily_query.with_for_update()
+        totals = dict((row.user_id, row) for row in query)
+        buckets = dict(((row.user_id, row.day), row) for row in daily_query)
+        recount = set()
+        for user_id, created_on, analysis in sorted(entries, key=lambda entry: entry[1]):
+            key = (user_id, created_on.date())
+            if buckets[key].diaries == 0:
+                # a day without diaries so far
+                if not totals[user_id].add_day(key[1]):
+                    recount.add(user_id)
+            totals[user_id].add(analysis)
+            buckets[key].add(analysis)
+        for user_id in recount:
+            totals[user_id].recount_streaks()
+
+    @staticmethod
+    def lock_tables():
+        # workers block on their first stats write until the commit
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(db.text('LOCK TABLE user_stats, user_stats_daily IN EXCLUSIVE MODE'))
+        else:
+            db.session.execute(
+                db.update(UserStats).where(db.false()).values(diaries=UserStats.diaries)
+            )
+
+    @staticmethod
+    def rebuild(chunk_size=1000):
+        """
+        Recomputes every user's stats from the processed diaries,
+        chunk_size users at a time in a single transaction. Workers wait
+        for it, diaries they process meanwhile are counted by them once
+        the rebuild committed, the others are counted by the rebuild.
+        :return: number of users rebuilt
+        """
+        UserStats.lock_tables()
+        UserStatsDaily.query.delete()
+        UserStats.query.delete()
+        rebuilt = 0
+        last_user_id = 0
+        while True:
+            user_ids = [user_id for user_id, in db.session.query(Diary.user_id).filter(
+                Diary.user_id > last_user_id
+            ).distinct().order_by(Diary.user_id).limit(chunk_size)]
+            if not user_ids:
+                db.session.commit()
+                return rebuilt
+            rows = db.session.query(Diary.user_id, Diary.created_on, Diary.result).filter(
+                Diary.user_id.in_(user_ids),
+                Diary.in_progress == False,
+                Diary.result != None
+            ).yield_per(chunk_size)
+            entries = []
+            for user_id, created_on, result in rows:
+                try:
+                    entries.append((user_id, created_on, json.loads(result)))
+                except ValueError:
+                    # results written before the text engine existed
+                    continue
+            if entries:
+                UserStats.record(entries)
+            # written out, only the next chunk is kept in memory
+            db.session.flush()
+            db.session.expunge_all()
+            rebuilt += len(user_ids)
+            last_user_id = user_ids[-1]
+
+class UserStatsDaily(db.Model):
+    """
+    Per user, per day rollup of processed diaries
+    """
+    __tablename__ = 'user_stats_daily'
+
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    day = db.Column(db.Date, primary_key=True)
+    diaries = db.Column(db.Integer, nullable=False, default=0)
+    words = db.Column(db.Integer, nullable=False, default=0)
+    sentiment_sum = db.Column(db.Float, nullable=False, default=0.0)
+    positive = db.Column(db.Integer, nullable=False, default=0)
+    neutral = db.Column(db.Integer, nullable=False, default=0)
+    negative = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, user_id, day):
+        self.user_id = user_id
+        self.day = day
+        self.diaries = 0
+        self.words = 0
+        self.sentiment_sum = 0.0
+        self.positive = 0
+        self.neutral = 0
+        self.negative = 0
+
+    def add(self, analysis):
+        self.diaries += 1
+        self.words += analysis['words']
+        self.sentiment_sum += analysis['sentiment']
+        setattr(self, analysis['mood'], getattr(self, analysis['mood']) + 1)
+
+    @staticmethod
+    def summary(user_id, start, end, bucket='day'):
+        """
+        Totals and day or week buckets between start and end, inclusive
+        :return: dict|None when there is nothing in the range
+        """
+        rows = UserStatsDaily.query.filter(
+            UserStatsDaily.user_id == user_id,
+            UserStatsDaily.day >= start,
+            UserStatsDaily.day <= end
+        ).order_by(UserStatsDaily.day).all()
+        if not rows:
+            return None
+        buckets = OrderedDict()
+        for row in rows:
+            if bucket == 'week':
+                key = row.day - datetime.timedelta(days=row.day.weekday())
+            else:
+                key = row.day
+            buckets.setdefault(key, []).append(row)
+        return dict(
+            rollup(rows),
+            start=start.isoformat(),
+            end=end.isoformat(),
+            buckets=[
+                dict(rollup(group), start=key.isoformat())
+                for key, group in buckets.items()
+            ]
+        )
+
+def insert_missing(model, rows):
+    # INSERT .. ON CONFLICT DO NOTHING, rows other workers created are kept
+    if not rows:
+        return
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    db.session.execute(dialect.insert(model).values(rows).on_conflict_do_nothing())
+
+def average(total, count):
+    return round(total / count, 4) if count else None
+
+def rollup(rows):
+    diaries = sum(row.diaries for row in rows)
+    return {
+        'diaries':diaries,
+        'words':sum(row.words for row in rows),
+        'average_sentiment':average(sum(row.sentiment_sum for row in rows), diaries),
+        'moods':{
+            'positive':sum(row.positive for row in rows),
+            'neutral':sum(row.neutral for row in rows),
+            'negative':sum(row.negative for row in rows)
         }
+    }
@@ -0,0 +1,73 @@
+import base64
+import binascii
+import datetime
+
+from extensions import db
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+STREAM_BATCH_SIZE = 1000
+
+
+def encode_cursor(created_on, id):
+    # opaque cursor pointing at the last row of a page
+    raw = '{}|{}'.format(created_on.isoformat(), id)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor made by encode_cursor
+    :param cursor:
+    :return: (datetime, integer)
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_on, id = raw.split('|')
+        return datetime.datetime.fromisoformat(created_on), int(id)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError('Invalid cursor.')
+
+
+def parse_limit(value):
+    if value is None:
+        return DEFAULT_LIMIT
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise ValueError('Limit must be a positive integer.')
+    return min(limit, MAX_LIMIT)
+
+
+def keyset(query, model, cursor=None):
+    """
+    Orders the query newest first on (created_on, id) and
+    seeks past the cursor, so no page ever needs an OFFSET
+    """
+    if cursor:
+        created_on, id = decode_cursor(cursor)
+        query = query.filter(db.or_(
+            model.created_on < created_on,
+            db.and_(model.created_on == created_on, model.id < id)
+        ))
+    return query.order_by(model.created_on.desc(), model.id.desc())
+
+
+def paginate(query, model, cursor=None, limit=DEFAULT_LIMIT):
+    # fetch one extra row to know whether there is a next page
+    rows = keyset(query, model, cursor).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        return rows, encode_cursor(last.created_on, last.id)
+    return rows, None
+
+
+def stream(query, model, cursor=None, limit=None):
+    # server side cursor, rows are fetched STREAM_BATCH_SIZE at a time
+    query = keyset(query, model, cursor)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.yield_per(STREAM_BATCH_SIZE)
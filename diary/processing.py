@@ -0,0 +1,154 @@
+import functools
+import json
+import math
+import re
+from collections import Counter, deque
+
+from diary import lexicon
+
+TOKEN_RE = re.compile(r"[a-z]+(?:'[a-z]+)?")
+# a token never continues past a character outside this set
+TOKEN_CHARS = frozenset("abcdefghijklmnopqrstuvwxyz'")
+
+# sentiment score normalization constant, as in VADER
+ALPHA = 15
+# mood thresholds on the normalized score
+POSITIVE = 0.05
+NEGATIVE = -0.05
+KEYWORDS = 5
+KEYWORD_LENGTH = 20
+
+
+class TextEngine:
+    """
+    Lexicon based text analysis: tokens, word counts, sentiment,
+    mood and keywords. Build it once per process with get_engine().
+    """
+
+    def __init__(self, valences, negations, intensifiers, stopwords):
+        self.valences = valences
+        self.negations = negations
+        self.intensifiers = intensifiers
+        self.stopwords = stopwords
+
+    def valence(self, token, window):
+        # window holds up to three preceding tokens, the nearest last
+        valence = self.valences.get(token)
+        if valence is None:
+            return 0.0
+        # a negation in the three preceding words flips the valence
+        if any(word in self.negations for word in window):
+            valence = -valence * 0.74
+        if window and window[-1] in self.intensifiers:
+            valence *= self.intensifiers[window[-1]]
+        return valence
+
+    def normalize(self, total):
+        return total / math.sqrt(total * total + ALPHA)
+
+    def mood(self, score):
+        if score >= POSITIVE:
+            return 'positive'
+        if score <= NEGATIVE:
+            return 'negative'
+        return 'neutral'
+
+    def is_keyword(self, token):
+        return len(token) > 2 and token not in self.stopwords
+
+    def top(self, counts):
+        # most frequent first, ties in alphabetical order
+        ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        return [word[:KEYWORD_LENGTH] for word, _ in ranked[:KEYWORDS]]
+
+    def analyze(self, text):
+        """
+        Analyzes a text given whole or as an iterable of chunks, which
+        lets very large bodies be read incrementally
+        :param text: str, None or iterable of str
+        :return: dict
+        """
+        if text is None or isinstance(text, str):
+            text = [text or '']
+        analysis = Analysis(self)
+        for chunk in text:
+            analysis.feed(chunk)
+        return analysis.result()
+
+    def analyze_many(self, texts):
+        return [self.analyze(text) for text in texts]
+
+
+class Analysis:
+    """
+    Running analysis of a text fed chunk by chunk, only the distinct
+    words and a partial word at the end of the last chunk are kept
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.total = 0.0
+        self.words = 0
+        self.unique = set()
+        self.counts = Counter()
+        self.window = deque(maxlen=3)
+        self.carry = ''
+
+    def feed(self, chunk):
+        text = self.carry + chunk.lower()
+        # hold back a word that may go on in the next chunk
+        end = len(text)
+        while end and text[end - 1] in TOKEN_CHARS:
+            end -= 1
+        self.carry = text[end:]
+        self._tokens(TOKEN_RE.findall(text, 0, end))
+
+    def _tokens(self, tokens):
+        engine = self.engine
+        for token in tokens:
+            self.total += engine.valence(token, self.window)
+            self.window.append(token)
+            self.words += 1
+            self.unique.add(token)
+            if engine.is_keyword(token):
+                self.counts[token] += 1
+
+    def result(self):
+        self._tokens(TOKEN_RE.findall(self.carry))
+        self.carry = ''
+        engine = self.engine
+        score = engine.normalize(self.total)
+        return {
+            'mood': engine.mood(score),
+            'sentiment': round(score, 4),
+            'words': self.words,
+            'unique_words': len(self.unique),
+            'keywords': engine.top(self.counts),
+        }
+
+
+def load_valences(path):
+    valences = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            word, _, score = line.rstrip('\n').rpartition('\t')
+            if word:
+                valences[word] = float(score)
+    return valences
+
+
+@functools.lru_cache(maxsize=None)
+def get_engine(lexicon_path=None):
+    # loaded once per process, workers warm it on startup
+    if lexicon_path:
+        valences = load_valences(lexicon_path)
+    else:
+        valences = lexicon.VALENCES
+    return TextEngine(
+        valences, lexicon.NEGATIONS, lexicon.INTENSIFIERS, lexicon.STOPWORDS
+    )
+
+
+def dumps(analysis):
+    # compact form stored in Diary.result
+    return json.dumps(analysis, separators=(',', ':'))
@@ -0,0 +1,230 @@
+"""
+Fair share scheduling of diary processing.
+
+New diaries are interactive work, the dispatcher sends them to their
+queue as soon as they are committed. Diaries of /api/diary/bulk are
+backfill work: they wait in the outbox and the relay releases them to
+a queue of their own, only while fewer than SCHEDULER_BACKFILL_IN_FLIGHT
+diaries are being processed and taking turns between users, so one
+large import cannot hold back everyone else's results. Releases run one
+at a time and keep the turns in scheduler_turns, so the cap and the
+turns hold whichever worker process runs the relay.
+"""
+import datetime
+from collections import deque
+
+from flask import current_app
+
+import metrics
+from extensions import db
+from diary.models import Diary, DiaryOutbox, SchedulerTurn
+
+INTERACTIVE = 'interactive'
+BACKFILL = 'backfill'
+# celery queue of each kind of work
+QUEUES = {
+    INTERACTIVE: 'diaries-interactive',
+    BACKFILL: 'diaries-backfill',
+}
+
+
+class FairShare:
+    """
+    Deficit round robin over users. On each turn a user's deficit grows
+    by quantum and their oldest diaries are released while it covers
+    their length, so users get the same share of characters processed
+    whatever the number or the size of their diaries. Users with nothing
+    left leave the round and lose their credit.
+    """
+
+    def __init__(self, quantum, order=(), deficits=None, serving=False):
+        self.quantum = quantum
+        self.order = deque(order)
+        self.deficits = dict(deficits or {})
+        # the user in front is in the middle of a turn
+        self.serving = serving
+
+    def select(self, pending, capacity):
+        """
+        :param pending: {user_id: (list of (diary_id, cost) oldest first, depth)}
+        :param capacity: most diaries to release
+        :return: diary ids in the order they should be served
+        """
+        if self.order and self.order[0] not in pending:
+            self.serving = False
+        self.order = deque(user_id for user_id in self.order if user_id in pending)
+        self.deficits = {user_id: self.deficits[user_id] for user_id in self.order}
+        for user_id in sorted(pending):
+            if user_id not in self.deficits:
+                self.order.append(user_id)
+                self.deficits[user_id] = 0
+
+        queues = {user_id: deque(items) for user_id, (items, _) in pending.items()}
+        left = {user_id: depth for user_id, (_, depth) in pending.items()}
+        remaining = sum(len(items) for items in queues.values())
+        chosen = []
+        while remaining and len(chosen) < capacity:
+            user_id = self.order[0]
+            items = queues[user_id]
+            if not self.serving:
+                self.deficits[user_id] += self.quantum
+                self.serving = True
+            while items and len(chosen) < capacity and items[0][1] <= self.deficits[user_id]:
+                diary_id, cost = items.popleft()
+                self.deficits[user_id] -= cost
+                left[user_id] -= 1
+                remaining -= 1
+                chosen.append(diary_id)
+            if items and items[0][1] <= self.deficits[user_id]:
+                # out of capacity, the turn goes on next time
+                break
+            self.serving = False
+            if left[user_id]:
+                self.order.rotate(-1)
+            else:
+                self.order.popleft()
+                del self.deficits[user_id]
+        return chosen
+
+
+def pending(limit):
+    """
+    The oldest limit backfill diaries of every user
+    :return: {user_id: (list of (diary_id, cost), depth)}, {diary_id: queued at}
+    """
+    ranked = db.session.query(
+        DiaryOutbox.diary_id, DiaryOutbox.created_on, Diary.user_id, Diary.text_length,
+        db.func.row_number().over(
+            partition_by=Diary.user_id, order_by=DiaryOutbox.id
+        ).label('rank'),
+        db.func.count().over(partition_by=Diary.user_id).label('depth'),
+    ).join(
+        Diary, Diary.id == DiaryOutbox.diary_id
+    ).filter(DiaryOutbox.backfill == True).subquery()
+    rows = db.session.query(ranked).filter(
+        ranked.c.rank <= limit
+    ).order_by(ranked.c.user_id, ranked.c.rank)
+    users = {}
+    queued = {}
+    for row in rows:
+        items, _ = users.setdefault(row.user_id, ([], row.depth))
+        # the length of the body is the work it takes, empty ones still count
+        items.append((row.diary_id, max(1, row.text_length or 0)))
+        queued[row.diary_id] = row.created_on
+    return users, queued
+
+
+def backlog(backfill, limit):
+    """
+    Waiting diaries of a queue
+    :param backfill:
+    :param limit: users reported, the ones with the most waiting
+    :return: dict with the depth and the users with their depth and oldest wait
+    """
+    now = datetime.datetime.now()
+    base = db.session.query(DiaryOutbox).filter(DiaryOutbox.backfill == backfill)
+    depth = base.count()
+    users = db.session.query(
+        Diary.user_id, db.func.count().label('depth'),
+        db.func.min(DiaryOutbox.created_on).label('oldest')
+    ).join(
+        Diary, Diary.id == DiaryOutbox.diary_id
+    ).filter(
+        DiaryOutbox.backfill == backfill
+    ).group_by(Diary.user_id).order_by(db.desc('depth'), Diary.user_id).limit(limit)
+    return {
+        'depth': depth,
+        'users': [
+            {
+                'user_id': user_id,
+                'depth': count,
+                'oldest_wait': max(0.0, (now - oldest).total_seconds()),
+            }
+            for user_id, count, oldest in users
+        ],
+    }
+
+
+def report():
+    """
+    Updates the queue gauges
+    :return: backlog() of both queues with the diaries in flight
+    """
+    limit = current_app.config.get('SCHEDULER_TOP_USERS')
+    data = {}
+    for queue in QUEUES:
+        data[queue] = backlog(queue == BACKFILL, limit)
+        metrics.DIARY_QUEUE_DEPTH.set(data[queue]['depth'], queue=queue)
+        metrics.DIARY_QUEUE_USER_DEPTH.replace({
+            (queue, user['user_id']): user['depth'] for user in data[queue]['users']
+        }, queue=queue)
+        metrics.DIARY_QUEUE_USER_OLDEST_SECONDS.replace({
+            (queue, user['user_id']): user['oldest_wait'] for user in data[queue]['users']
+        }, queue=queue)
+    data['in_flight'] = Diary.in_flight().scalar()
+    metrics.DIARY_IN_FLIGHT.set(data['in_flight'])
+    return data
+
+
+class Scheduler:
+    """
+    Releases backfill diaries from the outbox
+    """
+
+    def release(self, publish):
+        """
+        Fills the free backfill capacity in a single transaction, from
+        counting the diaries in flight to marking the released ones
+        dispatched, under the lock of scheduler_turns. The caller commits
+        nothing. When a batch fails the release is rolled back and the
+        batches already published are released again later.
+        :param publish: publish(ids, queue) sends one batch
+        :return: number of diaries released
+        """
+        config = current_app.config
+        try:
+            SchedulerTurn.lock()
+            # interactive diaries count as well, backfill only gets spare capacity
+            capacity = config.get('SCHEDULER_BACKFILL_IN_FLIGHT') - Diary.in_flight().scalar()
+            if capacity <= 0:
+                db.session.rollback()
+                return 0
+            users, queued = pending(capacity)
+            fair_share = FairShare(config.get('SCHEDULER_QUANTUM'), *SchedulerTurn.load())
+            chosen = fair_share.select(users, capacity)
+            released = self.relay(publish, chosen, queued, config.get('SCHEDULER_BACKFILL_BATCH_SIZE'))
+            SchedulerTurn.save(fair_share.order, fair_share.deficits, fair_share.serving)
+            db.session.commit()
+            return released
+        except Exception:
+            db.session.rollback()
+            raise
+
+    @staticmethod
+    def relay(publish, chosen, queued, batch_size):
+        # sends chosen in batches, the outbox rows are claimed in the caller's transaction
+        position = {diary_id: i for i, diary_id in enumerate(chosen)}
+
+        def send(ids):
+            # claimed in outbox order, published in turn order
+            ids = sorted(ids, key=position.get)
+            publish(ids, BACKFILL)
+            now = datetime.datetime.now()
+            for diary_id in ids:
+                metrics.DIARY_QUEUE_WAIT_SECONDS.observe(
+                    max(0.0, (now - queued[diary_id]).total_seconds()), queue=BACKFILL
+                )
+
+        released = 0
+        for start in range(0, len(chosen), batch_size):
+            batch = chosen[start:start + batch_size]
+            rows = DiaryOutbox.claim(len(batch), diary_ids=batch, backfill=True)
+            if not rows:
+                continue
+            send([row.diary_id for row in rows])
+            DiaryOutbox.sent(rows)
+            released += len(rows)
+        return released
+
+
+scheduler = Scheduler()
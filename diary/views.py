@@ -1,232 +1,454 @@
-from flask import Blueprint, request, make_response, jsonify
-from flask.views import MethodView
+import datetime
+import time
 
-import jwt
+from flask import Blueprint, request, make_response, jsonify, g, Response, stream_with_context
+from flask.views import MethodView
 
-from app import app, bcrypt, db
-from diary.models import Diary
-from auth.models import User, BlacklistToken
+import conditional
+from app import app, db
+from diary.models import Diary, DiaryOutbox, UserStats, UserStatsDaily
+from diary import export, ingest, pagination, scheduler
+from diary.events import events, catch_up
+from auth.decorators import login_required
 
-from tasks import process_diary
+from diary.dispatch import dispatcher
+from tasks import release_backfill
 
 diary_blueprint = Blueprint('diary', __name__)
 
 class DiariesAPI(MethodView):
 
-    def get(self):
-        # get the auth token
-        auth_header = request.headers.get('Authorization')
-        if auth_header:
-            try:
-                auth_token = auth_header
-            except IndexError:
-                responseObject = {
-                    'status': 'fail',
-                    'message': 'Bearer token malformed.'
-                }
-                return make_response(jsonify(responseObject)), 401
-        else:
-            auth_token = ''
-        if auth_token:
-            resp = User.decode_auth_token(auth_token)
-            if not isinstance(resp, str):
-                user = User.query.filter_by(id=resp).first()
+    decorators = [login_required]
 
-                if user.admin:
-                    diaries = Diary.query.all()
-                else:
-                    diaries = Diary.query.filter_by(user_id=resp)
+    def ndjson(self, diaries):
+        # one JSON document per line
+        for diary in diaries:
+            yield app.json.dumps(Diary.row_json(diary)) + '\n'
 
-                responseObject = {
-                    'status': 'success',
-                    'data': [diary.myjson() for diary in diaries]
-                }
-                return make_response(jsonify(responseObject)), 200
+    def json_array(self, diaries):
+        # same shape as the paginated response, sent in chunks
+        yield '{"status": "success", "data": ['
+        separator = ''
+        for diary in diaries:
+            yield separator + app.json.dumps(Diary.row_json(diary))
+            separator = ', '
+        yield ']}'
+
+    def get(self):
+        # plain rows, listings never need Diary objects
+        query = Diary.query.with_entities(*Diary.json_columns())
+        if not g.principal.admin:
+            query = query.filter(Diary.user_id == g.principal.id)
+
+        cursor = request.args.get('cursor')
+        mode = request.args.get('stream')
+        try:
+            if cursor:
+                pagination.decode_cursor(cursor)
+            if mode and 'limit' not in request.args:
+                limit = None
+            else:
+                limit = pagination.parse_limit(request.args.get('limit'))
+        except ValueError as e:
             responseObject = {
                 'status': 'fail',
-                'message': resp
+                'message': str(e)
             }
-            return make_response(jsonify(responseObject)), 401
-        else:
+            return make_response(jsonify(responseObject)), 400
+
+        if mode:
+            diaries = pagination.stream(query, Diary, cursor, limit)
+            if mode == 'ndjson':
+                return Response(
+                    stream_with_context(self.ndjson(diaries)),
+                    mimetype='application/x-ndjson'
+                )
+            if mode == 'json':
+                return Response(
+                    stream_with_context(self.json_array(diaries)),
+                    mimetype='application/json'
+                )
             responseObject = {
                 'status': 'fail',
-                'message': 'Provide a valid auth token.'
+                'message': 'Unknown stream mode.'
             }
-            return make_response(jsonify(responseObject)), 401
+            return make_response(jsonify(responseObject)), 400
+
+        diaries, next_cursor = pagination.paginate(query, Diary, cursor, limit)
+        # the page changes exactly when one of its rows or its end does
+        etag = conditional.make_etag('diaries', next_cursor, *(
+            '{}:{}'.format(diary.id, diary.updated_on) for diary in diaries
+        ))
+        last_modified = max((diary.updated_on for diary in diaries), default=None)
+        response = conditional.not_modified(etag, last_modified)
+        if response is not None:
+            return response
+        responseObject = {
+            'status': 'success',
+            'data': [Diary.row_json(diary) for diary in diaries],
+            'next_cursor': next_cursor
+        }
+        response = make_response(jsonify(responseObject))
+        return conditional.add_validators(response, etag, last_modified), 200
 
 class DiaryAPI(MethodView):
 
-    def get(self, diary_id):
-        # get the auth token
-        auth_header = request.headers.get('Authorization')
-        if auth_header:
-            try:
-                auth_token = auth_header
-            except IndexError:
-                responseObject = {
-                    'status': 'fail',
-                    'message': 'Bearer token malformed.'
-                }
-                return make_response(jsonify(responseObject)), 401
-        else:
-            auth_token = ''
-        if auth_token:
-            resp = User.decode_auth_token(auth_token)
-            if not isinstance(resp, str):
-                user = User.query.filter_by(id=resp).first()
-                diary = Diary.query.filter_by(id=diary_id).first()
-                if diary is None:
-                    responseObject = {
-                        'status': 'fail',
-                        'data': 'A diary with this id does not exist.'
-                        }
-                    return make_response(jsonify(responseObject)), 404
-                if user.admin or diary.user_id == user.id:
-                    diary = Diary.query.filter_by(id=diary_id).first()
-                    responseObject = {
-                        'status': 'success',
-                        'data': diary.myjson()
-                        }
-                    return make_response(jsonify(responseObject)), 200
-                else:
-                    responseObject = {
-                        'status': 'fail',
-                        'message': 'Authorization failed.'
-                    }
-                    return make_response(jsonify(responseObject)), 401
+    decorators = [login_required]
 
+    def get(self, diary_id):
+        # the body is deferred, a 304 never loads it
+        diary = db.session.get(Diary, diary_id)
+        if diary is None:
             responseObject = {
                 'status': 'fail',
-                'message': resp
-            }
-            return make_response(jsonify(responseObject)), 401
+                'data': 'A diary with this id does not exist.'
+                }
+            return make_response(jsonify(responseObject)), 404
+        if g.principal.admin or diary.user_id == g.principal.id:
+            etag = conditional.make_etag('diary', diary.id, diary.updated_on)
+            response = conditional.not_modified(etag, diary.updated_on)
+            if response is not None:
+                return response
+            responseObject = {
+                'status': 'success',
+                'data': diary.myjson()
+                }
+            response = make_response(jsonify(responseObject))
+            return conditional.add_validators(response, etag, diary.updated_on), 200
         else:
             responseObject = {
                 'status': 'fail',
-                'message': 'Provide a valid auth token.'
+                'message': 'Authorization failed.'
             }
             return make_response(jsonify(responseObject)), 401
 
 class DiaryCreateAPI(MethodView):
 
+    decorators = [login_required]
+
     def post(self):
         # get the post data
         post_data = request.get_json()
-        # get the auth token
-        auth_header = request.headers.get('Authorization')
-        if auth_header:
-            try:
-                auth_token = auth_header
-            except IndexError:
-                responseObject = {
-                    'status': 'fail',
-                    'message': 'Bearer token malformed.'
-                }
-                return make_response(jsonify(responseObject)), 401
-        else:
-            auth_token = ''
-        if auth_token:
-            resp = User.decode_auth_token(auth_token)
-            if not isinstance(resp, str):
-
-                if User.query.filter_by(id=resp).first() is None:
-                    responseObject = {
-                        'status': 'fail',
-                        'data': 'No such user.'
-                        }
-                    return make_response(jsonify(responseObject)), 404
-                try:
-                    diary = Diary(
-                        text=post_data.get('text'),
-                        user_id=resp,
-                        in_progress=True
-                    )
-                    # insert the diary
-                    db.session.add(diary)
-                    db.session.commit()
-
-                    process_diary.delay(diary.id)
-
-                    responseObject = {
-                        'status': 'success',
-                        'message': 'Diary successfully created.',
-                        'diary_id': diary.id
-                    }
-                    return make_response(jsonify(responseObject)), 201
-                except Exception as e:
-                    responseObject = {
-                        'status': 'fail',
-                        'message': 'Some error occurred. Please try again.',
-                    }
-                    return make_response(jsonify(responseObject)), 401
+        # same checks as the items of a bulk import
+        text = post_data.get('text') if isinstance(post_data, dict) else None
+        value, error = ingest.validate({'text': text}, app.config.get('DIARY_TEXT_MAX_LENGTH'))
+        if error:
+            responseObject = {
+                'status': 'fail',
+                'message': error
+            }
+            return make_response(jsonify(responseObject)), 400
+        try:
+            diary = Diary(
+                text=value[0],
+                user_id=g.principal.id,
+                in_progress=True
+            )
+            # insert the diary and its outbox row in one transaction
+            db.session.add(diary)
+            db.session.flush()
+            db.session.add(DiaryOutbox(diary.id))
+            db.session.commit()
+
+            dispatcher.submit(diary.id)
 
+            responseObject = {
+                'status': 'success',
+                'message': 'Diary successfully created.',
+                'diary_id': diary.id
+            }
+            return make_response(jsonify(responseObject)), 201
+        except Exception as e:
             responseObject = {
                 'status': 'fail',
-                'message': resp
+                'message': 'Some error occurred. Please try again.',
             }
             return make_response(jsonify(responseObject)), 401
+
+class DiaryBulkAPI(MethodView):
+    """
+    Creates many diaries from a JSON array or, with Content-Type
+    application/x-ndjson, from one JSON object per line. Items are read
+    as they arrive and committed BULK_CHUNK_SIZE at a time, ids[i] is
+    the id of item i or null when it failed, see errors. They are
+    processed as backfill, see diary.scheduler.
+    """
+
+    decorators = [login_required]
+
+    def post(self):
+        max_body = app.config.get('MAX_CONTENT_LENGTH')
+        if max_body and (request.content_length or 0) > max_body:
+            responseObject = {
+                'status': 'fail',
+                'message': 'Body must be at most {} bytes.'.format(max_body)
+            }
+            return make_response(jsonify(responseObject)), 413
+        max_item_size = app.config.get('BULK_MAX_ITEM_SIZE')
+        if request.mimetype == 'application/x-ndjson':
+            items = ingest.ndjson_items(request.stream, max_item_size)
         else:
+            items = ingest.json_array_items(request.stream, max_item_size)
+        chunk_size = app.config.get('BULK_CHUNK_SIZE')
+        max_length = app.config.get('DIARY_TEXT_MAX_LENGTH')
+        ids = []
+        errors = []
+        chunk = []
+        message = None
+        try:
+            for index, (item, error) in enumerate(items):
+                ids.append(None)
+                if error is None:
+                    value, error = ingest.validate(item, max_length)
+                if error is not None:
+                    errors.append({'index': index, 'message': error})
+                    continue
+                chunk.append((index, value))
+                if len(chunk) >= chunk_size:
+                    self.insert(chunk, ids, errors)
+                    chunk = []
+        except ingest.MalformedBody as e:
+            message = str(e)
+        self.insert(chunk, ids, errors)
+
+        created = len(ids) - len(errors)
+        if created:
+            release_backfill()
+        responseObject = {
+            'status': 'fail' if message else 'success',
+            'message': message or 'Created {} diaries.'.format(created),
+            'created': created,
+            'failed': len(errors),
+            'ids': ids,
+            'errors': sorted(errors, key=lambda error: error['index'])
+        }
+        return make_response(jsonify(responseObject)), 400 if message else 201
+
+    def insert(self, chunk, ids, errors):
+        # one transaction per chunk, the scheduler releases them later
+        if not chunk:
+            return
+        try:
+            new_ids = Diary.insert_many(
+                g.principal.id, [value for _, value in chunk], backfill=True
+            )
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            errors.extend(
+                {'index': index, 'message': 'Some error occurred. Please try again.'}
+                for index, _ in chunk
+            )
+            return
+        for (index, _), id in zip(chunk, new_ids):
+            ids[index] = id
+
+class DiaryEventsAPI(MethodView):
+    """
+    Server-sent events of processed diaries, for the diaries in ?ids=1,2,3
+    or for all of the user's diaries. Connections last at most
+    EVENTS_MAX_AGE seconds, clients reconnect with Last-Event-ID.
+    Catch-ups re-read EVENTS_CATCH_UP_LAG seconds before the last event,
+    so a diary may be sent again after a reconnect, never skipped.
+    """
+
+    decorators = [login_required]
+
+    def get(self):
+        try:
+            ids = request.args.get('ids')
+            diary_ids = {int(id) for id in ids.split(',')} if ids else None
+            since = request.headers.get('Last-Event-ID')
+            since = datetime.datetime.fromisoformat(since) if since else None
+        except ValueError:
             responseObject = {
                 'status': 'fail',
-                'message': 'Provide a valid auth token.'
+                'message': 'Invalid diary ids or event id.'
             }
-            return make_response(jsonify(responseObject)), 401
+            return make_response(jsonify(responseObject)), 400
+        if since is None and diary_ids is None:
+            # a user wide stream starts now
+            since = datetime.datetime.utcnow()
+        # admins may follow any diary by id, everyone else only their own
+        user_id = None if g.principal.admin and diary_ids else g.principal.id
+        return Response(
+            stream_with_context(self.stream(user_id, diary_ids, since)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+    def stream(self, user_id, diary_ids, since):
+        config = app.config
+        deadline = time.monotonic() + config.get('EVENTS_MAX_AGE')
+        sent = {}
+        # subscribed once the body is read, and before catching up so
+        # nothing falls in between
+        with events.subscribe(user_id, diary_ids) as subscription:
+            yield 'retry: {}\n\n'.format(config.get('EVENTS_RETRY_MS'))
+            messages = self.catch_up(subscription, since, sent)
+            while True:
+                for message in messages:
+                    # the same version may come from the broker and the database
+                    if sent.get(message['id']) == message['updated_on']:
+                        continue
+                    sent[message['id']] = message['updated_on']
+                    updated_on = datetime.datetime.fromisoformat(message['updated_on'])
+                    since = updated_on if since is None else max(since, updated_on)
+                    yield 'id: {}\nevent: diary\ndata: {}\n\n'.format(
+                        since.isoformat(), app.json.dumps(message)
+                    )
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                message = subscription.get(min(remaining, config.get('EVENTS_HEARTBEAT')))
+                if message is not None:
+                    messages = [message]
+                    continue
+                yield ': keepalive\n\n'
+                messages = []
+                if not events.shared or subscription.overflowed:
+                    # this process may not see every result, ask the database
+                    subscription.overflowed = False
+                    messages = self.catch_up(subscription, since, sent)
+
+    def catch_up(self, subscription, since, sent):
+        if since is not None:
+            # updated_on is set before the commit, a diary committed late
+            # can be older than one already sent
+            since -= datetime.timedelta(seconds=app.config.get('EVENTS_CATCH_UP_LAG'))
+            # versions older than that are never read again
+            cutoff = since.isoformat()
+            for id in [id for id, updated_on in sent.items() if updated_on <= cutoff]:
+                del sent[id]
+        try:
+            return catch_up(subscription.user_id, subscription.diary_ids, since)
+        finally:
+            # never hold a connection while waiting for events
+            db.session.close()
 
 class StatsAPI(MethodView):
 
-    def stats(self, diaries):
-        # Return stats object from a list of diaries of a user
-        return 'stats'
+    decorators = [login_required]
 
     def get(self):
-        # get the auth token
-        auth_header = request.headers.get('Authorization')
-        if auth_header:
+        start = request.args.get('from')
+        end = request.args.get('to')
+        if start is None and end is None:
+            stats = db.session.get(UserStats, g.principal.id)
+            data = stats.myjson() if stats else None
+        else:
             try:
-                auth_token = auth_header
-            except IndexError:
+                start = datetime.date.fromisoformat(start) if start else datetime.date.min
+                end = datetime.date.fromisoformat(end) if end else datetime.date.max
+            except ValueError:
                 responseObject = {
                     'status': 'fail',
-                    'message': 'Bearer token malformed.'
+                    'message': 'Dates must be in YYYY-MM-DD format.'
                 }
-                return make_response(jsonify(responseObject)), 401
-        else:
-            auth_token = ''
-        if auth_token:
-            resp = User.decode_auth_token(auth_token)
-            if not isinstance(resp, str):
-
-                if User.query.filter_by().first() is None:
-                    responseObject = {
-                        'status': 'fail',
-                        'data': 'No such user.'
-                        }
-                    return make_response(jsonify(responseObject)), 404
-                diaries = Diary.query.filter_by(user_id=resp).all()
-                if diaries == []:
-                    responseObject = {
-                        'status': 'fail',
-                        'data': 'This user has no diaries.'
-                        }
-                    return make_response(jsonify(responseObject)), 404
+                return make_response(jsonify(responseObject)), 400
+            bucket = request.args.get('bucket', 'day')
+            if bucket not in ('day', 'week'):
                 responseObject = {
-                    'status': 'success',
-                    'data': self.stats(diaries)
-                    }
-                return make_response(jsonify(responseObject)), 200
+                    'status': 'fail',
+                    'message': 'Bucket must be day or week.'
+                }
+                return make_response(jsonify(responseObject)), 400
+            data = UserStatsDaily.summary(g.principal.id, start, end, bucket)
+        if data is None:
+            responseObject = {
+                'status': 'fail',
+                'data': 'This user has no diaries.'
+                }
+            return make_response(jsonify(responseObject)), 404
+        responseObject = {
+            'status': 'success',
+            'data': data
+            }
+        return make_response(jsonify(responseObject)), 200
+
+
+class DiaryExportAPI(MethodView):
+    """
+    Admin export of diaries as csv, parquet or arrow, optionally of one
+    ?user_id= and ?from=/?to= days of creation. The X-Export-Watermark
+    header is the ?since= of the next incremental export, ?text=0
+    exports previews instead of bodies. Days and created_on are in
+    server local time, the watermark and updated_on in utc.
+    """
 
+    decorators = [login_required]
+
+    def get(self):
+        if not g.principal.admin:
             responseObject = {
                 'status': 'fail',
-                'message': resp
+                'message': 'Authorization failed.'
             }
             return make_response(jsonify(responseObject)), 401
-        else:
+
+        format = request.args.get('format', 'csv')
+        text = request.args.get('text', '1') != '0'
+        try:
+            user_id = request.args.get('user_id')
+            try:
+                user_id = int(user_id) if user_id else None
+            except ValueError:
+                raise ValueError('User id must be an integer.')
+            start = request.args.get('from')
+            end = request.args.get('to')
+            try:
+                start = datetime.date.fromisoformat(start) if start else None
+                end = datetime.date.fromisoformat(end) if end else None
+            except ValueError:
+                raise ValueError('Dates must be in YYYY-MM-DD format.')
+            since = export.parse_watermark(request.args.get('since'))
+            if format not in export.FORMATS:
+                raise ValueError('Format must be one of {}.'.format(', '.join(export.FORMATS)))
+        except ValueError as e:
             responseObject = {
                 'status': 'fail',
-                'message': 'Provide a valid auth token.'
+                'message': str(e)
             }
-            return make_response(jsonify(responseObject)), 401
+            return make_response(jsonify(responseObject)), 400
+        if not export.available(format):
+            responseObject = {
+                'status': 'fail',
+                'message': 'The {} format is not available on this server.'.format(format)
+            }
+            return make_response(jsonify(responseObject)), 501
+
+        upto = export.watermark(app.config.get('EXPORT_WATERMARK_LAG'), since)
+        batch_size = app.config.get('EXPORT_BATCH_SIZE')
+        rows = export.query(upto, user_id, start, end, since, text, batch_size)
+        response = Response(
+            stream_with_context(export.chunks(format, rows, export.column_names(text), batch_size)),
+            mimetype=export.MIMETYPES[format]
+        )
+        response.headers['X-Export-Watermark'] = upto.isoformat()
+        response.headers['Content-Disposition'] = 'attachment; filename=diaries.{}'.format(format)
+        return response
+
+
+class DiaryQueueAPI(MethodView):
+    """
+    Admin view of the processing queues: waiting diaries per queue and
+    of the users with the most, with the age of their oldest one.
+    """
 
+    decorators = [login_required]
+
+    def get(self):
+        if not g.principal.admin:
+            responseObject = {
+                'status': 'fail',
+                'message': 'Authorization failed.'
+            }
+            return make_response(jsonify(responseObject)), 401
+        responseObject = {
+            'status': 'success',
+            'data': scheduler.report()
+        }
+        return make_response(jsonify(responseObject)), 200
 
 
 # define the API resources
@@ -234,6 +456,10 @@ diaries_view = DiariesAPI.as_view('diaries_api')
 diary_view = DiaryAPI.as_view('diary_api')
 diary_create_view = DiaryCreateAPI.as_view('diary_create_api')
 stats_view = StatsAPI.as_view('stats_api')
+diary_events_view = DiaryEventsAPI.as_view('diary_events_api')
+diary_bulk_view = DiaryBulkAPI.as_view('diary_bulk_api')
+diary_export_view = DiaryExportAPI.as_view('diary_export_api')
+diary_queue_view = DiaryQueueAPI.as_view('diary_queue_api')
 
 
 # add Rules for API Endpoints
@@ -243,7 +469,7 @@ diary_blueprint.add_url_rule(
     methods=['GET']
 )
 diary_blueprint.add_url_rule(
-    '/api/diary/<diary_id>',
+    '/api/diary/<int:diary_id>',
     view_func=diary_view,
     methods=['GET']
 )
@@ -257,3 +483,23 @@ diary_blueprint.add_url_rule(
     view_func=stats_view,
     methods=['GET']
 )
+diary_blueprint.add_url_rule(
+    '/api/diary/events',
+    view_func=diary_events_view,
+    methods=['GET']
+)
+diary_blueprint.add_url_rule(
+    '/api/diary/bulk',
+    view_func=diary_bulk_view,
+    methods=['POST']
+)
+diary_blueprint.add_url_rule(
+    '/api/diary/export',
+    view_func=diary_export_view,
+    methods=['GET']
+)
+diary_blueprint.add_url_rule(
+    '/api/diary/queue',
+    view_func=diary_queue_view,
+    methods=['GET']
+)
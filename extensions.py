@@ -0,0 +1,6 @@
+from flask_bcrypt import Bcrypt
+from flask_sqlalchemy import SQLAlchemy
+
+# bound to the API app in app.py and to the worker app in worker.py
+db = SQLAlchemy()
+bcrypt = Bcrypt()
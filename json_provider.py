@@ -0,0 +1,50 @@
+import datetime
+import json
+import uuid
+
+from flask.json.provider import JSONProvider
+
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(o):
+    # the same representations with and without orjson
+    if isinstance(o, (datetime.date, datetime.time)):
+        return o.isoformat()
+    if isinstance(o, uuid.UUID):
+        return str(o)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(o).__name__))
+
+
+class FastJSONProvider(JSONProvider):
+    """
+    JSON provider using orjson when it is installed and the standard
+    library otherwise, datetimes are always ISO 8601
+    """
+
+    mimetype = 'application/json'
+
+    def dumps(self, obj, **kwargs):
+        return self.dumps_bytes(obj, **kwargs).decode()
+
+    def dumps_bytes(self, obj, **kwargs):
+        with metrics.timed('serialize'):
+            if orjson is not None and not kwargs:
+                return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+            kwargs.setdefault('default', default)
+            kwargs.setdefault('separators', (',', ':'))
+            return json.dumps(obj, **kwargs).encode()
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj), mimetype=self.mimetype)
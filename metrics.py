@@ -0,0 +1,376 @@
+"""
+Instrumentation: per-request query counts and phase timings, Celery
+task durations and queue latency, rendered in the Prometheus text
+format. Every process keeps its own registry.
+"""
+import ipaddress
+import threading
+import time
+from collections import Counter as Tally
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# phases of a request timed with timed(), besides the SQL time in 'db'
+PHASES = ('db', 'serialize', 'hash', 'jwt')
+
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# waits of queued work, up to hours behind a large import
+WAITS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, 4 * 3600)
+COUNTS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    ) + '}'
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield self.name + _labels(self.labels, key), value
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=SECONDS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # key -> [count per bucket, sum, count]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(entry[0]), entry[1], entry[2]) for key, entry in self.values.items()}
+        names = self.labels + ('le',)
+        for key, (buckets, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, buckets):
+                cumulative += n
+                yield self.name + '_bucket' + _labels(names, key + (bound,)), cumulative
+            yield self.name + '_bucket' + _labels(names, key + ('+Inf',)), count
+            yield self.name + '_sum' + _labels(self.labels, key), total
+            yield self.name + '_count' + _labels(self.labels, key), count
+
+
+class Gauge:
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def set(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = value
+
+    def replace(self, values, **labels):
+        """
+        Replaces every series whose labels include labels, users that
+        left a top list must not linger
+        :param values: {tuple of all label values: value}
+        """
+        positions = [(self.labels.index(name), value) for name, value in labels.items()]
+        with self.lock:
+            self.values = {
+                key: value for key, value in self.values.items()
+                if not all(key[i] == expected for i, expected in positions)
+            }
+            self.values.update(values)
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items(), key=lambda item: tuple(map(str, item[0]))):
+            yield self.name + _labels(self.labels, key), value
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, *args, **kwargs):
+        return self._add(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self._add(Histogram(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self._add(Gauge(*args, **kwargs))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    'http_request_duration_seconds', 'Time to build a response.',
+    ('endpoint', 'method', 'status')
+)
+REQUEST_QUERIES = registry.histogram(
+    'http_request_queries', 'SQL statements per request.', ('endpoint',), COUNTS
+)
+REQUEST_PHASE_SECONDS = registry.histogram(
+    'http_request_phase_seconds', 'Time spent per phase of a request.', ('endpoint', 'phase')
+)
+QUERY_BUDGET_EXCEEDED = registry.counter(
+    'http_request_query_budget_exceeded_total',
+    'Requests that issued more than METRICS_QUERY_BUDGET statements.', ('endpoint',)
+)
+TASK_SECONDS = registry.histogram(
+    'celery_task_duration_seconds', 'Run time of Celery tasks.', ('task', 'state')
+)
+TASK_QUEUE_SECONDS = registry.histogram(
+    'celery_task_queue_latency_seconds', 'Time from publishing a task to its start.',
+    ('task', 'queue')
+)
+DIARY_QUEUE_DEPTH = registry.gauge(
+    'diary_queue_depth', 'Diaries waiting in the outbox.', ('queue',)
+)
+DIARY_QUEUE_USER_DEPTH = registry.gauge(
+    'diary_queue_user_depth', 'Diaries waiting in the outbox of the users with the most.',
+    ('queue', 'user')
+)
+DIARY_QUEUE_USER_OLDEST_SECONDS = registry.gauge(
+    'diary_queue_user_oldest_seconds', 'Age of the oldest waiting diary of the same users.',
+    ('queue', 'user')
+)
+DIARY_QUEUE_WAIT_SECONDS = registry.histogram(
+    'diary_queue_wait_seconds', 'Time diaries waited in the outbox before their release.',
+    ('queue',), WAITS
+)
+DIARY_IN_FLIGHT = registry.gauge(
+    'diary_in_flight', 'Diaries released to the workers and not processed yet.'
+)
+BLACKLIST_PURGED = registry.counter(
+    'blacklist_purged_total', 'Expired tokens deleted from the blacklist.'
+)
+BLACKLIST_PURGE_BATCHES = registry.counter(
+    'blacklist_purge_batches_total', 'Batches deleted by blacklist purges.'
+)
+BLACKLIST_PURGE_SECONDS = registry.histogram(
+    'blacklist_purge_duration_seconds', 'Run time of blacklist purges.'
+)
+BLACKLIST_TOKENS = registry.gauge(
+    'blacklist_tokens', 'Tokens left in the blacklist after the last purge.'
+)
+
+
+def current():
+    # the timings of the request being handled, if any
+    if not has_request_context():
+        return None
+    return g.get('_metrics')
+
+
+@contextmanager
+def timed(phase):
+    """
+    Adds the time spent in the block to phase of the current request,
+    does nothing outside requests
+    """
+    timings = current()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] += time.perf_counter() - started
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    timings = current()
+    if timings is None:
+        return
+    timings['db'] += elapsed
+    timings['queries'] += 1
+    if timings['statements'] is not None:
+        timings['statements'][statement] += 1
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    # after_cursor_execute never runs for a failed statement
+    if context.connection is not None:
+        started = context.connection.info.get('query_started')
+        if started:
+            started.pop()
+
+
+def start_request():
+    budget = current_app.config.get('METRICS_QUERY_BUDGET')
+    g._metrics = dict.fromkeys(PHASES, 0.0)
+    g._metrics['queries'] = 0
+    # statements are only remembered when someone will look at them
+    g._metrics['statements'] = Tally() if budget else None
+    g._metrics['started'] = time.perf_counter()
+
+
+def finish_request(response):
+    timings = g.pop('_metrics', None)
+    if timings is None:
+        return response
+    elapsed = time.perf_counter() - timings['started']
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUEST_SECONDS.observe(
+        elapsed, endpoint=endpoint, method=request.method, status=response.status_code
+    )
+    REQUEST_QUERIES.observe(timings['queries'], endpoint=endpoint)
+    for phase in PHASES:
+        REQUEST_PHASE_SECONDS.observe(timings[phase], endpoint=endpoint, phase=phase)
+
+    config = current_app.config
+    budget = config.get('METRICS_QUERY_BUDGET')
+    if budget and timings['queries'] > budget:
+        QUERY_BUDGET_EXCEEDED.inc(endpoint=endpoint)
+        statement, repeats = timings['statements'].most_common(1)[0]
+        current_app.logger.warning(
+            '%s %s issued %d queries (budget %d), the most repeated one %d times: %s',
+            request.method, endpoint, timings['queries'], budget, repeats,
+            ' '.join(statement.split())
+        )
+    if config.get('METRICS_SERVER_TIMING'):
+        response.headers['Server-Timing'] = ', '.join(
+            ['{};dur={:.3f}'.format(phase, timings[phase] * 1000) for phase in PHASES] +
+            ['queries;desc="{}"'.format(timings['queries']),
+             'total;dur={:.3f}'.format(elapsed * 1000)]
+        )
+    return response
+
+
+def allowed(address, networks):
+    """
+    :param address: remote address of the request
+    :param networks: comma separated networks, METRICS_ALLOW
+    """
+    try:
+        address = ipaddress.ip_address(address or '')
+    except ValueError:
+        return False
+    return any(
+        address in ipaddress.ip_network(network.strip(), strict=False)
+        for network in networks.split(',') if network.strip()
+    )
+
+
+def metrics_view():
+    # the series name users, only scrapers from METRICS_ALLOW may read them
+    if not allowed(request.remote_addr, current_app.config.get('METRICS_ALLOW') or ''):
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+
+def task_started(task):
+    task.request.metrics_started = time.perf_counter()
+    # stamped by the publisher, see tasks.stamp_published
+    published_at = getattr(task.request, 'published_at', None)
+    if published_at is not None:
+        queue = (task.request.delivery_info or {}).get('routing_key') or 'unknown'
+        TASK_QUEUE_SECONDS.observe(
+            max(0.0, time.time() - published_at), task=task.name, queue=queue
+        )
+
+
+def task_finished(task, state):
+    started = getattr(task.request, 'metrics_started', None)
+    if started is not None:
+        TASK_SECONDS.observe(time.perf_counter() - started, task=task.name, state=state or 'UNKNOWN')
+
+
+def serve(host, port, tries=32):
+    """
+    Serves registry.render() from a daemon thread on the first free
+    port from port on, Celery processes have no web server of their own
+    :return: the port
+    """
+    from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    def application(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+        return [registry.render().encode()]
+
+    for candidate in range(port, port + tries):
+        try:
+            server = make_server(host, candidate, application, handler_class=QuietHandler)
+        except OSError:
+            continue
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return candidate
+    raise OSError('No free port for metrics from {}.'.format(port))
@@ -0,0 +1,85 @@
+"""
+Alembic style schema migrations.
+
+Every module in migrations/versions defines revision, down_revision and
+upgrade(conn), revisions are applied in chain order and the current one
+is recorded in the schema_version table.
+"""
+import importlib
+import pkgutil
+
+import sqlalchemy as sa
+
+from migrations import versions
+
+version_table = sa.Table(
+    'schema_version', sa.MetaData(),
+    sa.Column('revision', sa.String(32), nullable=False),
+)
+
+
+def revisions():
+    # ordered list of revision modules, oldest first
+    modules = {}
+    for info in pkgutil.iter_modules(versions.__path__):
+        module = importlib.import_module('migrations.versions.' + info.name)
+        modules[module.down_revision] = module
+    chain = []
+    revision = None
+    while revision in modules:
+        module = modules.pop(revision)
+        chain.append(module)
+        revision = module.revision
+    if modules:
+        raise RuntimeError('Broken migration chain at {}'.format(
+            ', '.join(module.revision for module in modules.values())
+        ))
+    return chain
+
+
+def head():
+    return revisions()[-1].revision
+
+
+def current(conn):
+    inspector = sa.inspect(conn)
+    if inspector.has_table('schema_version'):
+        return conn.execute(sa.select(version_table.c.revision)).scalar()
+    if inspector.has_table('users'):
+        # databases created before migrations existed
+        return '0001'
+    return None
+
+
+def _set_revision(conn, revision):
+    version_table.create(conn, checkfirst=True)
+    conn.execute(version_table.delete())
+    conn.execute(version_table.insert().values(revision=revision))
+
+
+def upgrade(engine):
+    """
+    Applies every pending revision, each in its own transaction
+    :param engine:
+    :return: list of applied revisions
+    """
+    with engine.connect() as conn:
+        revision = current(conn)
+    pending = [module.revision for module in revisions()]
+    if revision is not None:
+        pending = pending[pending.index(revision) + 1:]
+    applied = []
+    for module in revisions():
+        if module.revision not in pending:
+            continue
+        with engine.begin() as conn:
+            module.upgrade(conn)
+            _set_revision(conn, module.revision)
+        applied.append(module.revision)
+    return applied
+
+
+def stamp(engine, revision=None):
+    # record a revision without running anything, defaults to head
+    with engine.begin() as conn:
+        _set_revision(conn, revision or head())
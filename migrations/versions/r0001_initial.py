@@ -0,0 +1,35 @@
+"""
+Initial schema
+"""
+import sqlalchemy as sa
+
+revision = '0001'
+down_revision = None
+
+
+def upgrade(conn):
+    metadata = sa.MetaData()
+    sa.Table(
+        'users', metadata,
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('email', sa.String(255), unique=True, nullable=False),
+        sa.Column('password', sa.String(255), nullable=False),
+        sa.Column('registered_on', sa.DateTime, nullable=False),
+        sa.Column('admin', sa.Boolean, nullable=False, default=False),
+    )
+    sa.Table(
+        'blacklist_tokens', metadata,
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('token', sa.String(500), unique=True, nullable=False),
+        sa.Column('blacklisted_on', sa.DateTime, nullable=False),
+    )
+    sa.Table(
+        'diaries', metadata,
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('text', sa.String(255), nullable=True),
+        sa.Column('user_id', sa.Integer, nullable=False),
+        sa.Column('in_progress', sa.Boolean, nullable=False, default=False),
+        sa.Column('result', sa.String(255), nullable=True),
+        sa.Column('created_on', sa.DateTime, nullable=False),
+    )
+    metadata.create_all(conn)
@@ -0,0 +1,34 @@
+"""
+Expiry column on blacklist_tokens, filled from the token claims
+"""
+import datetime
+
+import jwt
+import sqlalchemy as sa
+
+revision = '0002'
+down_revision = '0001'
+
+
+def upgrade(conn):
+    conn.execute(sa.text('ALTER TABLE blacklist_tokens ADD COLUMN exp TIMESTAMP'))
+    rows = conn.execute(sa.text('SELECT id, token FROM blacklist_tokens')).fetchall()
+    params = []
+    for id, token in rows:
+        try:
+            payload = jwt.decode(token, options={'verify_signature': False})
+            exp = datetime.datetime.utcfromtimestamp(payload['exp'])
+        except (jwt.InvalidTokenError, KeyError):
+            # unreadable tokens can never be valid again
+            exp = datetime.datetime.utcfromtimestamp(0)
+        params.append({'exp': exp, 'id': id})
+    if params:
+        conn.execute(
+            sa.text(
+                'UPDATE blacklist_tokens SET exp = :exp WHERE id = :id'
+            ).bindparams(sa.bindparam('exp', type_=sa.DateTime)),
+            params
+        )
+    conn.execute(sa.text(
+        'CREATE INDEX ix_blacklist_tokens_exp ON blacklist_tokens (exp)'
+    ))
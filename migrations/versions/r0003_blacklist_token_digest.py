@@ -0,0 +1,53 @@
+"""
+Replace raw tokens in blacklist_tokens with their sha256 digest
+"""
+import hashlib
+
+import sqlalchemy as sa
+
+revision = '0003'
+down_revision = '0002'
+
+
+def upgrade(conn):
+    # rebuilt rather than altered so it works on SQLite too
+    metadata = sa.MetaData()
+    new = sa.Table(
+        'blacklist_tokens_new', metadata,
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('token_hash', sa.String(64), unique=True, nullable=False),
+        sa.Column('blacklisted_on', sa.DateTime, nullable=False),
+        sa.Column('exp', sa.DateTime, nullable=False),
+    )
+    new.create(conn)
+    last_id = 0
+    while True:
+        batch = conn.execute(sa.text(
+            'SELECT id, token, blacklisted_on, exp FROM blacklist_tokens '
+            'WHERE id > :last_id ORDER BY id LIMIT 1000'
+        ).columns(
+            blacklisted_on=sa.DateTime, exp=sa.DateTime
+        ), {'last_id': last_id}).fetchall()
+        if not batch:
+            break
+        conn.execute(new.insert(), [
+            {
+                'id': id,
+                'token_hash': hashlib.sha256(token.encode()).hexdigest(),
+                'blacklisted_on': blacklisted_on,
+                'exp': exp,
+            }
+            for id, token, blacklisted_on, exp in batch
+        ])
+        last_id = batch[-1][0]
+    conn.execute(sa.text('DROP TABLE blacklist_tokens'))
+    conn.execute(sa.text('ALTER TABLE blacklist_tokens_new RENAME TO blacklist_tokens'))
+    conn.execute(sa.text(
+        'CREATE INDEX ix_blacklist_tokens_exp ON blacklist_tokens (exp)'
+    ))
+    if conn.dialect.name == 'postgresql':
+        # ids were copied explicitly, move the sequence past them
+        conn.execute(sa.text(
+            "SELECT setval(pg_get_serial_sequence('blacklist_tokens', 'id'), "
+            "COALESCE(MAX(id), 1)) FROM blacklist_tokens"
+        ))
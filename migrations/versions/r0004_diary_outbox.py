@@ -0,0 +1,16 @@
+"""
+Outbox for diary ids the broker could not take
+"""
+import sqlalchemy as sa
+
+revision = '0004'
+down_revision = '0003'
+
+
+def upgrade(conn):
+    sa.Table(
+        'diary_outbox', sa.MetaData(),
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('diary_id', sa.Integer, nullable=False),
+        sa.Column('created_on', sa.DateTime, nullable=False),
+    ).create(conn)
@@ -0,0 +1,14 @@
+"""
+Dispatch time on diaries, diary_id index on the outbox
+"""
+import sqlalchemy as sa
+
+revision = '0005'
+down_revision = '0004'
+
+
+def upgrade(conn):
+    conn.execute(sa.text('ALTER TABLE diaries ADD COLUMN dispatched_on TIMESTAMP'))
+    conn.execute(sa.text(
+        'CREATE INDEX ix_diary_outbox_diary_id ON diary_outbox (diary_id)'
+    ))
@@ -0,0 +1,38 @@
+"""
+Precomputed per user stats and daily rollups
+"""
+import sqlalchemy as sa
+
+revision = '0006'
+down_revision = '0005'
+
+
+def counters():
+    return [
+        sa.Column('diaries', sa.Integer, nullable=False, default=0),
+        sa.Column('words', sa.Integer, nullable=False, default=0),
+        sa.Column('sentiment_sum', sa.Float, nullable=False, default=0.0),
+        sa.Column('positive', sa.Integer, nullable=False, default=0),
+        sa.Column('neutral', sa.Integer, nullable=False, default=0),
+        sa.Column('negative', sa.Integer, nullable=False, default=0),
+    ]
+
+
+def upgrade(conn):
+    # existing diaries are counted by running 'flask rebuild-stats' afterwards
+    metadata = sa.MetaData()
+    sa.Table(
+        'user_stats', metadata,
+        sa.Column('user_id', sa.Integer, primary_key=True, autoincrement=False),
+        *counters(),
+        sa.Column('current_streak', sa.Integer, nullable=False, default=0),
+        sa.Column('longest_streak', sa.Integer, nullable=False, default=0),
+        sa.Column('last_day', sa.Date, nullable=True),
+    )
+    sa.Table(
+        'user_stats_daily', metadata,
+        sa.Column('user_id', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('day', sa.Date, primary_key=True),
+        *counters(),
+    )
+    metadata.create_all(conn)
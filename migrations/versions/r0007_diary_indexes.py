@@ -0,0 +1,21 @@
+"""
+Listing and stuck job indexes on diaries
+"""
+import sqlalchemy as sa
+
+revision = '0007'
+down_revision = '0006'
+
+
+def upgrade(conn):
+    true = 'true' if conn.dialect.name == 'postgresql' else '1'
+    conn.execute(sa.text(
+        'CREATE INDEX ix_diaries_user_created ON diaries (user_id, created_on DESC, id DESC)'
+    ))
+    conn.execute(sa.text(
+        'CREATE INDEX ix_diaries_created ON diaries (created_on DESC, id DESC)'
+    ))
+    conn.execute(sa.text(
+        'CREATE INDEX ix_diaries_stuck ON diaries (coalesce(dispatched_on, created_on)) '
+        'WHERE in_progress = ' + true
+    ))
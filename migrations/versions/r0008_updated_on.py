@@ -0,0 +1,22 @@
+"""
+updated_on versions of diaries and users, for conditional GETs
+"""
+import sqlalchemy as sa
+
+revision = '0008'
+down_revision = '0007'
+
+
+def upgrade(conn):
+    for table, initial in (('diaries', 'created_on'), ('users', 'registered_on')):
+        conn.execute(sa.text(
+            'ALTER TABLE {} ADD COLUMN updated_on TIMESTAMP'.format(table)
+        ))
+        conn.execute(sa.text(
+            'UPDATE {} SET updated_on = {}'.format(table, initial)
+        ))
+        if conn.dialect.name == 'postgresql':
+            # sqlite cannot add the constraint to an existing column
+            conn.execute(sa.text(
+                'ALTER TABLE {} ALTER COLUMN updated_on SET NOT NULL'.format(table)
+            ))
@@ -0,0 +1,24 @@
+"""
+unbounded, optionally compressed diary bodies with a stored preview
+"""
+import sqlalchemy as sa
+
+revision = '0009'
+down_revision = '0008'
+
+
+def upgrade(conn):
+    conn.execute(sa.text('ALTER TABLE diaries ADD COLUMN preview VARCHAR(200)'))
+    conn.execute(sa.text('ALTER TABLE diaries ADD COLUMN text_length INTEGER'))
+    conn.execute(sa.text(
+        'UPDATE diaries SET preview = substr(text, 1, 200), text_length = length(text)'
+    ))
+    if conn.dialect.name == 'postgresql':
+        # stored bodies start with a format byte, p for plain utf-8
+        conn.execute(sa.text(
+            "ALTER TABLE diaries ALTER COLUMN text TYPE BYTEA "
+            "USING convert_to('p' || text, 'UTF8')"
+        ))
+        conn.execute(sa.text('ALTER TABLE diaries ALTER COLUMN result TYPE TEXT'))
+    # sqlite does not enforce the declared types, older bodies are read
+    # back as text and new ones are written as blobs
@@ -0,0 +1,13 @@
+"""
+updated_on index on diaries for incremental exports
+"""
+import sqlalchemy as sa
+
+revision = '0010'
+down_revision = '0009'
+
+
+def upgrade(conn):
+    conn.execute(sa.text(
+        'CREATE INDEX ix_diaries_updated ON diaries (updated_on, id)'
+    ))
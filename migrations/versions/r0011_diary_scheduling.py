@@ -0,0 +1,18 @@
+"""
+backfill flag on outbox rows and the in flight index for the scheduler
+"""
+import sqlalchemy as sa
+
+revision = '0011'
+down_revision = '0010'
+
+
+def upgrade(conn):
+    true, false = ('true', 'false') if conn.dialect.name == 'postgresql' else ('1', '0')
+    conn.execute(sa.text(
+        'ALTER TABLE diary_outbox ADD COLUMN backfill BOOLEAN NOT NULL DEFAULT ' + false
+    ))
+    conn.execute(sa.text(
+        'CREATE INDEX ix_diaries_in_flight ON diaries (dispatched_on) '
+        'WHERE in_progress = ' + true + ' AND dispatched_on IS NOT NULL'
+    ))
@@ -0,0 +1,13 @@
+"""
+blacklisted_on index, the blacklist sync re-reads recent rows
+"""
+import sqlalchemy as sa
+
+revision = '0012'
+down_revision = '0011'
+
+
+def upgrade(conn):
+    conn.execute(sa.text(
+        'CREATE INDEX ix_blacklist_tokens_blacklisted_on ON blacklist_tokens (blacklisted_on)'
+    ))
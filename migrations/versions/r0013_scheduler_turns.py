@@ -0,0 +1,19 @@
+"""
+Round robin state of the backfill scheduler, shared by the relays
+"""
+import sqlalchemy as sa
+
+revision = '0013'
+down_revision = '0012'
+
+
+def upgrade(conn):
+    metadata = sa.MetaData()
+    sa.Table(
+        'scheduler_turns', metadata,
+        sa.Column('user_id', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('position', sa.Integer, nullable=False),
+        sa.Column('deficit', sa.Integer, nullable=False, default=0),
+        sa.Column('serving', sa.Boolean, nullable=False, default=False),
+    )
+    metadata.create_all(conn)
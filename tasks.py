@@ -1,25 +1,196 @@
+import datetime
+import time
+
 from celery import Celery
+from celery.signals import before_task_publish, task_prerun, task_postrun, worker_process_init
+from celery.utils.log import get_task_logger
 
+import metrics
+import worker
 from config import Config
+from extensions import db
+from auth.models import BlacklistToken
+from diary.models import Diary, DiaryOutbox, UserStats
+from diary import compression, processing
+from diary.events import events, message
+from diary.scheduler import scheduler, report, INTERACTIVE, QUEUES
 
 
 celery = Celery('app',broker=Config.CELERY_BROKER_URL)
+celery.conf.task_always_eager = Config.CELERY_TASK_ALWAYS_EAGER
+celery.conf.beat_schedule = {
+    'purge-blacklist': {
+        'task': 'tasks.purge_blacklist',
+        'schedule': Config.BLACKLIST_PURGE_INTERVAL,
+    },
+    'relay-outbox': {
+        'task': 'tasks.relay_outbox',
+        'schedule': Config.RELAY_INTERVAL,
+    },
+    'sweep-diaries': {
+        'task': 'tasks.sweep_diaries',
+        'schedule': Config.SWEEP_INTERVAL,
+    },
+}
+
+logger = get_task_logger(__name__)
 
 @celery.task()
 def process_diary(id):
     pprocess_diary(id)
 
-from app import app, db
-from diary.models import Diary
+@celery.task()
+def process_diaries(ids):
+    pprocess_diaries(ids)
+
+@celery.task()
+def purge_blacklist():
+    return ppurge_blacklist()
+
+@celery.task()
+def relay_outbox():
+    return prelay_outbox()
+
+@celery.task()
+def sweep_diaries():
+    return psweep_diaries()
+
+@worker_process_init.connect
+def init_worker(**kwargs):
+    worker.start()
+    # load the lexicons before the first task arrives
+    processing.get_engine(Config.TEXT_LEXICON_PATH)
+    if Config.WORKER_METRICS_PORT:
+        port = metrics.serve(Config.WORKER_METRICS_HOST, Config.WORKER_METRICS_PORT)
+        logger.info('Serving metrics on port %s', port)
+
+@before_task_publish.connect
+def stamp_published(headers=None, **kwargs):
+    # read back by metrics.task_started for the queue latency
+    headers['published_at'] = time.time()
+
+@task_prerun.connect
+def task_started(task=None, **kwargs):
+    metrics.task_started(task)
+
+@task_postrun.connect
+def task_finished(task=None, state=None, **kwargs):
+    metrics.task_finished(task, state)
+
+def publish_diaries(ids, queue=INTERACTIVE):
+    # called by the relays inside their transaction
+    if celery.conf.task_always_eager:
+        # an eager task would run before the outbox rows are committed and,
+        # on sqlite, wait for the relay's write lock, run_eager() runs it later
+        db.session.info.setdefault('eager_batches', []).append(list(ids))
+        return
+    process_diaries.apply_async((ids,), queue=QUEUES[queue])
+
+def run_eager():
+    # the batches publish_diaries held back, once the relay committed
+    for ids in db.session.info.pop('eager_batches', []):
+        process_diaries.apply_async((ids,))
+
+def release_backfill():
+    # nothing relays on a schedule in eager mode, a bulk import is
+    # released and processed before the request returns
+    if not celery.conf.task_always_eager:
+        return
+    try:
+        while relay_outbox.delay().get():
+            pass
+    except Exception as e:
+        logger.warning('Could not release the backfill: %s', e)
 
 def pprocess_diary(id):
-    with app.app_context():
-        diary = Diary.query.filter_by(id=id).first()
-        diary.result = text_processor(diary.text)
-        diary.in_progress = False
+    pprocess_diaries([id])
 
-        db.session.add(diary)
+def pprocess_diaries(ids):
+    with worker.batch_scope():
+        # one IN query for the whole batch, only the columns needed
+        # bodies stay as stored and are decompressed while they are analyzed
+        diaries = db.session.query(
+            Diary.id, db.type_coerce(Diary.text, compression.StoredBody).label('body'),
+            Diary.user_id, Diary.created_on
+        ).filter(
+            Diary.id.in_(ids), Diary.in_progress == True
+        ).all()
+        # nothing is held while the texts are analyzed
+        db.session.rollback()
+        engine = processing.get_engine(Config.TEXT_LEXICON_PATH)
+        analyses = engine.analyze_many([
+            compression.iter_text(diary.body) for diary in diaries
+        ])
+        # a requeued or redelivered copy of the batch may have finished
+        # meanwhile, only the diaries claimed now are written and counted
+        claimed = Diary.claim_in_progress([diary.id for diary in diaries])
+        processed = [
+            (diary, analysis) for diary, analysis in zip(diaries, analyses)
+            if diary.id in claimed
+        ]
+        diaries = [diary for diary, _ in processed]
+        analyses = [analysis for _, analysis in processed]
+        results = [processing.dumps(analysis) for analysis in analyses]
+        now = datetime.datetime.utcnow()
+        db.session.bulk_update_mappings(Diary, [
+            {
+                'id': diary.id,
+                'result': result,
+                'in_progress': False,
+                'updated_on': now,
+            }
+            for diary, result in zip(diaries, results)
+        ])
+        if diaries:
+            UserStats.record([
+                (diary.user_id, diary.created_on, analysis)
+                for diary, analysis in zip(diaries, analyses)
+            ])
         db.session.commit()
+        # results are only announced once they are committed
+        try:
+            events.publish([
+                message(diary.id, diary.user_id, result, now)
+                for diary, result in zip(diaries, results)
+            ])
+        except Exception as e:
+            logger.warning('Could not publish diary events: %s', e)
+
+def ppurge_blacklist():
+    with worker.batch_scope():
+        stats = BlacklistToken.purge_expired(Config.BLACKLIST_PURGE_BATCH_SIZE)
+    logger.info(
+        'Purged %(purged)s expired tokens in %(batches)s batches, '
+        '%(remaining)s remaining (%(seconds).2fs)', stats
+    )
+    return stats
+
+def prelay_outbox():
+    # rows younger than RELAY_GRACE are still being sent by the web workers
+    older_than = datetime.datetime.now() - datetime.timedelta(seconds=Config.RELAY_GRACE)
+    with worker.batch_scope():
+        sent = DiaryOutbox.drain(
+            publish_diaries, Config.RELAY_BATCH_SIZE, older_than, backfill=False
+        )
+        sent += scheduler.release(publish_diaries)
+        run_eager()
+        try:
+            report()
+        except Exception as e:
+            logger.warning('Could not report the diary queues: %s', e)
+        return sent
+
+def psweep_diaries():
+    with worker.batch_scope():
+        requeued = Diary.requeue_stuck(Config.STUCK_DIARY_TIMEOUT)
+    if requeued:
+        logger.warning('Requeued %s stuck diaries', requeued)
+    return requeued
 
 def text_processor(text):
-    return 'a'
+    # text may be a string or an iterable of chunks such as compression.iter_text
+    return text_processor_many([text])[0]
+
+def text_processor_many(texts):
+    engine = processing.get_engine(Config.TEXT_LEXICON_PATH)
+    return [processing.dumps(analysis) for analysis in engine.analyze_many(texts)]
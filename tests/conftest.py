@@ -0,0 +1,53 @@
+import os
+import sys
+import tempfile
+
+# the configuration is read when config.py is imported
+os.environ['SECRET_KEY'] = 'test'
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['CELERY_TASK_ALWAYS_EAGER'] = '1'
+os.environ['DISPATCH_MAX_DELAY_MS'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from app import app as flask_app
+from extensions import db
+from auth.models import User, blacklist_cache
+from auth.principal import principal_cache
+from auth.tokens import token_service
+
+
+@pytest.fixture
+def app():
+    config = dict(flask_app.config)
+    with flask_app.app_context():
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+        db.drop_all()
+    flask_app.config.clear()
+    flask_app.config.update(config)
+    # per process caches would outlive the tables
+    blacklist_cache.bloom = None
+    blacklist_cache.last_id = 0
+    blacklist_cache.hits.clear()
+    principal_cache.backend = None
+    token_service.memo.clear()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def make_user(app):
+    def make_user(email, admin=False):
+        user = User(email, 'password')
+        user.admin = admin
+        db.session.add(user)
+        db.session.commit()
+        return user, user.encode_auth_token(user.id)
+    return make_user
@@ -0,0 +1,86 @@
+import datetime
+import os
+import time
+
+import pytest
+
+from extensions import db
+from auth.blacklist import BlacklistCache
+from auth.models import BlacklistToken
+
+
+def blacklist(token, id=None):
+    row = BlacklistToken(token)
+    row.id = id
+    db.session.add(row)
+    db.session.commit()
+    return row.token_hash
+
+
+def test_sync_reads_rows_committed_out_of_id_order(app, make_user):
+    app.config['BLACKLIST_SYNC_INTERVAL'] = 0
+    user, token = make_user('a@example.com')
+    _, other = make_user('b@example.com')
+    cache = BlacklistCache(BlacklistToken)
+    blacklist(other, id=10)
+    cache.warm()
+    assert cache.last_id == 10
+
+    # id 5 was taken first but committed after the sync passed 10
+    digest = blacklist(token, id=5)
+    assert cache.contains(digest)
+
+
+def test_sync_overlap_is_bounded(app, make_user):
+    user, token = make_user('a@example.com')
+    row = BlacklistToken(token)
+    row.blacklisted_on = datetime.datetime.now() - datetime.timedelta(minutes=5)
+    db.session.add(row)
+    db.session.commit()
+    # below the watermark, only re-read while within the overlap
+    recent = datetime.datetime.now() - datetime.timedelta(minutes=1)
+    assert list(BlacklistToken.since(row.id, recent)) == []
+    recent = datetime.datetime.now() - datetime.timedelta(minutes=10)
+    assert [id for id, _ in BlacklistToken.since(row.id, recent)] == [row.id]
+
+
+def test_listeners_reach_other_processes_without_sync(app, make_user):
+    app.config['BLACKLIST_SYNC_INTERVAL'] = 3600
+    user, token = make_user('a@example.com')
+    here = BlacklistCache(BlacklistToken)
+    there = BlacklistCache(BlacklistToken)
+    here.warm()
+    there.warm()
+    here.add_listener(there.receive)
+
+    digest = blacklist(token)
+    here.add(digest)
+    assert there.contains(digest)
+
+
+def test_logout_rejects_the_token(client, make_user):
+    user, token = make_user('a@example.com')
+    assert client.get('/api/auth/profile', headers={'Authorization': token}).status_code == 200
+    assert client.post('/api/auth/logout', headers={'Authorization': token}).status_code == 200
+    assert client.get('/api/auth/profile', headers={'Authorization': token}).status_code == 401
+
+
+@pytest.fixture
+def west_of_utc():
+    # naive utc times read as local ones are hours ahead here
+    previous = os.environ.get('TZ')
+    os.environ['TZ'] = 'Etc/GMT+10'
+    time.tzset()
+    yield
+    if previous is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = previous
+    time.tzset()
+
+
+def test_blacklist_is_checked_west_of_utc(app, make_user, west_of_utc):
+    user, token = make_user('a@example.com')
+    digest = blacklist(token)
+    assert BlacklistToken.check_digest(digest, time.time() + 3600)
+    assert not BlacklistToken.check_digest(digest, time.time() - 1)
@@ -0,0 +1,54 @@
+import datetime
+
+from auth.models import User
+from diary.models import Diary
+from extensions import db
+
+
+def create(user_id, text='a good day'):
+    id, = Diary.insert_many(user_id, [(text, None)])
+    db.session.commit()
+    return id
+
+
+def bump(model, id):
+    row = db.session.get(model, id)
+    row.updated_on += datetime.timedelta(seconds=2)
+    db.session.commit()
+
+
+def revalidates(client, url, token, change):
+    headers = {'Authorization': token}
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+    assert client.get(url, headers=dict(headers, **{'If-None-Match': etag})).status_code == 304
+    assert client.get(url, headers=dict(headers, **{'If-Modified-Since': last_modified})).status_code == 304
+    change()
+    response = client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    response = client.get(url, headers=dict(headers, **{'If-Modified-Since': last_modified}))
+    assert response.status_code == 200
+    return response
+
+
+def test_diary_detail(app, client, make_user):
+    user, token = make_user('a@example.com')
+    id = create(user.id)
+    response = revalidates(client, '/api/diary/{}'.format(id), token, lambda: bump(Diary, id))
+    # utc, unlike the local created_on next to it
+    assert response.json['data']['updated_on'].endswith('+00:00')
+
+
+def test_diary_listing(app, client, make_user):
+    user, token = make_user('a@example.com')
+    id = create(user.id)
+    response = revalidates(client, '/api/diary', token, lambda: bump(Diary, id))
+    assert response.json['data'][0]['updated_on'].endswith('+00:00')
+
+
+def test_profile(app, client, make_user):
+    user, token = make_user('a@example.com')
+    user_id = user.id
+    revalidates(client, '/api/auth/profile', token, lambda: bump(User, user_id))
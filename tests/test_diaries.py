@@ -0,0 +1,22 @@
+import pytest
+
+from diary.models import Diary
+
+
+@pytest.mark.parametrize('body', [{'text': 12}, {'text': ['a']}, {'text': ''}, {}, ['a']])
+def test_create_rejects_malformed_text(app, client, make_user, body):
+    user, token = make_user('a@example.com')
+    response = client.post('/api/diary', json=body, headers={'Authorization': token})
+    assert response.status_code == 400
+    assert response.json['status'] == 'fail'
+    assert Diary.query.count() == 0
+
+
+def test_create_rejects_long_text(app, client, make_user):
+    app.config['DIARY_TEXT_MAX_LENGTH'] = 10
+    user, token = make_user('a@example.com')
+    response = client.post('/api/diary', json={'text': 'x' * 11}, headers={'Authorization': token})
+    assert response.status_code == 400
+    assert response.json['message'] == 'Text must be at most 10 characters.'
+    response = client.post('/api/diary', json={'text': 'x' * 10}, headers={'Authorization': token})
+    assert response.status_code == 201
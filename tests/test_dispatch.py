@@ -0,0 +1,15 @@
+import logging
+
+from diary.dispatch import BatchDispatcher
+
+
+def test_failed_batches_are_logged(app, caplog):
+    def send(ids):
+        raise ConnectionError('broker down')
+
+    dispatcher = BatchDispatcher(send, max_batch=10, max_delay=0)
+    with caplog.at_level(logging.WARNING):
+        dispatcher.submit_many([1, 2, 3])
+    record, = [record for record in caplog.records if 'dispatch' in record.getMessage()]
+    assert record.getMessage() == 'Could not dispatch 3 diaries'
+    assert record.exc_info[0] is ConnectionError
@@ -0,0 +1,46 @@
+import datetime
+
+import tasks
+from extensions import db
+from diary.events import events
+from diary.models import Diary
+
+
+def test_unread_streams_do_not_subscribe(client, make_user):
+    user, token = make_user('a@example.com')
+    before = len(events._broker().subscriptions)
+    for _ in range(3):
+        response = client.head('/api/diary/events', headers={'Authorization': token})
+        assert response.status_code == 200
+        response.close()
+    assert len(events._broker().subscriptions) == before
+
+
+def test_read_streams_unsubscribe(client, make_user, app):
+    app.config.update(EVENTS_MAX_AGE=0.2, EVENTS_HEARTBEAT=0.1)
+    user, token = make_user('a@example.com')
+    response = client.get('/api/diary/events', headers={'Authorization': token})
+    response.get_data()
+    assert not events._broker().subscriptions
+
+
+def test_catch_up_overlaps_the_last_event(client, make_user, app):
+    app.config.update(EVENTS_MAX_AGE=0.2, EVENTS_HEARTBEAT=0.1, EVENTS_CATCH_UP_LAG=30)
+    user, token = make_user('a@example.com')
+    diary = Diary('a good day', user.id, True)
+    db.session.add(diary)
+    db.session.commit()
+    diary_id = diary.id
+    tasks.pprocess_diaries([diary_id])
+    # committed late, with an updated_on before the last event id
+    last_event = datetime.datetime.utcnow()
+    late = db.session.get(Diary, diary_id)
+    late.updated_on = last_event - datetime.timedelta(seconds=5)
+    db.session.commit()
+
+    response = client.get('/api/diary/events', headers={
+        'Authorization': token, 'Last-Event-ID': last_event.isoformat()
+    })
+    body = response.get_data(as_text=True)
+    assert body.count('event: diary') == 1
+    assert '"id":{},'.format(diary_id) in body.replace(' ', '')
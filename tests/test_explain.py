@@ -0,0 +1,32 @@
+import pytest
+import sqlalchemy
+
+from extensions import db
+from diary import explain
+
+
+def test_queries_use_indexes(app):
+    engine = sqlalchemy.create_engine('sqlite://')
+    results = explain.check(engine, rows=20000, users=200)
+    failed = [(name, plan) for name, plan, ok in results if not ok]
+    assert results and not failed
+    # ANALYZE leaves its statistics table behind
+    assert set(sqlalchemy.inspect(engine).get_table_names()) <= {'sqlite_stat1'}
+
+
+def test_refuses_databases_with_tables(app):
+    count = db.session.execute(sqlalchemy.text('SELECT count(*) FROM users')).scalar()
+    with pytest.raises(ValueError):
+        explain.check(db.engine, rows=10, users=1)
+    # nothing was dropped
+    assert db.session.execute(sqlalchemy.text('SELECT count(*) FROM users')).scalar() == count
+
+
+def test_command_refuses_databases_with_tables(app, tmp_path):
+    url = 'sqlite:///' + str(tmp_path / 'app.db')
+    engine = sqlalchemy.create_engine(url)
+    db.metadata.create_all(engine)
+    result = app.test_cli_runner().invoke(args=['explain-queries', '--url', url, '--rows', '10'])
+    assert result.exit_code == 1
+    assert 'already has the tables' in result.output
+    assert 'diaries' in sqlalchemy.inspect(engine).get_table_names()
@@ -0,0 +1,24 @@
+from diary.models import Diary
+from extensions import db
+
+
+def test_export_filters_by_user(app, client, make_user):
+    app.config['EXPORT_WATERMARK_LAG'] = 0
+    admin, token = make_user('admin@example.com', admin=True)
+    user, _ = make_user('a@example.com')
+    admin_id, user_id = admin.id, user.id
+    Diary.insert_many(admin_id, [('mine', None)])
+    Diary.insert_many(user_id, [('theirs', None)])
+    db.session.commit()
+
+    response = client.get('/api/diary/export?user_id={}'.format(user_id), headers={'Authorization': token})
+    assert response.status_code == 200
+    lines = response.get_data(as_text=True).splitlines()
+    assert len(lines) == 2 and lines[1].endswith(',theirs')
+
+
+def test_export_rejects_malformed_user_id(app, client, make_user):
+    admin, token = make_user('admin@example.com', admin=True)
+    response = client.get('/api/diary/export?user_id=abc', headers={'Authorization': token})
+    assert response.status_code == 400
+    assert response.json['message'] == 'User id must be an integer.'
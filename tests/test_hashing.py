@@ -0,0 +1,63 @@
+import pytest
+
+from auth.hashing import password_hasher
+from auth.models import User
+from extensions import db
+
+
+@pytest.fixture
+def rebuild(app):
+    def rebuild(**config):
+        app.config.update(config)
+        # the backends and the pool are built once per process
+        password_hasher.pid = None
+    yield rebuild
+    password_hasher.pid = None
+
+
+def login(client, password='password'):
+    return client.post('/api/auth/login', json={'email': 'a@example.com', 'password': password})
+
+
+def stored_hash(user_id):
+    db.session.expire_all()
+    return db.session.get(User, user_id).password
+
+
+def test_busy_hasher_answers_429(client, make_user, rebuild):
+    make_user('a@example.com')
+    rebuild(HASH_MAX_PENDING=1)
+    password_hasher._setup()
+    # the only slot is taken by another request
+    assert password_hasher.slots.acquire(blocking=False)
+    try:
+        assert login(client).status_code == 429
+        response = client.post('/api/auth/register', json={'email': 'b@example.com', 'password': 'x'})
+        assert response.status_code == 429
+    finally:
+        password_hasher.slots.release()
+    assert login(client).status_code == 200
+
+
+def test_login_rehashes_with_new_rounds(client, make_user, rebuild):
+    user, _ = make_user('a@example.com')
+    user_id = user.id
+    assert stored_hash(user_id).startswith('$2b$04$')
+    rebuild(BCRYPT_LOG_ROUNDS=5)
+    assert login(client, 'wrong').status_code == 404
+    assert stored_hash(user_id).startswith('$2b$04$')
+    assert login(client).status_code == 200
+    assert stored_hash(user_id).startswith('$2b$05$')
+
+
+def test_login_moves_bcrypt_to_argon2id(client, make_user, rebuild):
+    pytest.importorskip('argon2')
+    user, _ = make_user('a@example.com')
+    user_id = user.id
+    rebuild(PASSWORD_HASHER='argon2id', ARGON2_TIME_COST=1, ARGON2_MEMORY_COST=8, ARGON2_PARALLELISM=1)
+    assert login(client).status_code == 200
+    hashed = stored_hash(user_id)
+    assert hashed.startswith('$argon2id$')
+    # current hashes are left alone
+    assert login(client).status_code == 200
+    assert stored_hash(user_id) == hashed
@@ -0,0 +1,79 @@
+import io
+import json
+
+import pytest
+
+from diary import ingest
+
+
+def items(body, max_item_size=None):
+    return [item for item, _ in ingest.json_array_items(io.BytesIO(body), max_item_size)]
+
+
+def test_array_items():
+    assert items(b' [1, {"text": "a"}, "b" , 12345678901234567890] ') == [
+        1, {'text': 'a'}, 'b', 12345678901234567890
+    ]
+    assert items(b'[]') == []
+
+
+@pytest.mark.parametrize('body', [b'[1]trailing', b'[1] [2]', b'[]x', b'[1,', b'{}', b'[1 2]'])
+def test_malformed_arrays(body):
+    with pytest.raises(ingest.MalformedBody):
+        items(body)
+
+
+class CountingDecoder:
+    # characters every raw_decode call had in front of it
+
+    def __init__(self):
+        self.scanned = 0
+
+    def raw_decode(self, s, idx=0):
+        self.scanned += len(s) - idx
+        return json.JSONDecoder().raw_decode(s, idx)
+
+
+def test_large_items_are_linear(monkeypatch):
+    def scanned(size):
+        decoder = CountingDecoder()
+        monkeypatch.setattr(ingest, '_decoder', decoder)
+        body = json.dumps([{'text': 'x' * size}]).encode()
+        assert len(items(body)[0]['text']) == size
+        return decoder.scanned
+
+    # retrying with one more chunk each time scanned the item 32 times at 4MB
+    for size in (1 << 20, 4 << 20):
+        assert scanned(size) < 3 * size
+
+
+def test_items_over_the_limit_stop_the_body():
+    body = json.dumps([{'text': 'short'}, {'text': 'x' * 300000}]).encode()
+    parsed = ingest.json_array_items(io.BytesIO(body), max_item_size=100000)
+    assert next(parsed) == ({'text': 'short'}, None)
+    with pytest.raises(ingest.MalformedBody, match='at most 100000 bytes'):
+        next(parsed)
+
+
+def test_ndjson_lines_over_the_limit_fail_alone():
+    body = b'{"text": "a"}\n{"text": "' + b'x' * 300000 + b'"}\nnot json\n{"text": "b"}\n'
+    parsed = list(ingest.ndjson_items(io.BytesIO(body), max_item_size=1000))
+    assert parsed[0] == ({'text': 'a'}, None)
+    assert parsed[1][0] is None and 'at most 1000 bytes' in parsed[1][1]
+    assert parsed[2] == (None, 'Invalid JSON.')
+    assert parsed[3] == ({'text': 'b'}, None)
+
+
+def test_bulk_rejects_trailing_data_and_large_bodies(client, make_user, app):
+    user, token = make_user('a@example.com')
+    headers = {'Authorization': token}
+    response = client.post('/api/diary/bulk', headers=headers, data=b'[{"text": "a"}]trailing',
+                           content_type='application/json')
+    assert response.status_code == 400
+    assert response.json['created'] == 1
+    assert response.json['message'] == 'Unexpected data after the array.'
+
+    app.config['MAX_CONTENT_LENGTH'] = 100
+    response = client.post('/api/diary/bulk', headers=headers,
+                           json=[{'text': 'x' * 200}])
+    assert response.status_code == 413
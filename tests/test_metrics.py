@@ -0,0 +1,30 @@
+import datetime
+
+import metrics
+from auth.models import BlacklistToken
+from extensions import db
+
+
+def test_metrics_only_for_allowed_addresses(app, client):
+    assert client.get('/metrics').status_code == 200
+    remote = {'REMOTE_ADDR': '203.0.113.5'}
+    assert client.get('/metrics', environ_base=remote).status_code == 403
+    app.config['METRICS_ALLOW'] = '10.0.0.0/8, 203.0.113.0/24'
+    assert client.get('/metrics', environ_base=remote).status_code == 200
+    assert client.get('/metrics').status_code == 403
+    app.config['METRICS_ALLOW'] = ''
+    assert client.get('/metrics').status_code == 403
+
+
+def test_purge_is_counted(app, make_user):
+    user, token = make_user('a@example.com')
+    db.session.add(BlacklistToken(token))
+    db.session.commit()
+    db.session.query(BlacklistToken).update({'exp': datetime.datetime.utcnow() - datetime.timedelta(hours=1)})
+    db.session.commit()
+    before = metrics.BLACKLIST_PURGED.values.get((), 0)
+    stats = BlacklistToken.purge_expired()
+    assert stats['purged'] == 1
+    assert metrics.BLACKLIST_PURGED.values[()] == before + 1
+    assert metrics.BLACKLIST_TOKENS.values[()] == 0
+    assert 'blacklist_purged_total' in metrics.registry.render()
@@ -0,0 +1,60 @@
+import datetime
+import json
+
+import pytest
+
+from diary.models import Diary
+from extensions import db
+
+
+@pytest.fixture
+def diaries(app, make_user):
+    # five diaries share a created_on, only the id orders them
+    user, token = make_user('a@example.com')
+    same = datetime.datetime(2023, 1, 2)
+    items = [('diary {}'.format(i), same) for i in range(5)]
+    items += [('older', datetime.datetime(2023, 1, 1)), ('newer', datetime.datetime(2023, 1, 3))]
+    ids = Diary.insert_many(user.id, items)
+    db.session.commit()
+    newest_first = [ids[6]] + sorted(ids[:5], reverse=True) + [ids[5]]
+    return token, newest_first
+
+
+def test_pages_cover_equal_created_on_once(client, diaries):
+    token, expected = diaries
+    seen = []
+    cursor = None
+    while True:
+        url = '/api/diary?limit=2' + ('&cursor=' + cursor if cursor else '')
+        response = client.get(url, headers={'Authorization': token})
+        assert response.status_code == 200
+        seen += [diary['id'] for diary in response.json['data']]
+        cursor = response.json['next_cursor']
+        if cursor is None:
+            break
+    assert seen == expected
+
+
+def test_stream_modes(client, diaries):
+    token, expected = diaries
+    headers = {'Authorization': token}
+    response = client.get('/api/diary?stream=ndjson', headers=headers)
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line)['id'] for line in lines] == expected
+    response = client.get('/api/diary?stream=json&limit=3', headers=headers)
+    assert [diary['id'] for diary in json.loads(response.get_data(as_text=True))['data']] == expected[:3]
+
+    # a stream goes on after the cursor of a page, inside the equal created_on
+    page = client.get('/api/diary?limit=2', headers=headers).json
+    response = client.get('/api/diary?stream=ndjson&cursor=' + page['next_cursor'], headers=headers)
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line)['id'] for line in lines] == expected[2:]
+
+
+@pytest.mark.parametrize('query', ['limit=abc', 'limit=0', 'limit=-1', 'cursor=abc'])
+def test_malformed_parameters(client, diaries, query):
+    token, _ = diaries
+    response = client.get('/api/diary?' + query, headers={'Authorization': token})
+    assert response.status_code == 400
+    assert 'int()' not in response.json['message']
@@ -0,0 +1,74 @@
+from diary.models import Diary, DiaryOutbox, SchedulerTurn
+from diary.scheduler import FairShare, Scheduler, BACKFILL
+from extensions import db
+
+
+def test_fair_share_takes_turns_by_cost():
+    fair_share = FairShare(10)
+    pending = {
+        1: ([('a1', 5), ('a2', 5), ('a3', 5), ('a4', 5)], 4),
+        2: ([('b1', 10), ('b2', 10)], 2),
+    }
+    assert fair_share.select(pending, 100) == ['a1', 'a2', 'b1', 'a3', 'a4', 'b2']
+    assert not fair_share.order and not fair_share.deficits
+
+
+def test_fair_share_resumes_a_turn_from_saved_state():
+    fair_share = FairShare(10)
+    pending = {1: ([('a1', 5), ('a2', 5), ('a3', 5)], 3), 2: ([('b1', 10)], 1)}
+    assert fair_share.select(pending, 1) == ['a1']
+    # another process goes on with the same turn, without a new quantum
+    resumed = FairShare(10, fair_share.order, fair_share.deficits, fair_share.serving)
+    pending = {1: ([('a2', 5), ('a3', 5)], 2), 2: ([('b1', 10)], 1)}
+    assert resumed.select(pending, 2) == ['a2', 'b1']
+
+
+def backfill(user_ids, count):
+    for user_id in user_ids:
+        Diary.insert_many(user_id, [('abcd', None)] * count, backfill=True)
+    db.session.commit()
+
+
+def test_release_caps_in_flight_and_keeps_turns(app, make_user):
+    app.config.update(
+        SCHEDULER_BACKFILL_IN_FLIGHT=3, SCHEDULER_BACKFILL_BATCH_SIZE=2, SCHEDULER_QUANTUM=4
+    )
+    first, _ = make_user('a@example.com')
+    second, _ = make_user('b@example.com')
+    first_id, second_id = first.id, second.id
+    backfill([first_id, second_id], 3)
+    published = []
+    publish = lambda ids, queue: published.append((queue, list(ids)))
+
+    assert Scheduler().release(publish) == 3
+    assert [queue for queue, _ in published] == [BACKFILL, BACKFILL]
+    released = [id for _, ids in published for id in ids]
+    owners = [db.session.get(Diary, id).user_id for id in released]
+    assert owners == [first_id, second_id, first_id]
+    assert Diary.in_flight().scalar() == 3
+    # full, nothing more until some are processed
+    assert Scheduler().release(publish) == 0
+    assert DiaryOutbox.query.count() == 3
+
+    Diary.query.filter(Diary.id.in_(released)).update({'in_progress': False})
+    db.session.commit()
+    published.clear()
+    # the turns are kept in the database, any relay goes on with them
+    assert SchedulerTurn.load()[0] == [second_id, first_id]
+    assert Scheduler().release(publish) == 3
+    owners = [db.session.get(Diary, id).user_id for _, ids in published for id in ids]
+    assert owners == [second_id, first_id, second_id]
+    assert SchedulerTurn.query.count() == 0
+
+
+def test_eager_bulk_imports_are_processed(app, client, make_user):
+    app.config.update(SCHEDULER_BACKFILL_IN_FLIGHT=2, SCHEDULER_BACKFILL_BATCH_SIZE=1)
+    user, token = make_user('a@example.com')
+    response = client.post(
+        '/api/diary/bulk', json=[{'text': 'a good day'}] * 5, headers={'Authorization': token}
+    )
+    assert response.status_code == 201
+    assert response.json['created'] == 5
+    assert DiaryOutbox.query.count() == 0
+    assert Diary.query.filter(Diary.in_progress == True).count() == 0
+    assert Diary.query.filter(Diary.result != None).count() == 5
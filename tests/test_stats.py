@@ -0,0 +1,79 @@
+import datetime
+
+import tasks
+from extensions import db
+from diary import processing
+from diary.models import Diary, UserStats, UserStatsDaily
+
+
+def add_diaries(user_id, texts, start=datetime.datetime(2024, 1, 1, 9)):
+    diaries = []
+    for day, text in enumerate(texts):
+        diary = Diary(text, user_id, True)
+        diary.created_on = start + datetime.timedelta(days=day)
+        diaries.append(diary)
+    db.session.add_all(diaries)
+    db.session.commit()
+    return [diary.id for diary in diaries]
+
+
+def stats(user_id):
+    db.session.expire_all()
+    row = db.session.get(UserStats, user_id)
+    return row.myjson() if row else None
+
+
+def test_processing_twice_counts_once(app):
+    ids = add_diaries(1, ['a good day', 'a bad day'])
+    tasks.pprocess_diaries(ids)
+    tasks.pprocess_diaries(ids)
+    assert stats(1)['diaries'] == 2
+    assert UserStatsDaily.query.count() == 2
+
+
+def test_overlapping_tasks_count_once(app, monkeypatch):
+    ids = add_diaries(1, ['a good day', 'a bad day', 'another day'])
+    engine = processing.get_engine(tasks.Config.TEXT_LEXICON_PATH)
+    analyze_many = engine.analyze_many
+    overlapped = []
+
+    def redelivered(texts):
+        # the same batch runs to completion while this one is analyzing
+        texts = list(texts)
+        if not overlapped:
+            overlapped.append(True)
+            tasks.pprocess_diaries(ids)
+        return analyze_many(texts)
+
+    monkeypatch.setattr(engine, 'analyze_many', redelivered)
+    tasks.pprocess_diaries(ids)
+    assert stats(1)['diaries'] == 3
+    assert Diary.query.filter_by(in_progress=True).count() == 0
+
+
+def test_first_rows_of_a_user_exist_before_locking(app):
+    ids = add_diaries(1, ['a good day'])
+    # a row another worker created between our read and our insert
+    db.session.add(UserStats(1))
+    db.session.add(UserStatsDaily(1, datetime.date(2024, 1, 1)))
+    db.session.commit()
+    tasks.pprocess_diaries(ids)
+    assert stats(1)['diaries'] == 1
+    assert stats(1)['current_streak'] == 1
+
+
+def test_streaks(app):
+    ids = add_diaries(1, ['one', 'two', 'three'])
+    tasks.pprocess_diaries(ids[2:])
+    tasks.pprocess_diaries(ids[:2])
+    assert stats(1)['current_streak'] == 3
+    assert stats(1)['longest_streak'] == 3
+
+
+def test_rebuild_matches_incremental_stats(app):
+    ids = add_diaries(1, ['a good day', 'a bad day', 'fine']) + add_diaries(2, ['great'])
+    tasks.pprocess_diaries(ids)
+    before = {user_id: stats(user_id) for user_id in (1, 2)}
+    assert UserStats.rebuild(chunk_size=1) == 2
+    assert {user_id: stats(user_id) for user_id in (1, 2)} == before
+    assert UserStatsDaily.query.count() == 4
@@ -0,0 +1,78 @@
+import time
+
+import jwt
+import pytest
+
+from auth.tokens import token_service, EXPIRED, INVALID, LEGACY_KID
+
+
+@pytest.fixture
+def keys(app):
+    def keys(value, signing_kid=None):
+        app.config.update(JWT_KEYS=value, JWT_SIGNING_KID=signing_kid)
+        # keys are loaded once per process, load them again
+        token_service.pid = None
+    yield keys
+    token_service.pid = None
+
+
+def test_signing_kid_is_in_the_header(keys):
+    keys('new=secret-new', 'new')
+    token = token_service.encode(1, 60)
+    assert jwt.get_unverified_header(token)['kid'] == 'new'
+    result = token_service.verify(token)
+    assert result.valid and result.user_id == 1 and result.kid == 'new'
+
+
+def test_legacy_tokens_have_no_kid(keys):
+    keys(None)
+    token = token_service.encode(1, 60)
+    assert 'kid' not in jwt.get_unverified_header(token)
+    assert token_service.verify(token).kid == LEGACY_KID
+
+
+def test_rotation_accepts_the_old_key_until_it_is_removed(keys):
+    keys('old=secret-old', 'old')
+    old = token_service.encode(1, 60)
+    keys('old=secret-old,new=secret-new', 'new')
+    new = token_service.encode(2, 60)
+    assert jwt.get_unverified_header(new)['kid'] == 'new'
+    assert token_service.verify(old).user_id == 1
+    assert token_service.verify(new).user_id == 2
+    keys('new=secret-new', 'new')
+    assert token_service.verify(old).error == INVALID
+    assert token_service.verify(new).user_id == 2
+
+
+def test_unknown_kid_and_bad_signature_are_invalid(keys):
+    keys('new=secret-new', 'new')
+    token = jwt.encode(
+        {'sub': 1, 'exp': int(time.time()) + 60}, 'secret-new', algorithm='HS256',
+        headers={'kid': 'other'}
+    )
+    assert token_service.verify(token).error == INVALID
+    forged = jwt.encode(
+        {'sub': 1, 'exp': int(time.time()) + 60}, 'guessed', algorithm='HS256',
+        headers={'kid': 'new'}
+    )
+    assert token_service.verify(forged).error == INVALID
+
+
+def test_expired_tokens_are_rejected(keys):
+    keys('new=secret-new', 'new')
+    token = token_service.encode(1, -1)
+    assert token_service.verify(token).error == EXPIRED
+    assert not token_service.memo
+
+
+def test_memoized_results_expire(keys):
+    keys('new=secret-new', 'new')
+    token = token_service.encode(1, 60)
+    result = token_service.verify(token)
+    hits = token_service.hits
+    assert token_service.verify(token) == result
+    assert token_service.hits == hits + 1
+    # the token expires while it is remembered
+    token_service.memo[result.digest] = result._replace(exp=time.time() - 1)
+    assert token_service.verify(token).error == EXPIRED
+    assert result.digest not in token_service.memo
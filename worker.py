@@ -0,0 +1,55 @@
+"""
+Worker side bootstrap.
+
+A bare Flask app sharing config, models and the engine setup with the
+API, without its blueprints, so Celery processes stay small. Each
+worker process keeps one app context, and so one session, for its
+whole life and every batch runs in batch_scope().
+"""
+from contextlib import contextmanager
+
+from flask import Flask, current_app, has_app_context
+from flask.globals import app_ctx
+
+import database
+from extensions import db
+
+app = Flask('worker')
+app.config.from_object('config.Config')
+db.init_app(app)
+
+context = None
+
+
+def start():
+    # called once per worker process
+    global context
+    if context is None:
+        context = app.app_context()
+        context.push()
+
+
+@contextmanager
+def batch_scope():
+    """
+    Runs a batch on the worker session, or on a session of its own when
+    called inside another app context (an eager task sent by the relay
+    must not close the relay's session), rolls back on errors and always
+    releases the connection afterwards
+    """
+    pushed = None
+    if not has_app_context():
+        pushed = app.app_context()
+    elif app_ctx._get_current_object() is not context:
+        pushed = current_app.app_context()
+    if pushed is not None:
+        pushed.push()
+    try:
+        yield db.session
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        db.session.close()
+        if pushed is not None:
+            pushed.pop()